@@ -0,0 +1,327 @@
+"""Throughput and latency of the function-calling server under agent
+workloads: the multi-turn, parallel-calling and sequential-calling
+conversations of scenarios.py, replayed by `--concurrency` clients, each
+sending the requests of one conversation after the other (streamed).
+
+Runs against a server started with `python -m empower_functions.server
+--chat_format empower-functions` (--server URL, with an n_ctx that fits
+the longest conversation), in process against a Llama with the
+EmpowerFunctionsCompletionHandler (--model MODEL.gguf) or against a
+StubLlama answering with tool calls at the --stub-prefill-rate and
+--stub-decode-rate token rates (--stub, see stub_llama.py).
+
+Reports, per scenario: requests and completion tokens per second, time
+to first token and inter-token latency percentiles, the prefill/decode
+split and peak memory. Token counts and the prefill/decode split come
+from the server's /metrics (empower_functions.metrics in process).
+With --output the results are stored as JSON; --compare prints the
+change from an earlier results file.
+
+Usage: python benchmarks/agent_workloads.py (--server URL | --model MODEL.gguf | --stub)
+           [--scenarios multi_turn parallel_calling sequential_calling]
+           [--conversations 8] [--concurrency 4] [--max-tokens 64]
+           [--output results.json] [--compare baseline.json]
+           [--n-parallel 4] [--n-ctx 8192] [--server-pid PID]
+           [--stub-prefill-rate 2000] [--stub-decode-rate 50]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from scenarios import SCENARIOS, requests
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentiles(values):
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+    values = sorted(values)
+    return {
+        f"p{p}": values[min(len(values) - 1, int(len(values) * p / 100))]
+        for p in PERCENTILES
+    }
+
+
+def parse_metrics(text):
+    """Samples of the Prometheus text format, by name and labels."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+class ServerTarget:
+    def __init__(self, url, pid=None):
+        self.url = url.rstrip("/")
+        self.pid = pid
+
+    def stream(self, tools, messages, max_tokens):
+        """Yields the chunks of a streamed chat completion."""
+        request = urllib.request.Request(
+            self.url + "/v1/chat/completions",
+            data=json.dumps({
+                "messages": messages,
+                "tools": tools,
+                "max_tokens": max_tokens,
+                "temperature": 0,
+                "stream": True,
+            }).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            for line in response:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data: "):
+                    continue
+                if line == "data: [DONE]":
+                    break
+                yield json.loads(line[len("data: "):])
+
+    def metrics(self):
+        with urllib.request.urlopen(self.url + "/metrics") as response:
+            return parse_metrics(response.read().decode("utf-8"))
+
+    def peak_memory_bytes(self):
+        if self.pid is None:
+            return None
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+        return None
+
+
+class InProcessTarget:
+    def __init__(self, llama):
+        from empower_functions.monkey_patch.app import _create_chat_completion_patched
+
+        self.llama = llama
+        self._create_chat_completion = _create_chat_completion_patched
+        # Without a batch scheduler a Llama serves one request at a time.
+        self._lock = (
+            threading.Lock()
+            if getattr(llama.chat_handler, "n_parallel", 1) <= 1
+            else None
+        )
+
+    def stream(self, tools, messages, max_tokens):
+        if self._lock is not None:
+            self._lock.acquire()
+        try:
+            yield from self._create_chat_completion(
+                self.llama,
+                messages=messages,
+                tools=tools,
+                max_tokens=max_tokens,
+                temperature=0,
+                stream=True,
+            )
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+
+    def metrics(self):
+        from empower_functions.metrics import REGISTRY
+
+        return parse_metrics(REGISTRY.render())
+
+    def peak_memory_bytes(self):
+        # Kilobytes on Linux, bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def run_request(target, tools, messages, max_tokens):
+    """Seconds to the first generated chunk, between the following ones
+    and in total."""
+    start = time.perf_counter()
+    arrivals = []
+    for chunk in target.stream(tools, messages, max_tokens):
+        delta = chunk["choices"][0]["delta"]
+        if delta.get("content") or delta.get("tool_calls"):
+            arrivals.append(time.perf_counter())
+    end = time.perf_counter()
+    ttft = arrivals[0] - start if arrivals else None
+    itl = [b - a for a, b in zip(arrivals, arrivals[1:])]
+    return ttft, itl, end - start
+
+
+def _metric_delta(before, after, name):
+    return after.get(name, 0.0) - before.get(name, 0.0)
+
+
+def run_scenario(target, scenario, conversations, concurrency, max_tokens):
+    ttfts, itls, latencies = [], [], []
+    errors = 0
+    lock = threading.Lock()
+
+    def conversation(i):
+        nonlocal errors
+        for tools, messages in requests(scenario, i):
+            try:
+                ttft, itl, latency = run_request(target, tools, messages, max_tokens)
+            except Exception:  # noqa: BLE001
+                with lock:
+                    errors += 1
+                continue
+            with lock:
+                if ttft is not None:
+                    ttfts.append(ttft)
+                itls.extend(itl)
+                latencies.append(latency)
+
+    before = target.metrics()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(conversation, range(conversations)))
+    seconds = time.perf_counter() - start
+    after = target.metrics()
+
+    prefill = _metric_delta(before, after, 'empower_phase_seconds_sum{phase="prefill"}')
+    decode = _metric_delta(before, after, 'empower_phase_seconds_sum{phase="decode"}')
+    completion_tokens = _metric_delta(before, after, "empower_completion_tokens_total")
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": seconds,
+        "requests_per_second": len(latencies) / seconds,
+        "completion_tokens_per_second": completion_tokens / seconds,
+        "prompt_tokens": _metric_delta(before, after, "empower_prompt_tokens_total"),
+        "cached_prompt_tokens": _metric_delta(before, after, "empower_cached_prompt_tokens_total"),
+        "completion_tokens": completion_tokens,
+        "ttft_seconds": percentiles(ttfts),
+        "inter_token_seconds": percentiles(itls),
+        "latency_seconds": percentiles(latencies),
+        "prefill_seconds": prefill,
+        "decode_seconds": decode,
+        "prefill_share": prefill / (prefill + decode) if prefill + decode > 0 else None,
+        "peak_memory_bytes": target.peak_memory_bytes(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print(
+        f"{'scenario':<20} {'req/s':>7} {'tok/s':>8} {'ttft p50':>9} {'ttft p90':>9} "
+        f"{'itl p50':>8} {'prefill':>8} {'mem MB':>8} {'errors':>7}"
+    )
+    for scenario, result in results.items():
+        def ms(value):
+            return f"{value * 1000:.0f}ms" if value is not None else "-"
+
+        memory = result["peak_memory_bytes"]
+        print(
+            f"{scenario:<20} {result['requests_per_second']:7.2f} "
+            f"{result['completion_tokens_per_second']:8.1f} "
+            f"{ms(result['ttft_seconds']['p50']):>9} {ms(result['ttft_seconds']['p90']):>9} "
+            f"{ms(result['inter_token_seconds']['p50']):>8} "
+            f"{result['prefill_share'] or 0:8.0%} "
+            f"{memory / 2**20 if memory else 0:8.0f} {result['errors']:7d}"
+        )
+        old = (baseline or {}).get(scenario)
+        if old:
+            for key in ("requests_per_second", "completion_tokens_per_second"):
+                if old[key]:
+                    print(f"  {key}: {result[key] / old[key] - 1:+.1%} vs baseline")
+            for key in ("ttft_seconds", "inter_token_seconds"):
+                if old[key]["p50"] and result[key]["p50"]:
+                    print(f"  {key} p50: {result[key]['p50'] / old[key]['p50'] - 1:+.1%} vs baseline")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument("--server", type=str)
+    target_group.add_argument("--model", type=str)
+    target_group.add_argument("--stub", action="store_true")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--conversations", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--output", type=str)
+    parser.add_argument("--compare", type=str)
+    parser.add_argument("--n-parallel", type=int, default=1, help="In process only.")
+    parser.add_argument("--n-ctx", type=int, default=8192, help="In process only.")
+    parser.add_argument("--server-pid", type=int, help="To report the server's peak memory.")
+    parser.add_argument("--stub-prefill-rate", type=float, default=2000, help="Tokens per second.")
+    parser.add_argument("--stub-decode-rate", type=float, default=50, help="Tokens per second.")
+    args = parser.parse_args()
+
+    if args.server is not None:
+        target = ServerTarget(args.server, pid=args.server_pid)
+    elif args.stub:
+        from empower_functions import EmpowerFunctionsCompletionHandler
+        from stub_llama import StubLlama, tool_call_response
+
+        target = InProcessTarget(StubLlama(
+            [tool_call_response([("get_current_weather", {"location": "Paris"})])],
+            chat_handler=EmpowerFunctionsCompletionHandler(),
+            n_ctx=args.n_ctx,
+            prefill_tokens_per_second=args.stub_prefill_rate,
+            decode_tokens_per_second=args.stub_decode_rate,
+        ))
+    else:
+        import llama_cpp
+
+        from empower_functions import EmpowerFunctionsCompletionHandler
+
+        target = InProcessTarget(llama_cpp.Llama(
+            model_path=args.model,
+            n_ctx=args.n_ctx,
+            chat_handler=EmpowerFunctionsCompletionHandler(n_parallel=args.n_parallel),
+            verbose=False,
+        ))
+
+    results = {
+        scenario: run_scenario(
+            target, scenario, args.conversations, args.concurrency, args.max_tokens
+        )
+        for scenario in args.scenarios
+    }
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    "config": {
+                        key: value for key, value in vars(args).items()
+                        if key not in ("output", "compare")
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Throughput and latency of concurrent chat completions, served one at a
+time (the server's global lock) versus decoded together by the
+BatchScheduler.
+
+Every client sends the same tool-calling request in a loop; each level of
+concurrency runs for `--requests` completions.
+
+Usage: python benchmarks/continuous_batching.py MODEL.gguf
+           [--clients 1 4 16 64] [--n-parallel 16] [--requests 64]
+           [--max-tokens 64] [--n-ctx 4096]
+"""
+import argparse
+import contextlib
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import llama_cpp
+
+from empower_functions import EmpowerFunctionsCompletionHandler
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_weather",
+            "description": "Get the current weather in a given location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {
+                        "type": "string",
+                        "description": "The city and state, e.g. San Francisco, CA",
+                    },
+                    "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+                },
+                "required": ["location"],
+            },
+        },
+    }
+]
+
+
+def run(llama, clients, requests, max_tokens, lock=None):
+    latencies = []
+    tokens = []
+
+    def request(i):
+        start = time.perf_counter()
+        with lock or contextlib.nullcontext():
+            response = llama.create_chat_completion(
+                messages=[{"role": "user", "content": f"What's the weather in San Francisco? ({i})"}],
+                tools=TOOLS,
+                max_tokens=max_tokens,
+            )
+        latencies.append(time.perf_counter() - start)
+        tokens.append(response["usage"]["completion_tokens"])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(request, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests/s": requests / elapsed,
+        "tokens/s": sum(tokens) / elapsed,
+        "p50 s": statistics.median(latencies),
+        "p99 s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--n-parallel", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    args = parser.parse_args()
+
+    serial = llama_cpp.Llama(
+        model_path=args.model,
+        n_ctx=args.n_ctx,
+        chat_handler=EmpowerFunctionsCompletionHandler(),
+        verbose=False,
+    )
+    batched = llama_cpp.Llama(
+        model_path=args.model,
+        n_ctx=args.n_ctx,
+        chat_handler=EmpowerFunctionsCompletionHandler(
+            n_parallel=args.n_parallel,
+            n_parallel_ctx=args.n_ctx * args.n_parallel,
+        ),
+        verbose=False,
+    )
+
+    print(f"{'clients':>7} {'mode':<8} {'req/s':>8} {'tok/s':>8} {'p50 s':>8} {'p99 s':>8}")
+    for clients in args.clients:
+        results = {
+            "serial": run(serial, clients, args.requests, args.max_tokens,
+                          lock=threading.Lock()),
+            "batched": run(batched, clients, args.requests, args.max_tokens),
+        }
+        for mode, r in results.items():
+            print(
+                f"{clients:>7} {mode:<8} {r['requests/s']:8.2f} {r['tokens/s']:8.1f} "
+                f"{r['p50 s']:8.2f} {r['p99 s']:8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
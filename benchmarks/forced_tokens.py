@@ -0,0 +1,67 @@
+"""Generation speed of grammar-constrained tool calls with and without the
+forced-token fast path (forced_tokens), which appends the text the grammar
+leaves as the only option instead of decoding it one token at a time.
+
+Uses the requests of speculative_tool_calls.py.
+
+Usage: python benchmarks/forced_tokens.py MODEL.gguf [--requests 32] [--max-tokens 128]
+"""
+import argparse
+import time
+
+import llama_cpp
+
+from empower_functions import EmpowerFunctionsCompletionHandler
+from empower_functions.monkey_patch.app import _create_chat_completion_patched
+from speculative_tool_calls import TOOLS, messages
+
+
+def run(llama, requests, max_tokens):
+    tokens = 0
+    saved = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        response = _create_chat_completion_patched(
+            llama,
+            messages=messages(i),
+            tools=TOOLS,
+            max_tokens=max_tokens,
+            temperature=0,
+        )
+        tokens += response["usage"]["completion_tokens"]
+        saved += response["usage"].get("decode_steps_saved", 0)
+    return tokens / (time.perf_counter() - start), tokens, saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    args = parser.parse_args()
+
+    print(f"{'forced tokens':<14} {'tok/s':>8} {'speedup':>8} {'steps saved':>12}")
+    baseline = None
+    for forced_tokens in (False, True):
+        llama = llama_cpp.Llama(
+            model_path=args.model,
+            n_ctx=args.n_ctx,
+            # Forced tokens are verified with the logits of every position.
+            logits_all=forced_tokens,
+            chat_handler=EmpowerFunctionsCompletionHandler(
+                tool_call_grammar=True, forced_tokens=forced_tokens
+            ),
+            verbose=False,
+        )
+        tokens_per_second, tokens, saved = run(llama, args.requests, args.max_tokens)
+        baseline = baseline or tokens_per_second
+        print(
+            f"{str(forced_tokens).lower():<14} {tokens_per_second:8.1f} "
+            f"{tokens_per_second / baseline:7.2f}x {saved / tokens:12.0%}"
+        )
+        del llama
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""CPU time per request spent on JSON with each backend of
+empower_functions.json_backend (see the json_backend server setting).
+
+Checks first that every prompt of the scenarios.py conversations and of
+the prompt_building.py conversations is the same text with each backend,
+then times, per backend:
+
+  first   prompt_messages on the first request of a conversation, when no
+          function definitions or tool results have been serialized yet
+  later   prompt_messages on a later turn of the conversation
+  parse   converting a `<f>` response with --calls tool calls
+  stream  encoding the chunks of a streamed response, as the server does
+
+Usage: python benchmarks/json_backends.py [--turns 10 50 100]
+           [--result-size 20] [--calls 5] [--number 200]
+"""
+import argparse
+import timeit
+
+from empower_functions import json_backend
+from empower_functions.chat_handler import _convert_completion_to_chat_function
+from empower_functions.prompt import _tool_result, functions_cache_clear, prompt_messages
+from prompt_building import FUNCTIONS, build_messages
+from response_conversion import build_completion
+from scenarios import SCENARIOS, requests
+
+BACKENDS = [name for name in ("json", "orjson") if name != "orjson" or json_backend.orjson]
+
+
+def first_request(messages, functions):
+    functions_cache_clear()
+    _tool_result.cache_clear()
+    return prompt_messages(messages, functions)
+
+
+def stream_chunks(text, chars_per_token=4):
+    """The chat completion chunks of `text` streamed as content."""
+    return [
+        {
+            "id": "chatcmpl-3f6d8c0e-5b1a-4b7e-9d2c-8a4f1e0b7c6d",
+            "object": "chat.completion.chunk",
+            "created": 1718000000,
+            "model": "empower-functions",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": text[i:i + chars_per_token]},
+                    "logprobs": None,
+                    "finish_reason": None,
+                }
+            ],
+        }
+        for i in range(0, len(text), chars_per_token)
+    ]
+
+
+def encode_stream(chunks):
+    for chunk in chunks:
+        json_backend.dumps_response(chunk)
+
+
+def prompts(conversations):
+    return [first_request(messages, functions) for functions, messages in conversations]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--result-size", type=int, default=20)
+    parser.add_argument("--calls", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    conversations = [
+        ([tool["function"] for tool in tools], messages)
+        for scenario in SCENARIOS
+        for i in range(3)
+        for tools, messages in requests(scenario, i)
+    ] + [(FUNCTIONS, build_messages(turns, args.result_size)) for turns in args.turns]
+    expected = None
+    for name in BACKENDS:
+        json_backend.use(name)
+        built = prompts(conversations)
+        assert expected is None or built == expected, f"{name} prompts differ"
+        expected = built
+    print(f"{len(conversations)} conversations, same prompts with {', '.join(BACKENDS)}")
+
+    completion = build_completion(args.calls, 4, False)
+    chunks = stream_chunks(completion["choices"][0]["text"])
+    workloads = {
+        f"{phase} {turns}": fn
+        for turns in args.turns
+        for phase, fn in (
+            ("first", lambda m=build_messages(turns, args.result_size): first_request(m, FUNCTIONS)),
+            ("later", lambda m=build_messages(turns, args.result_size): prompt_messages(m, FUNCTIONS)),
+        )
+    }
+    workloads[f"parse {args.calls}"] = lambda: _convert_completion_to_chat_function(completion)
+    workloads[f"stream {len(chunks)}"] = lambda: encode_stream(chunks)
+
+    timings = {}
+    for name in BACKENDS:
+        json_backend.use(name)
+        for workload, fn in workloads.items():
+            fn()
+            timings[name, workload] = min(
+                timeit.repeat(fn, number=args.number, repeat=3)) / args.number
+
+    print(f"{'workload':<12} " + " ".join(f"{name:>12}" for name in BACKENDS)
+          + (f" {'saved':>10} {'speedup':>8}" if len(BACKENDS) > 1 else ""))
+    for workload in workloads:
+        line = f"{workload:<12} " + " ".join(
+            f"{timings[name, workload] * 1e6:9.0f} us" for name in BACKENDS)
+        if len(BACKENDS) > 1:
+            before, after = timings[BACKENDS[0], workload], timings[BACKENDS[-1], workload]
+            line += f" {(before - after) * 1e6:7.0f} us {before / after:7.2f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""Python overhead of a chat completion, measured with StubLlama (see
+stub_llama.py) instead of a model, so it runs anywhere in seconds.
+
+Each path sends the parallel-calling conversation of scenarios.py
+through _create_chat_completion_patched, as the server does, with a
+scripted response:
+
+  content           <c> message
+  tool_calls        <f> with --calls tool calls
+  thinking          <thinking> then <f> with --calls tool calls
+  stream_content    streamed <c> message, every chunk SSE encoded
+  stream_tool_calls streamed <f>, every chunk SSE encoded
+
+For each path it reports the time per request, the part of it spent in
+each handler phase (from empower_functions.metrics) and, with
+tracemalloc, the peak memory allocated during a request and the memory
+still held after --number requests.
+
+Profiling: --profile out.prof writes cProfile stats of the selected
+paths and prints the functions with the most own time; --loop SECONDS
+repeats the selected paths for that long, e.g. to sample them with
+`py-spy record -o profile.svg -- python benchmarks/profile_overhead.py
+--paths tool_calls --loop 30`.
+
+Regressions: --output stores the results as JSON, --baseline compares
+with such a file and exits with status 1 when a path got slower by more
+than --tolerance.
+
+Usage: python benchmarks/profile_overhead.py [--paths content tool_calls ...]
+           [--number 500] [--calls 5] [--fast-template] [--tool-call-grammar]
+           [--session-cache-size 8] [--fit-context] [--json-backend json]
+           [--profile out.prof] [--loop 30]
+           [--output results.json] [--baseline results.json] [--tolerance 0.25]
+"""
+import argparse
+import cProfile
+import json
+import pstats
+import statistics
+import sys
+import time
+import tracemalloc
+
+from sse_starlette.sse import ServerSentEvent
+
+from agent_workloads import parse_metrics
+from empower_functions import EmpowerFunctionsCompletionHandler, json_backend
+from empower_functions.metrics import REGISTRY
+from empower_functions.monkey_patch.app import _create_chat_completion_patched
+from scenarios import parallel_calling
+from stub_llama import (
+    StubLlama,
+    content_response,
+    thinking_response,
+    tool_call_response,
+)
+
+PATHS = ("content", "tool_calls", "thinking", "stream_content", "stream_tool_calls")
+PHASES = ("fit_context", "prompt", "render", "tokenize", "convert")
+
+
+def responses(path, calls):
+    cities = ["San Francisco", "Paris", "Beijing", "Tokyo", "Berlin", "Chicago"]
+    tool_calls = tool_call_response(
+        [("get_current_weather", {"location": cities[i % len(cities)], "unit": "celsius"})
+         for i in range(calls)]
+    )
+    if path in ("content", "stream_content"):
+        return [content_response()]
+    if path == "thinking":
+        return [thinking_response(tool_calls)]
+    return [tool_calls]
+
+
+def request(llama, tools, messages, stream):
+    """One chat completion, with the chunks of a stream encoded as the
+    server sends them."""
+    response = _create_chat_completion_patched(
+        llama, messages=messages, tools=tools, stream=stream
+    )
+    if stream:
+        for chunk in response:
+            ServerSentEvent(data=json_backend.dumps_response(chunk), sep="\n").encode()
+        ServerSentEvent(data="[DONE]", sep="\n").encode()
+
+
+def _phase_sums():
+    samples = parse_metrics(REGISTRY.render())
+    return {
+        phase: samples.get(f'empower_phase_seconds_sum{{phase="{phase}"}}', 0.0)
+        for phase in PHASES
+    }
+
+
+def measure(llama, tools, messages, stream, number):
+    # The first request fills the caches of a conversation, as in a server
+    # that has seen the tool set before.
+    request(llama, tools, messages, stream)
+
+    before = _phase_sums()
+    seconds = []
+    for _ in range(number):
+        start = time.perf_counter()
+        request(llama, tools, messages, stream)
+        seconds.append(time.perf_counter() - start)
+    after = _phase_sums()
+
+    tracemalloc.start()
+    peaks = []
+    held = tracemalloc.get_traced_memory()[0]
+    for _ in range(number):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        request(llama, tools, messages, stream)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    held = tracemalloc.get_traced_memory()[0] - held
+    tracemalloc.stop()
+
+    return {
+        "mean_us": statistics.mean(seconds) * 1e6,
+        "p50_us": statistics.median(seconds) * 1e6,
+        "phases_us": {
+            phase: (after[phase] - before[phase]) / number * 1e6 for phase in PHASES
+        },
+        "peak_kib": statistics.median(peaks) / 1024,
+        "held_kib": held / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS))
+    parser.add_argument("--number", type=int, default=500)
+    parser.add_argument("--calls", type=int, default=5, help="Tool calls per <f> response.")
+    parser.add_argument("--fast-template", action="store_true")
+    parser.add_argument("--tool-call-grammar", action="store_true")
+    parser.add_argument("--session-cache-size", type=int, default=0)
+    parser.add_argument("--fit-context", action="store_true")
+    parser.add_argument("--json-backend", choices=json_backend.JSON_BACKENDS, default="auto")
+    parser.add_argument("--profile", type=str, help="Write cProfile stats to this file.")
+    parser.add_argument("--loop", type=float, help="Repeat the paths for this many seconds.")
+    parser.add_argument("--output", type=str)
+    parser.add_argument("--baseline", type=str)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    json_backend.use(args.json_backend)
+
+    tools, messages = parallel_calling(0)
+
+    def stub(path):
+        return StubLlama(
+            responses(path, args.calls),
+            chat_handler=EmpowerFunctionsCompletionHandler(
+                fast_template=args.fast_template,
+                tool_call_grammar=args.tool_call_grammar,
+                session_cache_size=args.session_cache_size,
+                fit_context=args.fit_context,
+            ),
+        )
+
+    if args.loop is not None or args.profile is not None:
+        llamas = {path: stub(path) for path in args.paths}
+        profiler = cProfile.Profile() if args.profile is not None else None
+        end = time.perf_counter() + (args.loop or 0)
+        if profiler is not None:
+            profiler.enable()
+        requests = 0
+        while True:
+            for path, llama in llamas.items():
+                for _ in range(args.number if args.loop is None else 1):
+                    request(llama, tools, messages, path.startswith("stream"))
+                    requests += 1
+            if time.perf_counter() >= end:
+                break
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"{requests} requests, stats written to {args.profile}")
+            pstats.Stats(profiler).sort_stats("tottime").print_stats(20)
+        return
+
+    results = {
+        path: measure(stub(path), tools, messages, path.startswith("stream"), args.number)
+        for path in args.paths
+    }
+    print(
+        f"{'path':<18} {'mean us':>8} {'p50 us':>8} "
+        + " ".join(f"{phase:>11}" for phase in PHASES)
+        + f" {'peak KiB':>9} {'held KiB':>9}"
+    )
+    for path, result in results.items():
+        print(
+            f"{path:<18} {result['mean_us']:8.0f} {result['p50_us']:8.0f} "
+            + " ".join(f"{result['phases_us'][phase]:11.0f}" for phase in PHASES)
+            + f" {result['peak_kib']:9.1f} {result['held_kib']:9.1f}"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressed = []
+        for path, result in results.items():
+            if path not in baseline:
+                continue
+            change = result["p50_us"] / baseline[path]["p50_us"] - 1
+            print(f"{path}: {change:+.1%} vs baseline")
+            if change > args.tolerance:
+                regressed.append(path)
+        if regressed:
+            print(f"Slower than the baseline by more than {args.tolerance:.0%}: "
+                  + ", ".join(regressed), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Cost of building the prompt for long tool-calling conversations.
+
+Compares the previous two-pass build (merge the messages, parsing every
+tool result, then serialize the merged results again) with the current
+single pass, on the first request of a conversation and on a later turn,
+when the tool results of the history have been rendered before.
+
+Usage: python benchmarks/prompt_building.py [--turns 10 50 100 200]
+           [--result-size 20] [--number 200]
+"""
+import argparse
+import json
+import timeit
+
+from empower_functions.prompt import (
+    _first_user_prefix,
+    _system_instruction,
+    _tool_result,
+    functions_block,
+    prompt_messages,
+)
+
+FUNCTIONS = [
+    {
+        "name": "search_flights",
+        "description": "Search flights between two airports",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "origin": {"type": "string", "description": "IATA code"},
+                "destination": {"type": "string", "description": "IATA code"},
+            },
+            "required": ["origin", "destination"],
+        },
+    }
+]
+
+
+def build_messages(turns, result_size):
+    """A user request, then `turns` rounds of two parallel tool calls, their
+    results and an assistant answer followed by a user question."""
+    messages = [{"role": "user", "content": "Find me a flight from SFO to JFK."}]
+    for i in range(turns):
+        messages.append({
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": f"call_{i}_{j}",
+                    "type": "function",
+                    "function": {
+                        "name": "search_flights",
+                        "arguments": json.dumps({"origin": "SFO", "destination": "JFK"}),
+                    },
+                }
+                for j in range(2)
+            ],
+        })
+        for j in range(2):
+            messages.append({
+                "role": "tool",
+                "tool_call_id": f"call_{i}_{j}",
+                "content": json.dumps({
+                    "flights": [
+                        {"id": f"UA{k}", "price": 100 + k, "stops": k % 2, "note": "Économie"}
+                        for k in range(result_size)
+                    ]
+                }),
+            })
+        messages.append({"role": "assistant", "content": f"Found flights, round {i}."})
+        messages.append({"role": "user", "content": f"Any cheaper? ({i})"})
+    return messages
+
+
+def two_pass_prompt_messages(messages, functions_def):
+    """The previous build, without its validation."""
+    merged = [messages[0]]
+    previous_role = messages[0]["role"]
+    for message in messages[1:]:
+        if message["role"] == "tool":
+            result = {"value": json.loads(message["content"]),
+                      "tool_call_id": message["tool_call_id"]}
+            if previous_role == "tool":
+                merged[-1]["content"].append(result)
+            else:
+                merged.append({"role": "tool", "content": [result]})
+        elif message["role"] == "user" and previous_role == "user":
+            merged[-1]["content"] += "\n\n" + message["content"]
+        else:
+            merged.append(message)
+        previous_role = message["role"]
+
+    prefix = _first_user_prefix(_system_instruction(messages, False),
+                                functions_block(functions_def))
+    prompted = [{"role": "user", "content": prefix + merged[0]["content"]}]
+    for message in merged[1:]:
+        if message["role"] == "tool":
+            prompted.append({"role": "user", "content": "<r>" + json.dumps(
+                message["content"], indent=2, ensure_ascii=True)})
+        elif message["role"] == "user":
+            prompted.append({"role": "user", "content": "<u>" + message["content"]})
+        elif message.get("content"):
+            prompted.append({"role": "assistant", "content": "<c>" + message["content"]})
+        else:
+            functions = [tool_call["function"] for tool_call in message["tool_calls"]]
+            prompted.append({"role": "assistant", "content": "<f>" + json.dumps(
+                functions, indent=2, ensure_ascii=False)})
+    return prompted
+
+
+def first_request(messages):
+    _tool_result.cache_clear()
+    return prompt_messages(messages, FUNCTIONS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--result-size", type=int, default=20)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'turns':>6} {'messages':>8} {'two-pass':>12} {'first':>12} {'later':>12} {'speedup':>8}")
+    for turns in args.turns:
+        messages = build_messages(turns, args.result_size)
+        assert prompt_messages(messages, FUNCTIONS) == two_pass_prompt_messages(
+            messages, FUNCTIONS)
+
+        timings = {}
+        for name, fn in {
+            "two-pass": lambda: two_pass_prompt_messages(messages, FUNCTIONS),
+            "first": lambda: first_request(messages),
+            "later": lambda: prompt_messages(messages, FUNCTIONS),
+        }.items():
+            fn()
+            timings[name] = min(timeit.repeat(fn, number=args.number, repeat=3)) / args.number
+        print(
+            f"{turns:>6} {len(messages):>8} "
+            f"{timings['two-pass'] * 1e3:9.3f} ms {timings['first'] * 1e3:9.3f} ms "
+            f"{timings['later'] * 1e3:9.3f} ms {timings['two-pass'] / timings['later']:7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
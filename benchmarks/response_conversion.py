@@ -0,0 +1,137 @@
+"""Time and memory of converting a `<f>` response into tool calls.
+
+Compares the previous conversion (split off the thinking block, parse
+the array twice, serialize every argument again, concatenate the call
+ids) with the current single scan, which returns the arguments as they
+were generated. Peak is the most memory allocated at once during a
+conversion, measured with tracemalloc.
+
+Usage: python benchmarks/response_conversion.py [--calls 1 5 20 50]
+           [--argument-size 4] [--thinking] [--number 2000]
+"""
+import argparse
+import json
+import timeit
+import tracemalloc
+
+from empower_functions.chat_handler import (
+    _convert_completion_to_chat_function,
+    _maybe_json_dumps,
+    _separate_thinking_if_present,
+    _thinking_end,
+)
+
+
+def build_completion(calls, argument_size, thinking):
+    arguments = {
+        "location": "San Francisco, CA",
+        "unit": "celsius",
+        "filters": {f"field_{k}": [k, k + 1, "Économie"] for k in range(argument_size)},
+    }
+    text = "<f>" + json.dumps(
+        [{"name": "get_current_weather", "arguments": arguments} for _ in range(calls)]
+    )
+    if thinking:
+        text = "<thinking>The user asks for the weather in several cities.</thinking>" + text
+    return {
+        "id": "cmpl-3f6d8c0e-5b1a-4b7e-9d2c-8a4f1e0b7c6d",
+        "object": "text_completion",
+        "created": 1718000000,
+        "model": "empower-functions",
+        "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1000, "completion_tokens": 100, "total_tokens": 1100},
+    }
+
+
+def previous_conversion(completion):
+    content, thinking = _separate_thinking_if_present(completion["choices"][0]["text"])
+    completion = {**completion, "choices": [{**completion["choices"][0], "text": content}]}
+    json_object = json.loads(completion["choices"][0]["text"][3:])
+    tool_calls = [
+        {
+            "id": "call_" + "_0_" + tool["name"] + "_" + completion["id"] + "_" + str(i),
+            "type": "function",
+            "function": {
+                "name": tool["name"],
+                "arguments": _maybe_json_dumps(tool["arguments"]),
+            },
+        }
+        for (i, tool) in enumerate(json_object)
+    ]
+    json_object = json.loads(completion["choices"][0]["text"][3:])
+    return {
+        "id": "chat" + completion["id"],
+        "object": "chat.completion",
+        "created": completion["created"],
+        "model": completion["model"],
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": thinking, "tool_calls": tool_calls},
+                "logprobs": completion["choices"][0]["logprobs"],
+                "finish_reason": "tool_calls",
+            }
+        ],
+        "usage": completion["usage"],
+    }
+
+
+def current_conversion(completion):
+    # As in EmpowerFunctionsCompletionHandler.__call__.
+    text = completion["choices"][0]["text"]
+    start = _thinking_end(text)
+    return _convert_completion_to_chat_function(
+        completion, thinking=text[:start] if start else None, start=start
+    )
+
+
+def peak_bytes(fn):
+    tracemalloc.start()
+    current = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, nargs="+", default=[1, 5, 20, 50])
+    parser.add_argument("--argument-size", type=int, default=4)
+    parser.add_argument("--thinking", action="store_true")
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(
+        f"{'calls':>6} {'previous':>12} {'current':>12} {'speedup':>8} "
+        f"{'previous peak':>14} {'current peak':>13}"
+    )
+    for calls in args.calls:
+        completion = build_completion(calls, args.argument_size, args.thinking)
+        previous, current = previous_conversion(completion), current_conversion(completion)
+        # The same calls, with the arguments as generated instead of
+        # serialized again.
+        assert [
+            (call["id"], call["function"]["name"], json.loads(call["function"]["arguments"]))
+            for call in previous["choices"][0]["message"]["tool_calls"]
+        ] == [
+            (call["id"], call["function"]["name"], json.loads(call["function"]["arguments"]))
+            for call in current["choices"][0]["message"]["tool_calls"]
+        ]
+
+        timings, peaks = {}, {}
+        for name, fn in {
+            "previous": lambda: previous_conversion(completion),
+            "current": lambda: current_conversion(completion),
+        }.items():
+            timings[name] = min(timeit.repeat(fn, number=args.number, repeat=5)) / args.number
+            peaks[name] = peak_bytes(fn)
+        print(
+            f"{calls:>6} {timings['previous'] * 1e6:9.1f} us {timings['current'] * 1e6:9.1f} us "
+            f"{timings['previous'] / timings['current']:7.2f}x "
+            f"{peaks['previous'] / 1024:10.1f} KiB {peaks['current'] / 1024:9.1f} KiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
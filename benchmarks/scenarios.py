@@ -0,0 +1,223 @@
+"""Synthetic agent conversations modelled on docs/inference: multi-turn
+(multi-turn.md), parallel calling (parallel-calling.md) and sequential
+calling (sequential-calling.md).
+
+Each conversation is scripted, assistant tool calls and tool results
+included, so the requests sent are the same whatever the model answers:
+request i of a conversation holds its first turns up to and including
+the i-th user or tool message.
+"""
+import json
+
+SUPPORT_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_ticket_status",
+            "description": "Returns mock ticket status based on the ticket ID.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "ticket_id": {
+                        "type": "string",
+                        "description": "The unique identifier for the ticket.",
+                    }
+                },
+                "required": ["ticket_id"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "verify_user",
+            "description": "Verifies the user based on the provided username and API key.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "username": {
+                        "type": "string",
+                        "description": "The username of the user to be verified.",
+                    },
+                    "api_key": {
+                        "type": "string",
+                        "description": "The API key provided by the user for verification.",
+                    },
+                },
+                "required": ["username", "api_key"],
+            },
+        },
+    },
+]
+
+WEATHER_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_weather",
+            "description": "Get the current weather in a given location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {
+                        "type": "string",
+                        "description": "The city and state, e.g. San Francisco, CA",
+                    },
+                    "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+                },
+                "required": ["location"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_capital",
+            "description": "Get the capital city of a given country",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "country": {"type": "string", "description": "Name of the country"}
+                },
+                "required": ["country"],
+            },
+        },
+    },
+]
+
+VEHICLE_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_vehicle_diagnostics",
+            "description": "Retrieves diagnostic data from the user's vehicle",
+            "parameters": {
+                "type": "object",
+                "properties": {"vin_number": {"type": "string"}},
+                "required": ["vin_number"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "analyze_diagnostics",
+            "description": "Analyzes vehicle diagnostic data to suggest maintenance",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "diagnostic_data": {
+                        "type": "object",
+                        "description": "The diagnostic data to analyze",
+                    }
+                },
+                "required": ["diagnostic_data"],
+            },
+        },
+    },
+]
+
+USERS = ["john_doe", "jane_roe", "alex_kim", "maria_garcia"]
+CITIES = ["San Francisco", "Paris", "Beijing", "Tokyo", "Berlin", "Chicago"]
+COUNTRIES = ["Germany", "India", "Japan", "France", "United Kingdom"]
+
+
+def _call(call_id, name, arguments):
+    return {
+        "id": call_id,
+        "type": "function",
+        "function": {"name": name, "arguments": json.dumps(arguments)},
+    }
+
+
+def _result(call_id, value):
+    return {"role": "tool", "tool_call_id": call_id, "content": json.dumps(value)}
+
+
+def multi_turn(i):
+    user, ticket = USERS[i % len(USERS)], str(10000 + i)
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a customer support agent you job is to help users check ticket status. "
+            "Make sure you verify the user before checking the ticket status. Start by greeting the user.",
+        },
+        {"role": "user", "content": f"Hi there, my username is {user}, can you help me check the status for my ticket?"},
+        {"role": "assistant", "content": "Sure, could you give me your API key so I can verify you first?"},
+        {"role": "user", "content": f"Of course, it is key-{i:06d}."},
+        {"role": "assistant", "content": None, "tool_calls": [_call(f"v{i}", "verify_user", {"username": user, "api_key": f"key-{i:06d}"})]},
+        _result(f"v{i}", {"success": True}),
+        {"role": "assistant", "content": "Thanks, you are verified. What is the ticket ID?"},
+        {"role": "user", "content": f"It's {ticket}."},
+        {"role": "assistant", "content": None, "tool_calls": [_call(f"t{i}", "get_ticket_status", {"ticket_id": ticket})]},
+        _result(f"t{i}", {"status": "Open", "issue": "Billing Query"}),
+    ]
+    return SUPPORT_TOOLS, messages
+
+
+def parallel_calling(i):
+    cities = [CITIES[(i + k) % len(CITIES)] for k in range(3)]
+    countries = [COUNTRIES[(i + k) % len(COUNTRIES)] for k in range(2)]
+    calls = [
+        _call(f"w{i}_{k}", "get_current_weather", {"location": city})
+        for k, city in enumerate(cities)
+    ] + [
+        _call(f"c{i}_{k}", "get_capital", {"country": country})
+        for k, country in enumerate(countries)
+    ]
+    messages = [
+        {
+            "role": "user",
+            "content": f"What's the current weather in {', '.join(cities[:-1])} and {cities[-1]}? "
+            f"Also can you help me check the capital of {countries[0]} and {countries[1]}?",
+        },
+        {"role": "assistant", "content": None, "tool_calls": calls},
+    ]
+    for call in calls:
+        arguments = json.loads(call["function"]["arguments"])
+        value = (
+            {"location": arguments["location"], "temperature": str(10 + i % 20), "unit": "fahrenheit"}
+            if call["function"]["name"] == "get_current_weather"
+            else {"country": arguments["country"], "capital": "Unknown"}
+        )
+        messages.append(_result(call["id"], value))
+    return WEATHER_TOOLS, messages
+
+
+def sequential_calling(i):
+    vin = f"1HGCM82633A{i:06d}"
+    diagnostics = {
+        "engine_temperature": 190 + i % 40,
+        "oil_pressure": 25 + i % 15,
+        "battery_voltage": 12.4,
+        "error_codes": ["P0300", "P0171"][: 1 + i % 2],
+        "readings": [{"sensor": f"o2_{k}", "value": 0.45 + k / 100} for k in range(8)],
+    }
+    messages = [
+        {"role": "user", "content": f"My car's check engine light is on, the VIN is {vin}. What maintenance does it need?"},
+        {"role": "assistant", "content": None, "tool_calls": [_call(f"d{i}", "get_vehicle_diagnostics", {"vin_number": vin})]},
+        _result(f"d{i}", diagnostics),
+        {"role": "assistant", "content": None, "tool_calls": [_call(f"a{i}", "analyze_diagnostics", {"diagnostic_data": diagnostics})]},
+        _result(f"a{i}", {"suggestions": ["Replace spark plugs", "Check the fuel system for leaks"]}),
+    ]
+    return VEHICLE_TOOLS, messages
+
+
+SCENARIOS = {
+    "multi_turn": multi_turn,
+    "parallel_calling": parallel_calling,
+    "sequential_calling": sequential_calling,
+}
+
+
+def requests(scenario, i):
+    """The (tools, messages) of each request of conversation `i` of
+    `scenario`, one per user or tool turn."""
+    tools, messages = SCENARIOS[scenario](i)
+    ends = [
+        end + 1
+        for end, message in enumerate(messages)
+        if message["role"] != "assistant"
+        and (end + 1 == len(messages) or messages[end + 1]["role"] == "assistant")
+    ]
+    return [(tools, messages[:end]) for end in ends]
@@ -0,0 +1,104 @@
+"""Per-turn cost of preparing the prompt tokens of a growing tool-calling
+conversation: prompting, rendering and tokenizing the whole history every
+turn versus only the messages appended since the previous turn
+(session_cache_size, looked up by session id or by history).
+
+Only the tokenizer is loaded, generation is not measured.
+
+Usage: python benchmarks/session_prompt.py MODEL.gguf [--turns 10 50 100 200]
+"""
+import argparse
+import json
+import time
+
+import llama_cpp
+
+from empower_functions import EmpowerFunctionsCompletionHandler
+from empower_functions.prompt import prompt_messages
+
+FUNCTIONS = [
+    {
+        "name": "search_flights",
+        "description": "Search flights between two airports",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "origin": {"type": "string", "description": "IATA code"},
+                "destination": {"type": "string", "description": "IATA code"},
+            },
+            "required": ["origin", "destination"],
+        },
+    }
+]
+
+
+def append_turn(messages, i):
+    messages.append({
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{
+            "id": f"call_{i}",
+            "type": "function",
+            "function": {
+                "name": "search_flights",
+                "arguments": json.dumps({"origin": "SFO", "destination": "JFK"}),
+            },
+        }],
+    })
+    messages.append({
+        "role": "tool",
+        "tool_call_id": f"call_{i}",
+        "content": json.dumps({"flights": [
+            {"id": f"UA{k}", "price": 100 + k, "stops": k % 2} for k in range(10)
+        ]}),
+    })
+    messages.append({"role": "assistant", "content": f"Found 10 flights, round {i}."})
+    messages.append({"role": "user", "content": f"Any cheaper ones? ({i})"})
+
+
+def prepare(handler, llama, messages, session_id):
+    if handler.session_cache is None:
+        return llama.tokenize(
+            handler._render(prompt_messages(messages, FUNCTIONS)).encode("utf-8"),
+            special=True,
+        )
+    return handler._session_prompt(llama, messages, FUNCTIONS, False, session_id)
+
+
+def run(llama, handler, turns, session_id=None):
+    """Milliseconds spent preparing each turn's prompt, and the last prompt."""
+    messages = [{"role": "user", "content": "Find me a flight from SFO to JFK."}]
+    timings = []
+    for i in range(turns):
+        start = time.perf_counter()
+        tokens = prepare(handler, llama, messages, session_id)
+        timings.append((time.perf_counter() - start) * 1e3)
+        append_turn(messages, i)
+    return timings, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 100, 200])
+    args = parser.parse_args()
+
+    llama = llama_cpp.Llama(model_path=args.model, vocab_only=True, verbose=False)
+
+    print(f"{'turns':>6} {'tokens':>7} {'full ms':>9} {'history ms':>11} {'session ms':>11} {'speedup':>8}")
+    for turns in args.turns:
+        full, expected = run(llama, EmpowerFunctionsCompletionHandler(fast_template=True), turns)
+        results = {}
+        for name, session_id in (("history", None), ("session", "conversation")):
+            handler = EmpowerFunctionsCompletionHandler(fast_template=True, session_cache_size=16)
+            results[name], tokens = run(llama, handler, turns, session_id)
+            assert tokens == expected
+        # Cost of the last turn, i.e. with the whole history behind it.
+        print(
+            f"{turns:>6} {len(expected):>7} {full[-1]:9.2f} {results['history'][-1]:11.2f} "
+            f"{results['session'][-1]:11.2f} {full[-1] / results['session'][-1]:7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
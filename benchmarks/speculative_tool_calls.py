@@ -0,0 +1,130 @@
+"""Generation speed of tool-calling responses without speculative decoding,
+with llama.cpp's prompt lookup decoding and with the ToolCallDraftModel
+(--draft_model tool-call).
+
+Each request asks for a call whose arguments appear in the user message.
+With --grammar, responses are constrained to valid tool calls
+(tool_call_grammar), which makes the comparison meaningful with models
+that do not call tools on their own.
+
+Usage: python benchmarks/speculative_tool_calls.py MODEL.gguf
+           [--requests 32] [--max-tokens 128] [--num-pred-tokens 10] [--grammar]
+"""
+import argparse
+import time
+
+import llama_cpp
+from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+from empower_functions import EmpowerFunctionsCompletionHandler
+from empower_functions.monkey_patch.app import _create_chat_completion_patched
+from empower_functions.speculative import ToolCallDraftModel
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "book_flight",
+            "description": "Book a flight for a passenger",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "passenger_name": {"type": "string"},
+                    "origin": {"type": "string", "description": "Departure city"},
+                    "destination": {"type": "string", "description": "Arrival city"},
+                    "date": {"type": "string", "description": "YYYY-MM-DD"},
+                },
+                "required": ["passenger_name", "origin", "destination", "date"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_weather",
+            "description": "Get the current weather in a given location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {"type": "string", "description": "The city and state"},
+                    "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+                },
+                "required": ["location"],
+            },
+        },
+    },
+]
+
+CITIES = ["San Francisco", "New York", "Los Angeles", "Seattle", "Chicago", "Boston"]
+NAMES = ["Ada Lovelace", "Alan Turing", "Grace Hopper", "Edsger Dijkstra"]
+
+
+def messages(i):
+    name, origin, destination = NAMES[i % 4], CITIES[i % 6], CITIES[(i + 1) % 6]
+    return [{
+        "role": "user",
+        "content": (
+            f"Book a flight for {name} from {origin} to {destination} on 2024-06-{i % 28 + 1:02d}, "
+            f"and tell me the weather in {destination} in celsius."
+        ),
+    }]
+
+
+def run(llama, requests, max_tokens):
+    tokens = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        response = _create_chat_completion_patched(
+            llama,
+            messages=messages(i),
+            tools=TOOLS,
+            max_tokens=max_tokens,
+            temperature=0,
+        )
+        tokens += response["usage"]["completion_tokens"]
+    return tokens / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--num-pred-tokens", type=int, default=10)
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    parser.add_argument("--grammar", action="store_true")
+    args = parser.parse_args()
+
+    draft_models = {
+        "none": None,
+        "prompt-lookup-decoding": LlamaPromptLookupDecoding(
+            num_pred_tokens=args.num_pred_tokens
+        ),
+        "tool-call": ToolCallDraftModel(num_pred_tokens=args.num_pred_tokens),
+    }
+
+    print(f"{'draft model':<24} {'tok/s':>8} {'speedup':>8} {'accepted':>9}")
+    baseline = None
+    for name, draft_model in draft_models.items():
+        llama = llama_cpp.Llama(
+            model_path=args.model,
+            n_ctx=args.n_ctx,
+            draft_model=draft_model,
+            chat_handler=EmpowerFunctionsCompletionHandler(tool_call_grammar=args.grammar),
+            verbose=False,
+        )
+        tokens_per_second = run(llama, args.requests, args.max_tokens)
+        baseline = baseline or tokens_per_second
+        accepted = (
+            f"{draft_model.info().acceptance_rate:9.0%}"
+            if isinstance(draft_model, ToolCallDraftModel)
+            else f"{'':>9}"
+        )
+        print(
+            f"{name:<24} {tokens_per_second:8.1f} {tokens_per_second / baseline:7.2f}x {accepted}"
+        )
+        del llama
+
+
+if __name__ == "__main__":
+    main()
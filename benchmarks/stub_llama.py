@@ -0,0 +1,204 @@
+"""Stand-in for llama_cpp.Llama that generates scripted responses, to
+measure the Python code around inference without loading a model.
+
+StubLlama answers create_completion (what EmpowerFunctionsCompletionHandler
+calls) with the next of its scripted responses, as a completion or as a
+stream of chunks, at configurable prefill and decode token rates: by
+default it does not wait at all, so the time spent in a request is the
+Python overhead of the handler, the response conversion and the caller.
+
+Its tokenizer maps every byte to a token, which is enough for prompt
+caching, context fitting and the generation prompt check to behave as
+with a model. The default handler path and the session cache are
+supported; paths that evaluate the model directly (prefix cache, session
+store, batch scheduler, forced tokens) are not.
+"""
+import itertools
+import json
+import time
+import uuid
+
+import numpy as np
+
+BOS = 256
+EOS = 257
+
+
+def content_response(text="The weather in San Francisco is sunny, 72 degrees."):
+    return "<c>" + text
+
+
+def tool_call_response(calls):
+    """`<f>` response calling each `(name, arguments)` of `calls`."""
+    return "<f>" + json.dumps(
+        [{"name": name, "arguments": arguments} for name, arguments in calls]
+    )
+
+
+def thinking_response(response, thinking="The user asks for the weather, I need a tool."):
+    return f"<thinking>{thinking}</thinking>{response}"
+
+
+class StubLlama:
+    def __init__(
+        self,
+        responses,
+        chat_handler=None,
+        n_ctx=8192,
+        chars_per_token=4,
+        prefill_tokens_per_second=None,
+        decode_tokens_per_second=None,
+        model_path="stub.gguf",
+    ):
+        """
+        Args:
+            responses: Texts generated in turn, cycling, e.g. built with
+                content_response, tool_call_response and
+                thinking_response; or a callable returning the text for
+                the prompt tokens.
+            chars_per_token: Characters of a response per generated token,
+                streamed as one chunk.
+            prefill_tokens_per_second: Rate at which prompt tokens not in
+                the KV cache are evaluated, None for no wait.
+            decode_tokens_per_second: Rate at which tokens are generated,
+                None for no wait.
+        """
+        self._responses = responses if callable(responses) else itertools.cycle(responses)
+        self.chat_handler = chat_handler
+        self.chat_format = None
+        self._chat_handlers = {}
+        self._n_ctx = n_ctx
+        self.chars_per_token = chars_per_token
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.decode_tokens_per_second = decode_tokens_per_second
+        self.model_path = model_path
+        self.verbose = False
+        self.draft_model = None
+        # The tokens in the KV cache.
+        self.input_ids = np.zeros(0, dtype=np.intc)
+        self.n_tokens = 0
+        self._scores = np.zeros(self.n_vocab(), dtype=np.single)
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return EOS + 1
+
+    def token_eos(self):
+        return EOS
+
+    def token_bos(self):
+        return BOS
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return ([BOS] if add_bos else []) + list(text)
+
+    def detokenize(self, tokens, prev_tokens=None, special=False):
+        return bytes(token for token in tokens if token < BOS)
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def _response(self, prompt):
+        return self._responses(prompt) if callable(self._responses) else next(self._responses)
+
+    def _prefill(self, prompt):
+        if not self.prefill_tokens_per_second:
+            return
+        n = min(self.n_tokens, len(prompt) - 1)
+        mismatch = np.nonzero(self.input_ids[:n] != np.asarray(prompt[:n]))[0]
+        cached = int(mismatch[0]) if len(mismatch) else max(n, 0)
+        time.sleep((len(prompt) - cached) / self.prefill_tokens_per_second)
+
+    def _set_input_ids(self, tokens):
+        # Only the first token can be BOS, the others are bytes: building
+        # the array from bytes keeps the stub's own cost small.
+        head = 1 if tokens and tokens[0] == BOS else 0
+        self.input_ids = np.empty(len(tokens), dtype=np.intc)
+        self.input_ids[:head] = BOS
+        self.input_ids[head:] = np.frombuffer(bytes(tokens[head:]), dtype=np.uint8)
+        self.n_tokens = len(tokens)
+
+    def _pieces(self, text, max_tokens):
+        """The pieces of `text` generated, one per token, and the finish
+        reason."""
+        pieces = [
+            text[i:i + self.chars_per_token]
+            for i in range(0, len(text), self.chars_per_token)
+        ]
+        if max_tokens is not None and 0 < max_tokens < len(pieces):
+            return pieces[:max_tokens], "length"
+        return pieces, "stop"
+
+    def _generate(self, prompt, pieces, logits_processor):
+        self._prefill(prompt)
+        generated = []
+        for piece in pieces:
+            for processor in logits_processor or ():
+                processor(self.input_ids, self._scores)
+            if self.decode_tokens_per_second:
+                time.sleep(1 / self.decode_tokens_per_second)
+            generated.extend(piece.encode("utf-8"))
+            yield piece
+        self._set_input_ids(list(prompt) + generated)
+
+    def create_completion(
+        self,
+        prompt,
+        max_tokens=16,
+        stream=False,
+        logits_processor=None,
+        **kwargs,
+    ):
+        if isinstance(prompt, str):
+            prompt = self.tokenize(prompt.encode("utf-8"), special=True)
+        completion_id = f"cmpl-{uuid.uuid4()}"
+        created = int(time.time())
+        pieces, finish_reason = self._pieces(self._response(prompt), max_tokens)
+        if stream:
+            return self._stream(
+                completion_id, created, prompt, pieces, finish_reason, logits_processor
+            )
+
+        text = "".join(self._generate(prompt, pieces, logits_processor))
+        return {
+            "id": completion_id,
+            "object": "text_completion",
+            "created": created,
+            "model": self.model_path,
+            "choices": [
+                {
+                    "text": text,
+                    "index": 0,
+                    "logprobs": None,
+                    "finish_reason": finish_reason,
+                }
+            ],
+            "usage": {
+                "prompt_tokens": len(prompt),
+                "completion_tokens": len(pieces),
+                "total_tokens": len(prompt) + len(pieces),
+            },
+        }
+
+    def _stream(self, completion_id, created, prompt, pieces, finish_reason, logits_processor):
+        def chunk(text, finish_reason=None):
+            return {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": self.model_path,
+                "choices": [
+                    {
+                        "text": text,
+                        "index": 0,
+                        "logprobs": None,
+                        "finish_reason": finish_reason,
+                    }
+                ],
+            }
+
+        for piece in self._generate(prompt, pieces, logits_processor):
+            yield chunk(piece)
+        yield chunk("", finish_reason)
@@ -0,0 +1,74 @@
+"""Per-request cost of rendering the Llama-3 chat template.
+
+Compares the old behaviour (compile the Jinja template on every request),
+the compiled-once Jinja template and the precompiled fast renderer.
+
+Usage: python benchmarks/template_rendering.py [--turns 8] [--number 2000]
+"""
+import argparse
+import timeit
+
+from empower_functions.chat_handler import (
+    _compile_llama3_template,
+    _render_llama3_prompt,
+)
+from empower_functions.prompt import prompt_messages
+
+FUNCTIONS = [
+    {
+        "name": "get_current_weather",
+        "description": "Get the current weather in a given location",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "location": {
+                    "type": "string",
+                    "description": "The city and state, e.g. San Francisco, CA",
+                },
+                "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+            },
+            "required": ["location"],
+        },
+    }
+]
+
+
+def build_messages(turns):
+    messages = [{"role": "user", "content": "What's the weather in San Francisco?"}]
+    for i in range(turns):
+        messages.append({"role": "assistant", "content": f"It is sunny, turn {i}."})
+        messages.append({"role": "user", "content": f"And tomorrow? ({i})"})
+    return prompt_messages(messages, FUNCTIONS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    messages = build_messages(args.turns)
+    compiled = _compile_llama3_template()
+
+    expected = compiled.render(messages=messages, add_generation_prompt=True)
+    assert _render_llama3_prompt(messages) == expected
+
+    cases = {
+        "compile per request": lambda: _compile_llama3_template().render(
+            messages=messages, add_generation_prompt=True
+        ),
+        "compiled once": lambda: compiled.render(
+            messages=messages, add_generation_prompt=True
+        ),
+        "fast renderer": lambda: _render_llama3_prompt(messages),
+    }
+
+    baseline = None
+    for name, fn in cases.items():
+        per_call = min(timeit.repeat(fn, number=args.number, repeat=3)) / args.number
+        baseline = baseline or per_call
+        print(f"{name:<22} {per_call * 1e6:10.1f} us/request  {baseline / per_call:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
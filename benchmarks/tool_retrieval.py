@@ -0,0 +1,149 @@
+"""Prompt size, latency and recall of the tool retrieval stage
+(tool_retrieval_top_k) on a synthetic catalog of 200 functions.
+
+Each request asks, in words that differ from the function's description,
+for one action on one entity. Recall is the share of requests whose
+function is among the retrieved ones; prompt tokens and the time to the
+first token are compared with prompting the whole catalog.
+
+Usage: python benchmarks/tool_retrieval.py MODEL.gguf [--requests 64] [--top-k 4 8 16]
+           [--embedding-model EMBEDDING.gguf] [--n-ctx 32768]
+"""
+import argparse
+import time
+
+import llama_cpp
+
+from empower_functions import EmpowerFunctionsCompletionHandler
+from empower_functions.monkey_patch.app import _create_chat_completion_patched
+from empower_functions.prompt import prompt_messages
+from empower_functions.retrieval import ToolRetriever
+
+ENTITIES = [
+    "calendar event", "email", "invoice", "flight", "hotel reservation",
+    "support ticket", "customer", "order", "product", "shipment", "payment",
+    "subscription", "user account", "file", "meeting room", "expense report",
+    "job posting", "playlist", "recipe", "weather alert",
+]
+
+# Action, its description and how a user asks for it.
+ACTIONS = [
+    ("create", "Create a new {entity}", "Please add a new {entity} for next Tuesday"),
+    ("get", "Get the details of a {entity} by id", "Show me everything about {entity} 4521"),
+    ("update", "Update the fields of an existing {entity}", "Change the title of {entity} 77 to Draft"),
+    ("delete", "Delete a {entity} permanently", "Remove {entity} 310, I don't need it anymore"),
+    ("list", "List the {entity} records of the current user", "What {entity} records do I have?"),
+    ("search", "Search {entity} records matching a text query", "Find any {entity} mentioning Berlin"),
+    ("cancel", "Cancel a pending {entity}", "Call off the pending {entity} from yesterday"),
+    ("share", "Share a {entity} with another user", "Send {entity} 12 over to alice@example.com"),
+    ("export", "Export a {entity} as a CSV file", "Download {entity} 98 as a spreadsheet"),
+    ("archive", "Archive a {entity} so it is hidden from lists", "Put {entity} 5 away, hide it from lists"),
+]
+
+
+def catalog():
+    tools = []
+    for entity in ENTITIES:
+        for action, description, _ in ACTIONS:
+            tools.append({
+                "type": "function",
+                "function": {
+                    "name": f"{action}_{entity.replace(' ', '_')}",
+                    "description": description.format(entity=entity) + ".",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "string", "description": f"Id of the {entity}"},
+                            "fields": {"type": "object", "description": "Values to set"},
+                        },
+                        "required": [],
+                    },
+                },
+            })
+    return tools
+
+
+def request(i):
+    entity = ENTITIES[(i * 7) % len(ENTITIES)]
+    action, _, query = ACTIONS[i % len(ACTIONS)]
+    messages = [{"role": "user", "content": query.format(entity=entity)}]
+    return messages, f"{action}_{entity.replace(' ', '_')}"
+
+
+def prompt_tokens(llama, messages, functions):
+    text = "".join(message["content"] for message in prompt_messages(messages, functions))
+    return len(llama.tokenize(text.encode("utf-8"), add_bos=False))
+
+
+def time_to_first_token(llama, messages, tools):
+    start = time.perf_counter()
+    _create_chat_completion_patched(
+        llama, messages=messages, tools=tools, max_tokens=1, temperature=0
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--embedding-model", type=str)
+    parser.add_argument("--n-ctx", type=int, default=32768)
+    parser.add_argument("--latency-requests", type=int, default=4)
+    args = parser.parse_args()
+
+    tools = catalog()
+    functions = [tool["function"] for tool in tools]
+    requests = [request(i) for i in range(args.requests)]
+    retrievers = {"bm25": None, "embedding": args.embedding_model}
+    if args.embedding_model is None:
+        del retrievers["embedding"]
+
+    print(
+        f"{'retrieval':<10} {'top k':>6} {'recall':>7} {'prompt tok':>11} "
+        f"{'select ms':>10} {'ttft s':>7}"
+    )
+    for top_k in [0, *args.top_k]:
+        for name, embedding_model in retrievers.items():
+            if top_k == 0 and name != "bm25":
+                continue
+            llama = llama_cpp.Llama(
+                model_path=args.model,
+                n_ctx=args.n_ctx,
+                chat_handler=EmpowerFunctionsCompletionHandler(
+                    tool_retrieval_top_k=top_k,
+                    tool_retrieval_embedding_model=embedding_model,
+                ),
+                verbose=False,
+            )
+            retriever = ToolRetriever(top_k or len(functions), embedding_model_path=embedding_model)
+            retriever.index(functions)
+
+            found = 0
+            tokens = []
+            selecting = 0.0
+            for messages, expected in requests:
+                start = time.perf_counter()
+                selected = retriever.select(functions, messages)
+                selecting += time.perf_counter() - start
+                found += any(function["name"] == expected for function in selected)
+                tokens.append(prompt_tokens(llama, messages, selected))
+
+            # Prompts that do not fit in the context are not timed.
+            timed = requests[:args.latency_requests]
+            ttft = (
+                f"{sum(time_to_first_token(llama, m, tools) for m, _ in timed) / len(timed):7.2f}"
+                if timed and max(tokens) < llama.n_ctx()
+                else f"{'-':>7}"
+            )
+            print(
+                f"{name if top_k else 'none':<10} {top_k or len(functions):>6} "
+                f"{found / len(requests):7.0%} {sum(tokens) / len(tokens):11.0f} "
+                f"{selecting / len(requests) * 1000:10.2f} {ttft}"
+            )
+            del llama
+
+
+if __name__ == "__main__":
+    main()
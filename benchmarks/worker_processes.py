@@ -0,0 +1,125 @@
+"""Load test of the server with chat completions served in process versus
+by 1, 2, 4... worker processes (--n_workers).
+
+Starts `python -m empower_functions.server` for each configuration and
+sends tool-calling chat completions from concurrent HTTP clients, half of
+them streaming, reporting throughput and latency.
+
+Usage: python benchmarks/worker_processes.py MODEL.gguf
+           [--workers 0 1 2 4] [--clients 32] [--requests 256]
+           [--max-tokens 64] [--port 8765] [server args...]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_weather",
+            "description": "Get the current weather in a given location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {
+                        "type": "string",
+                        "description": "The city and state, e.g. San Francisco, CA",
+                    },
+                    "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+                },
+                "required": ["location"],
+            },
+        },
+    }
+]
+
+
+def wait_until_ready(url, process, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            urllib.request.urlopen(url + "/v1/models")
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.5)
+    raise TimeoutError("Server did not start")
+
+
+def request(url, i, max_tokens):
+    body = {
+        "messages": [{"role": "user", "content": f"What's the weather in San Francisco? ({i})"}],
+        "tools": TOOLS,
+        "max_tokens": max_tokens,
+        "stream": i % 2 == 0,
+    }
+    start = time.perf_counter()
+    response = urllib.request.urlopen(
+        urllib.request.Request(
+            url + "/v1/chat/completions",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+    )
+    response.read()
+    return time.perf_counter() - start
+
+
+def run(url, clients, requests, max_tokens):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        latencies = sorted(pool.map(lambda i: request(url, i, max_tokens), range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests/s": requests / elapsed,
+        "p50 s": statistics.median(latencies),
+        "p99 s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--port", type=int, default=8765)
+    args, server_args = parser.parse_known_args()
+    url = f"http://127.0.0.1:{args.port}"
+
+    print(f"{'workers':>7} {'req/s':>8} {'p50 s':>8} {'p99 s':>8}")
+    for n_workers in args.workers:
+        process = subprocess.Popen(
+            [
+                sys.executable, "-m", "empower_functions.server",
+                "--model", args.model,
+                "--chat_format", "empower-functions",
+                "--n_workers", str(n_workers),
+                "--port", str(args.port),
+                # Queued requests must not cut off streaming ones in process.
+                "--interrupt_requests", "False",
+                *server_args,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_until_ready(url, process)
+            r = run(url, args.clients, args.requests, args.max_tokens)
+        finally:
+            process.terminate()
+            process.wait()
+        print(f"{n_workers:>7} {r['requests/s']:8.2f} {r['p50 s']:8.2f} {r['p99 s']:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
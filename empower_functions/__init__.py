@@ -1,7 +1,9 @@
 from .chat_handler import EmpowerFunctionsCompletionHandler
 from .prompt import prompt_messages
+from .streaming import ToolCall
 
 __all__ = [
     'EmpowerFunctionsCompletionHandler',
-    'prompt_messages'
+    'prompt_messages',
+    'ToolCall'
 ]
\ No newline at end of file
@@ -0,0 +1,379 @@
+"""Offline chat completions over a JSONL file.
+
+Each input line is a JSON object with the arguments of a chat completion,
+at least `messages` and usually `tools`, and an optional `id`. Each output
+line holds the `line` number (0-based) and `id` of a record with its
+`response`, or its `error`, written in the order records finish.
+
+Usage: python -m empower_functions.batch --model MODEL.gguf
+           --input records.jsonl --output results.jsonl [--n_parallel 8]
+           [--window 1024] [--checkpoint_every 256] [other model settings]
+
+Records are read into a window of at most `--window` records and submitted
+grouped by tool set, so requests with the same functions (and so the same
+first user message prefix) run next to each other and the batch scheduler
+(`--n_parallel`) prefills their shared prefix once. A record is submitted
+at the latest once as many records as the window holds were submitted
+after it was read, so small groups are not held back by larger ones.
+Memory stays bounded by the window whatever the size of the input.
+
+Progress is checkpointed to OUTPUT.checkpoint; running the same command
+again resumes after the last checkpoint, or starts over if OUTPUT was
+removed since.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
+from typing import IO, Any, Deque, Dict, NamedTuple, Optional, Set, Tuple
+
+from llama_cpp.server.cli import add_args_from_model, parse_model_from_args
+
+from empower_functions import json_backend
+from empower_functions.monkey_patch.app import _create_chat_completion_patched
+from empower_functions.monkey_patch.settings import EmpowerModelSettings
+from empower_functions.pool import LlamaPool
+from empower_functions.prompt import functions_fingerprint
+
+
+class BatchStats(NamedTuple):
+    completed: int
+    errors: int
+    skipped: int
+    prompt_tokens: int
+    completion_tokens: int
+    seconds: float
+
+
+class _Record(NamedTuple):
+    line: int
+    offset: int
+    body: Any
+
+
+class _Checkpoint:
+    """Where to resume: all input lines before `next_line` (starting at byte
+    `input_offset`) are done, as are the `done` lines after it, and their
+    results are the first `output_offset` bytes of the output."""
+
+    def __init__(
+        self,
+        next_line: int = 0,
+        input_offset: int = 0,
+        done: Optional[Set[int]] = None,
+        output_offset: int = 0,
+    ):
+        self.next_line = next_line
+        self.input_offset = input_offset
+        self.done = done or set()
+        self.output_offset = output_offset
+
+    @classmethod
+    def load(cls, path: str) -> "_Checkpoint":
+        with open(path, "r") as f:
+            state = json.load(f)
+        return cls(
+            next_line=state["next_line"],
+            input_offset=state["input_offset"],
+            done=set(state["done"]),
+            output_offset=state["output_offset"],
+        )
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "next_line": self.next_line,
+                    "input_offset": self.input_offset,
+                    "done": sorted(self.done),
+                    "output_offset": self.output_offset,
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+def _tool_set(body: Any) -> str:
+    if not isinstance(body, dict):
+        return ""
+    functions = body.get("functions")
+    if functions is None:
+        functions = [tool.get("function") for tool in body.get("tools") or []]
+    try:
+        return functions_fingerprint(functions)
+    except (TypeError, ValueError):
+        return ""
+
+
+class _Window:
+    """Records read ahead, grouped by tool set. Records of the group being
+    submitted come first, then the largest group, unless a record waited
+    while `max_age` others were popped, then its group comes first."""
+
+    def __init__(self, max_age: int):
+        # Records with the number of records popped before they were added.
+        self._groups: "OrderedDict[str, Deque[Tuple[int, _Record]]]" = OrderedDict()
+        self._current: Optional[str] = None
+        self._popped = 0
+        self.max_age = max_age
+        self.size = 0
+
+    def add(self, record: _Record):
+        self._groups.setdefault(_tool_set(record.body), deque()).append(
+            (self._popped, record)
+        )
+        self.size += 1
+
+    def pop(self) -> _Record:
+        oldest = min(self._groups, key=lambda key: self._groups[key][0][0])
+        if self._popped - self._groups[oldest][0][0] >= self.max_age:
+            self._current = oldest
+        elif self._current not in self._groups:
+            self._current = max(self._groups, key=lambda key: len(self._groups[key]))
+        group = self._groups[self._current]
+        _, record = group.popleft()
+        self._popped += 1
+        if not group:
+            del self._groups[self._current]
+        self.size -= 1
+        return record
+
+
+def _complete(create_chat_completion, body: Any) -> Dict[str, Any]:
+    if not isinstance(body, dict):
+        raise ValueError("Record must be a JSON object")
+    kwargs = {key: value for key, value in body.items() if key != "id"}
+    kwargs["stream"] = False
+    return create_chat_completion(**kwargs)
+
+
+def run_batch(
+    llama,
+    input_path: str,
+    output_path: str,
+    checkpoint_path: Optional[str] = None,
+    concurrency: int = 1,
+    window: int = 1024,
+    checkpoint_every: int = 256,
+    verbose: bool = True,
+) -> BatchStats:
+    """Run the chat completion records of the JSONL file `input_path` on
+    `llama` (a Llama or LlamaPool), `concurrency` at a time, and append
+    their results to `output_path` as they finish.
+
+    If `checkpoint_path` exists, the run resumes from it; it is updated
+    every `checkpoint_every` results and when the run stops.
+    """
+    create_chat_completion = (
+        partial(llama.run, _create_chat_completion_patched)
+        if isinstance(llama, LlamaPool)
+        else partial(_create_chat_completion_patched, llama)
+    )
+    checkpoint = (
+        _Checkpoint.load(checkpoint_path)
+        if checkpoint_path is not None and os.path.exists(checkpoint_path)
+        else _Checkpoint()
+    )
+    if checkpoint.output_offset > 0 and (
+        not os.path.exists(output_path)
+        or os.path.getsize(output_path) < checkpoint.output_offset
+    ):
+        # The results written before the checkpoint are gone, run them again.
+        if verbose:
+            print(
+                f"{output_path} does not have the results of the checkpoint, starting over",
+                file=sys.stderr,
+            )
+        checkpoint = _Checkpoint()
+    if verbose and checkpoint.next_line > 0:
+        print(
+            f"Resuming at line {checkpoint.next_line} "
+            f"({len(checkpoint.done)} later lines done)",
+            file=sys.stderr,
+        )
+
+    start = time.perf_counter()
+    completed = errors = skipped = prompt_tokens = completion_tokens = 0
+    # Offsets of the lines read and not done yet, in line order.
+    pending: "OrderedDict[int, int]" = OrderedDict()
+    done_after: Set[int] = set(checkpoint.done)
+    in_flight: Dict[Future, _Record] = {}
+    records = _Window(max_age=window)
+
+    input_file: IO[bytes] = open(input_path, "rb")
+    output_file: IO[bytes] = open(
+        output_path, "r+b" if checkpoint.output_offset > 0 else "wb"
+    )
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    line = checkpoint.next_line
+    offset = checkpoint.input_offset
+    eof = False
+    since_checkpoint = 0
+
+    def save_checkpoint():
+        output_file.flush()
+        os.fsync(output_file.fileno())
+        if pending:
+            next_line, input_offset = next(iter(pending.items()))
+        else:
+            next_line, input_offset = line, offset
+        done_after.difference_update([done for done in done_after if done < next_line])
+        checkpoint.next_line = next_line
+        checkpoint.input_offset = input_offset
+        checkpoint.done = set(done_after)
+        checkpoint.output_offset = output_file.tell()
+        if checkpoint_path is not None:
+            checkpoint.save(checkpoint_path)
+
+    try:
+        input_file.seek(offset)
+        # Drop results written after the checkpoint, they are run again.
+        output_file.seek(checkpoint.output_offset)
+        output_file.truncate()
+
+        while True:
+            while not eof and records.size < window:
+                raw = input_file.readline()
+                if not raw:
+                    eof = True
+                    break
+                record_line, record_offset = line, offset
+                line += 1
+                offset += len(raw)
+                if record_line in done_after or not raw.strip():
+                    skipped += record_line in done_after
+                    continue
+                try:
+                    body = json.loads(raw)
+                except ValueError as e:
+                    body = e
+                pending[record_line] = record_offset
+                records.add(_Record(record_line, record_offset, body))
+
+            while records.size > 0 and len(in_flight) < concurrency:
+                record = records.pop()
+                if isinstance(record.body, ValueError):
+                    future: Future = Future()
+                    future.set_exception(record.body)
+                else:
+                    future = executor.submit(_complete, create_chat_completion, record.body)
+                in_flight[future] = record
+
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                record = in_flight.pop(future)
+                result: Dict[str, Any] = {
+                    "line": record.line,
+                    "id": record.body.get("id") if isinstance(record.body, dict) else None,
+                }
+                try:
+                    response = future.result()
+                    result["response"] = response
+                    completed += 1
+                    prompt_tokens += response["usage"]["prompt_tokens"]
+                    completion_tokens += response["usage"]["completion_tokens"]
+                except Exception as e:  # noqa: BLE001
+                    result["error"] = f"{type(e).__name__}: {e}"
+                    errors += 1
+                output_file.write(json.dumps(result, ensure_ascii=False).encode("utf-8") + b"\n")
+                del pending[record.line]
+                done_after.add(record.line)
+
+                since_checkpoint += 1
+                if since_checkpoint >= checkpoint_every:
+                    since_checkpoint = 0
+                    save_checkpoint()
+                    if verbose:
+                        elapsed = time.perf_counter() - start
+                        print(
+                            f"{completed + errors} records, {errors} errors, "
+                            f"{completion_tokens / elapsed:.1f} completion tok/s",
+                            file=sys.stderr,
+                        )
+    finally:
+        # Results of requests still running are lost, they run again on
+        # resume.
+        executor.shutdown(wait=True, cancel_futures=True)
+        save_checkpoint()
+        input_file.close()
+        output_file.close()
+
+    return BatchStats(
+        completed=completed,
+        errors=errors,
+        skipped=skipped,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        seconds=time.perf_counter() - start,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    add_args_from_model(parser, EmpowerModelSettings)
+    parser.add_argument("--input", type=str, required=True, help="JSONL file of chat completion records.")
+    parser.add_argument("--output", type=str, required=True, help="JSONL file the results are appended to.")
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="Checkpoint file, defaults to OUTPUT.checkpoint.",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=1024,
+        help="Records read ahead and grouped by tool set.",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=256,
+        help="Results written between checkpoints.",
+    )
+    parser.add_argument(
+        "--json_backend",
+        choices=json_backend.JSON_BACKENDS,
+        default="auto",
+        help="JSON library used to build prompts and parse responses: orjson, json or auto, orjson when it is installed.",
+    )
+    args = parser.parse_args()
+    if args.chat_format is None:
+        args.chat_format = "empower-functions"
+    settings = parse_model_from_args(EmpowerModelSettings, args)
+    json_backend.use(args.json_backend)
+
+    # Imported here, it patches the server's LlamaProxy.
+    from empower_functions.server import load_llama_from_model_settings
+
+    llama = load_llama_from_model_settings(settings)
+    stats = run_batch(
+        llama,
+        args.input,
+        args.output,
+        checkpoint_path=args.checkpoint or f"{args.output}.checkpoint",
+        concurrency=settings.n_parallel * settings.n_replicas,
+        window=max(args.window, 1),
+        checkpoint_every=max(args.checkpoint_every, 1),
+        verbose=settings.verbose,
+    )
+    print(
+        f"{stats.completed} completed, {stats.errors} errors, {stats.skipped} already done, "
+        f"{stats.prompt_tokens} prompt and {stats.completion_tokens} completion tokens "
+        f"in {stats.seconds:.1f} s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, Tuple
+
+import llama_cpp.llama as llama
+
+
+class FitInfo(NamedTuple):
+    # Estimated prompt tokens of the returned messages.
+    prompt_tokens: int
+    dropped_messages: int
+    compacted_results: int
+
+
+class TokenCounter:
+    """Token counts of prompt pieces, e.g. rendered turns, kept for the
+    `maxsize` most recently counted pieces of each model so that a growing
+    conversation only tokenizes its new turns."""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._counts: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, llama: llama.Llama, text: str) -> int:
+        key = (llama.model_path, text)
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                return count
+        count = len(llama.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+        return count
+
+
+def compact_json(value: Any, max_items: int = 3, max_string: int = 256) -> Any:
+    """`value` with arrays cut to their first `max_items` items, followed by
+    a note of how many were left out, and strings cut to `max_string`
+    characters."""
+    if isinstance(value, list):
+        items = [compact_json(item, max_items, max_string) for item in value[:max_items]]
+        if len(value) > max_items:
+            items.append(f"... {len(value) - max_items} more items")
+        return items
+    if isinstance(value, dict):
+        return {key: compact_json(item, max_items, max_string) for key, item in value.items()}
+    if isinstance(value, str) and len(value) > max_string:
+        return value[:max_string] + f"... ({len(value) - max_string} more characters)"
+    return value
+
+
+def _compact_tool_message(
+    message: Dict[str, Any], max_items: int, max_string: int
+) -> Dict[str, Any]:
+    """`message` with its JSON content compacted, or `message` itself if
+    that does not make it shorter."""
+    try:
+        value = json.loads(message["content"])
+    except (KeyError, TypeError, ValueError):
+        return message
+    content = json.dumps(compact_json(value, max_items, max_string), ensure_ascii=False)
+    if len(content) >= len(message["content"]):
+        return message
+    return {**message, "content": content}
+
+
+def fit_history(
+    messages: Sequence[Dict[str, Any]],
+    budget: int,
+    count_tokens: Callable[[List[Dict[str, Any]]], int],
+    count_turns: Callable[[List[Dict[str, Any]]], int],
+    max_items: int = 3,
+    max_string: int = 256,
+) -> Tuple[List[Dict[str, Any]], FitInfo]:
+    """Cut `messages` until their prompt, counted by `count_tokens`, is at
+    most `budget` tokens. `count_turns` counts the tokens messages add to
+    the conversation they continue (see prompt_continuation), those of the
+    dropped messages are subtracted rather than counting the prompt again
+    after each cut; the prompt is counted once the estimate fits.
+
+    The system message and the messages from the last user message on are
+    kept. Until the prompt fits, the JSON results of earlier tool messages
+    are compacted (see compact_json), then the oldest messages are dropped
+    up to the next user message, so the prompt still starts with a user
+    turn carrying the functions, and last the latest tool results are
+    compacted too. The result may still be over budget when the latest
+    turns alone are.
+    """
+    messages = list(messages)
+    n_tokens = count_tokens(messages)
+    if n_tokens <= budget:
+        return messages, FitInfo(n_tokens, 0, 0)
+
+    system = messages[:1] if messages and messages[0].get("role") == "system" else []
+    history = messages[len(system):]
+    last_user = max(
+        (i for i, message in enumerate(history) if message.get("role") == "user"),
+        default=0,
+    )
+    originals = {id(message) for message in history}
+    dropped = 0
+
+    def compact(start: int, end: int) -> bool:
+        changed = False
+        for i in range(start, end):
+            if history[i].get("role") != "tool":
+                continue
+            message = _compact_tool_message(history[i], max_items, max_string)
+            if message is not history[i]:
+                history[i] = message
+                changed = True
+        return changed
+
+    if compact(0, last_user):
+        n_tokens = count_tokens(system + history)
+
+    while n_tokens > budget and last_user > 0:
+        while n_tokens > budget and last_user > 0:
+            cut = next(i for i in range(1, last_user + 1) if history[i].get("role") == "user")
+            n_tokens -= count_turns(history[:cut])
+            del history[:cut]
+            dropped += cut
+            last_user -= cut
+        n_tokens = count_tokens(system + history)
+
+    if n_tokens > budget and compact(last_user, len(history)):
+        n_tokens = count_tokens(system + history)
+
+    compacted = sum(1 for message in history if id(message) not in originals)
+    return system + history, FitInfo(n_tokens, dropped, compacted)
@@ -1,7 +1,12 @@
 import json
+import re
+import sys
+import threading
+from functools import partial
 
 from typing import (
     Any,
+    Callable,
     Dict,
     Iterator,
     List,
@@ -14,16 +19,542 @@ from typing import (
 )
 
 import jinja2
+import numpy as np
 from jinja2.sandbox import ImmutableSandboxedEnvironment
 
+import llama_cpp
 import llama_cpp.llama as llama
 import llama_cpp.llama_types as llama_types
 from llama_cpp.llama_chat_format import LlamaChatCompletionHandler
-from empower_functions.prompt import prompt_messages
+from empower_functions import json_backend
+from empower_functions.budget import FitInfo, TokenCounter, fit_history
+from empower_functions.forced import ForcedTokens
+from empower_functions.grammar import ToolCallGrammarCache
+from empower_functions.metrics import (
+    JSON_PARSE_FAILURES,
+    PHASE_SECONDS,
+    RESPONSES,
+    GenerationClock,
+)
+from empower_functions.prefix_cache import PrefixStateCache
+from empower_functions.prompt import (
+    functions_block,
+    prompt_continuation,
+    prompt_messages,
+    prompt_prefix,
+    tool_choice_prefill,
+)
+from empower_functions.retrieval import ToolRetriever
+from empower_functions.scheduler import BatchScheduler
+from empower_functions.session_store import SessionStateStore
+from empower_functions.sessions import Session, SessionCache, history_digests
+from empower_functions.speculative import ToolCallDraftModel
+from empower_functions.streaming import (
+    CONTENT_PREFIX,
+    FUNCTIONS_PREFIX,
+    THINKING_END_TAG,
+    ToolCall,
+    ToolCallObserver,
+    ToolCallStreamParser,
+)
 import traceback
 
+LLAMA_3_TEMPLATE = "{% set loop_messages = messages %}{% for message in loop_messages %}{% set content = '<|start_header_id|>' + message['role'] + '<|end_header_id|>\n\n'+ message['content'] | trim + '<|eot_id|>' %}{% if loop.index0 == 0 %}{% set content = '<|begin_of_text|>' + content %}{% endif %}{{ content }}{% endfor %}{% if add_generation_prompt %}{{ '<|start_header_id|>assistant<|end_header_id|>\n\n' }}{% endif %}"
+
+
+def _compile_llama3_template() -> jinja2.Template:
+    return ImmutableSandboxedEnvironment(
+        autoescape=False,
+        undefined=jinja2.StrictUndefined,
+    ).from_string(LLAMA_3_TEMPLATE)
+
+
+_LLAMA_3_GENERATION_PROMPT = "<|start_header_id|>assistant<|end_header_id|>\n\n"
+
+
+def _render_llama3_turns(messages: List[Dict[str, str]]) -> str:
+    """Rendered text of `messages` as they follow earlier turns."""
+    parts = []
+    for message in messages:
+        parts.append("<|start_header_id|>")
+        parts.append(message["role"])
+        parts.append("<|end_header_id|>\n\n")
+        parts.append(message["content"].strip())
+        parts.append("<|eot_id|>")
+    return "".join(parts)
+
+
+def _render_llama3_prompt(
+    messages: List[Dict[str, str]], add_generation_prompt: bool = True
+) -> str:
+    """Render the same text as LLAMA_3_TEMPLATE without going through Jinja."""
+    parts = ["<|begin_of_text|>"] if messages else []
+    parts.append(_render_llama3_turns(messages))
+    if add_generation_prompt:
+        parts.append(_LLAMA_3_GENERATION_PROMPT)
+    return "".join(parts)
+
+
+def _render_llama3_first_turn_prefix(content_prefix: str) -> str:
+    """Rendered prompt text up to and including `content_prefix`, the start
+    of the first user message. Only leading whitespace is trimmed since the
+    message continues after it."""
+    return (
+        "<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n"
+        + content_prefix.lstrip()
+    )
+
 
 class EmpowerFunctionsCompletionHandler(LlamaChatCompletionHandler):
+    def __init__(
+        self,
+        fast_template: bool = False,
+        prefix_cache_bytes: int = 0,
+        tool_call_grammar: bool = False,
+        on_tool_call: Optional[Callable[[ToolCall], None]] = None,
+        n_parallel: int = 1,
+        n_parallel_ctx: Optional[int] = None,
+        session_cache_size: int = 0,
+        session_store_path: Optional[str] = None,
+        session_store_bytes: int = (8 << 30),
+        session_store_ttl: float = 3600.0,
+        forced_tokens: bool = False,
+        tool_retrieval_top_k: int = 0,
+        tool_retrieval_embedding_model: Optional[str] = None,
+        functions_encoding: str = "indent",
+        fit_context: bool = False,
+        reserve_tokens: int = 512,
+    ):
+        """
+        Args:
+            fast_template: Render the prompt without Jinja, same text.
+            prefix_cache_bytes: Capacity of the PrefixStateCache, 0 disables it.
+            tool_call_grammar: Constrain responses to `<c>` text or calls of
+                the given tools, unless the request has a grammar.
+            on_tool_call: Called with each ToolCall as soon as it is generated.
+            n_parallel: Requests decoded together by a BatchScheduler.
+            n_parallel_ctx: KV cache size of the BatchScheduler.
+            session_cache_size: Conversations kept by the SessionCache.
+            session_store_path: Directory of the SessionStateStore, None
+                disables it.
+            session_store_bytes: Size limit of the SessionStateStore.
+            session_store_ttl: Seconds an unused conversation is stored.
+            forced_tokens: Append grammar-forced tokens with ForcedTokens,
+                needs a Llama created with logits_all.
+            tool_retrieval_top_k: Functions kept by the ToolRetriever, 0
+                keeps them all.
+            tool_retrieval_embedding_model: Ranks the functions by embedding
+                instead of BM25.
+            functions_encoding: See encode_functions.
+            fit_context: Cut histories that do not fit, see fit_history.
+            reserve_tokens: Response tokens fit_context leaves without
+                max_tokens.
+
+        Requests also take `session_id`, `route`, `include_thinking`,
+        `functions_encoding` and `on_tool_call` keyword arguments, which
+        the server passes from the request body. Llama.create_chat_completion
+        rejects them, call the handler itself to pass them.
+        """
+        self.fast_template = fast_template
+        self._template_renderer = None if fast_template else _compile_llama3_template()
+        self.prefix_cache = (
+            PrefixStateCache(capacity_bytes=prefix_cache_bytes)
+            if prefix_cache_bytes > 0
+            else None
+        )
+        self.grammar_cache = ToolCallGrammarCache() if tool_call_grammar else None
+        self.routing_grammar_cache = self.grammar_cache or ToolCallGrammarCache()
+        self.on_tool_call = on_tool_call
+        self.n_parallel = n_parallel
+        self.n_parallel_ctx = n_parallel_ctx
+        self._scheduler: Optional[BatchScheduler] = None
+        self._scheduler_lock = threading.Lock()
+        self.session_cache = (
+            SessionCache(maxsize=session_cache_size) if session_cache_size > 0 else None
+        )
+        self._generation_prompt_tokens: Dict[str, Optional[List[int]]] = {}
+        self.forced_tokens = forced_tokens
+        self.functions_encoding = functions_encoding
+        self.fit_context = fit_context
+        self.reserve_tokens = reserve_tokens
+        self.token_counter = TokenCounter() if fit_context else None
+        self.tool_retriever = (
+            ToolRetriever(
+                tool_retrieval_top_k, embedding_model_path=tool_retrieval_embedding_model
+            )
+            if tool_retrieval_top_k > 0
+            else None
+        )
+        self.session_store = (
+            SessionStateStore(
+                session_store_path,
+                capacity_bytes=session_store_bytes,
+                ttl=session_store_ttl,
+            )
+            if session_store_path is not None
+            else None
+        )
+
+    def scheduler(self, llama: llama.Llama) -> Optional[BatchScheduler]:
+        """The BatchScheduler of `llama`, created on first use, or None when
+        requests are not batched."""
+        if self.n_parallel <= 1:
+            return None
+        with self._scheduler_lock:
+            if self._scheduler is None or self._scheduler.llama is not llama:
+                self._scheduler = BatchScheduler(
+                    llama, n_parallel=self.n_parallel, n_ctx=self.n_parallel_ctx
+                )
+            return self._scheduler
+
+    def _render(self, prompted_messages: List[Dict[str, str]]) -> str:
+        if self._template_renderer is None:
+            return _render_llama3_prompt(prompted_messages, add_generation_prompt=True)
+        return self._template_renderer.render(
+            messages=prompted_messages, add_generation_prompt=True
+        )
+
+    def _session_prompt(
+        self,
+        llama: llama.Llama,
+        messages: List[llama_types.ChatCompletionRequestMessage],
+        functions: List[llama_types.ChatCompletionFunction],
+        include_thinking: bool,
+        functions_encoding: str,
+        session_id: Optional[str],
+        digests: List[str],
+    ) -> List[int]:
+        """Prompt tokens of `messages`, prompting and tokenizing only the
+        messages appended since the conversation's previous turn."""
+        session_cache = cast(SessionCache, self.session_cache)
+        key = (
+            llama.model_path,
+            functions_block(functions, functions_encoding).fingerprint if functions else None,
+            include_thinking,
+        )
+        session = session_cache.lookup(key, messages, digests, session_id)
+        generation_prompt_tokens = self._generation_prompt(llama)
+
+        if session is None:
+            text = _render_llama3_prompt(
+                prompt_messages(
+                    messages,
+                    functions,
+                    include_thinking=include_thinking,
+                    functions_encoding=functions_encoding,
+                ),
+                add_generation_prompt=False,
+            )
+            tokens = (
+                llama.tokenize(text.encode("utf-8"), special=True)
+                if generation_prompt_tokens is not None
+                else None
+            )
+        else:
+            appended = _render_llama3_turns(
+                prompt_continuation(messages[session.n_messages:])
+            )
+            text = session.text + appended
+            tokens = (
+                session.tokens
+                + llama.tokenize(appended.encode("utf-8"), add_bos=False, special=True)
+                if session.tokens is not None
+                else None
+            )
+        session_cache.store(key, Session(len(messages), digests[-1], text, tokens), session_id)
+
+        if tokens is None or generation_prompt_tokens is None:
+            return llama.tokenize(
+                (text + _LLAMA_3_GENERATION_PROMPT).encode("utf-8"), special=True
+            )
+        return tokens + generation_prompt_tokens
+
+    def _prompt_tokens(
+        self,
+        llama: llama.Llama,
+        messages: List[llama_types.ChatCompletionRequestMessage],
+        functions: List[llama_types.ChatCompletionFunction],
+        include_thinking: bool,
+        functions_encoding: str,
+    ) -> int:
+        """Tokens of the prompt of `messages`, counted turn by turn. The
+        prefix of the first user message, with the functions, is counted
+        apart from the message so it is only tokenized once."""
+        count = partial(cast(TokenCounter, self.token_counter).count, llama)
+        prompted_messages = prompt_messages(
+            messages,
+            functions,
+            include_thinking=include_thinking,
+            functions_encoding=functions_encoding,
+        )
+        n_tokens = count("<|begin_of_text|>") + count(_LLAMA_3_GENERATION_PROMPT)
+        prefix = prompt_prefix(messages, functions, include_thinking, functions_encoding)
+        for i, message in enumerate(prompted_messages):
+            if i == 0 and prefix is not None and message["content"].startswith(prefix.text):
+                n_tokens += count(
+                    _render_llama3_first_turn_prefix(prefix.text)[len("<|begin_of_text|>"):]
+                )
+                n_tokens += count(
+                    message["content"][len(prefix.text):].rstrip() + "<|eot_id|>"
+                )
+            else:
+                n_tokens += count(_render_llama3_turns([message]))
+        return n_tokens
+
+    def _continuation_tokens(
+        self, llama: llama.Llama, messages: List[llama_types.ChatCompletionRequestMessage]
+    ) -> int:
+        """Tokens `messages` add to the prompt of the conversation they
+        continue."""
+        count = partial(cast(TokenCounter, self.token_counter).count, llama)
+        return sum(
+            count(_render_llama3_turns([message])) for message in prompt_continuation(messages)
+        )
+
+    def _fit_context(
+        self,
+        llama: llama.Llama,
+        messages: List[llama_types.ChatCompletionRequestMessage],
+        functions: List[llama_types.ChatCompletionFunction],
+        tool_choice: Any,
+        include_thinking: bool,
+        functions_encoding: str,
+        max_tokens: Optional[int],
+    ) -> List[llama_types.ChatCompletionRequestMessage]:
+        scheduler = self.scheduler(llama)
+        n_ctx = min(llama.n_ctx(), scheduler.n_ctx) if scheduler is not None else llama.n_ctx()
+        budget = n_ctx - (max_tokens if max_tokens is not None and max_tokens > 0 else self.reserve_tokens)
+        prefill = tool_choice_prefill(tool_choice, functions)
+        if prefill:
+            budget -= cast(TokenCounter, self.token_counter).count(llama, prefill)
+        if budget <= 0:
+            return messages
+
+        fitted, info = fit_history(
+            messages,
+            budget,
+            lambda candidate: self._prompt_tokens(
+                llama, candidate, functions, include_thinking, functions_encoding
+            ),
+            lambda turns: self._continuation_tokens(llama, turns),
+        )
+        if llama.verbose and (info.dropped_messages or info.compacted_results):
+            _log_fit(info)
+        return cast(List[llama_types.ChatCompletionRequestMessage], fitted)
+
+    def _generation_prompt(self, llama: llama.Llama) -> Optional[List[int]]:
+        """Tokens of the generation prompt if the model tokenizes each turn
+        independently of the previous ones, as when the turn markers are
+        special tokens, else None and prompts are tokenized in full."""
+        if llama.model_path not in self._generation_prompt_tokens:
+            def tokenize(text: str, add_bos: bool = True) -> List[int]:
+                return llama.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True)
+
+            first = _render_llama3_prompt(
+                [{"role": "user", "content": "Hi"}], add_generation_prompt=False
+            )
+            turn = _render_llama3_turns([{"role": "assistant", "content": "<c>Hello"}])
+            separable = (
+                tokenize(first + turn + _LLAMA_3_GENERATION_PROMPT)
+                == tokenize(first)
+                + tokenize(turn, add_bos=False)
+                + tokenize(_LLAMA_3_GENERATION_PROMPT, add_bos=False)
+            )
+            self._generation_prompt_tokens[llama.model_path] = (
+                tokenize(_LLAMA_3_GENERATION_PROMPT, add_bos=False) if separable else None
+            )
+        return self._generation_prompt_tokens[llama.model_path]
+
+    def _prompt(
+        self,
+        llama: llama.Llama,
+        messages: List[llama_types.ChatCompletionRequestMessage],
+        functions: List[llama_types.ChatCompletionFunction],
+        include_thinking: bool,
+        functions_encoding: str,
+        session_id: Optional[str],
+        restore: bool,
+        store: bool,
+    ) -> Tuple[Union[str, List[int]], Optional[str], Optional[str]]:
+        """Prompt of `messages`, with the context restored from the session
+        store or the prefix cache when `restore`. Returns the prompt, text or
+        tokens, and the keys the state is saved under and replaces after
+        generation when the session store is used (`store`)."""
+        digests = (
+            history_digests(messages)
+            if self.session_cache is not None or self.session_store is not None
+            else []
+        )
+        prompt: Union[str, List[int]]
+        if self.session_cache is not None:
+            # Rendered and tokenized too.
+            with PHASE_SECONDS.time("prompt"):
+                prompt = self._session_prompt(
+                    llama,
+                    messages,
+                    functions,
+                    include_thinking,
+                    functions_encoding,
+                    session_id,
+                    digests,
+                )
+        else:
+            with PHASE_SECONDS.time("prompt"):
+                prompted_messages = prompt_messages(
+                    messages,
+                    functions,
+                    include_thinking=include_thinking,
+                    functions_encoding=functions_encoding,
+                )
+            with PHASE_SECONDS.time("render"):
+                prompt = self._render(prompted_messages)
+
+        session_key = restored_key = None
+        if self.session_store is not None and restore and store:
+            if isinstance(prompt, str):
+                with PHASE_SECONDS.time("tokenize"):
+                    prompt = llama.tokenize(prompt.encode("utf-8"), special=True)
+            # The state saved after the longest earlier turn of this
+            # conversation, found by session id or by history.
+            restored_key = self.session_store.restore(
+                llama,
+                [session_id] if session_id is not None else digests[:0:-1],
+                prompt,
+            )
+            session_key = session_id if session_id is not None else digests[-1]
+        if self.prefix_cache is not None and functions and restore:
+            prefix = prompt_prefix(messages, functions, include_thinking, functions_encoding)
+            prompt = self.prefix_cache.prepare(
+                llama,
+                key=(
+                    llama.model_path,
+                    prefix.system_instruction,
+                    prefix.functions_block.fingerprint,
+                    include_thinking,
+                ),
+                prefix=_render_llama3_first_turn_prefix(prefix.text),
+                prompt=prompt,
+            )
+        return prompt, session_key, restored_key
+
+    def _prefill(
+        self,
+        llama: llama.Llama,
+        prompt: Union[str, List[int]],
+        functions: List[llama_types.ChatCompletionFunction],
+        tool_choice: Any,
+        include_thinking: bool,
+        route: bool,
+        grammar: Optional[llama.LlamaGrammar],
+    ) -> Tuple[Union[str, List[int]], str, Optional[llama.LlamaGrammar]]:
+        """`prompt` followed by the start of the response forced by
+        `tool_choice`, that start, and the grammar the rest of the response
+        is generated with."""
+        # A forced tool choice starts the response with the tool call, the
+        # model only generates the rest of it.
+        prefill = tool_choice_prefill(tool_choice, functions)
+        routed_functions = functions
+        if route and prefill:
+            # The name of the forced function is generated like any other.
+            prefill = FUNCTIONS_PREFIX
+            if isinstance(tool_choice, dict):
+                routed_functions = [
+                    f for f in functions if f["name"] == tool_choice["function"]["name"]
+                ]
+        if prefill:
+            if isinstance(prompt, str):
+                prompt += prefill
+            else:
+                prompt = prompt + llama.tokenize(
+                    prefill.encode("utf-8"), add_bos=False, special=True
+                )
+
+        if route:
+            grammar = self.routing_grammar_cache.get_routing(
+                routed_functions, include_thinking, prefilled=bool(prefill)
+            )
+        elif grammar is None and self.grammar_cache is not None and functions:
+            if prefill:
+                grammar = self.grammar_cache.get_continuation(
+                    functions,
+                    tool_choice["function"]["name"] if isinstance(tool_choice, dict) else None,
+                )
+            else:
+                grammar = self.grammar_cache.get(functions, include_thinking)
+        return prompt, prefill, grammar
+
+    def _generate(
+        self,
+        llama: llama.Llama,
+        scheduler: Optional[BatchScheduler],
+        prompt: Union[str, List[int]],
+        grammar: Optional[llama.LlamaGrammar],
+        logits_processor: Optional[llama.LogitsProcessorList],
+        session_key: Optional[str],
+        restored_key: Optional[str],
+        stream: bool,
+        **kwargs: Any,
+    ) -> Union[llama_types.CreateCompletionResponse, Iterator[llama_types.CreateCompletionStreamResponse]]:
+        """Completion of `prompt`, timed, with forced tokens when enabled,
+        and the state saved to the session store under `session_key` once
+        done. `kwargs` are the sampling arguments of create_completion."""
+        if isinstance(prompt, str):
+            with PHASE_SECONDS.time("tokenize"):
+                prompt = llama.tokenize(prompt.encode("utf-8"), special=True)
+        # Times prefill and decode, see GenerationClock.
+        clock = GenerationClock()
+        logits_processor = llama_cpp.LogitsProcessorList([*(logits_processor or []), clock])
+        # The batch scheduler counts the tokens it reuses itself.
+        cached_tokens = _cached_prompt_tokens(llama, prompt) if scheduler is None else 0
+
+        forced_tokens = None
+        if (
+            self.forced_tokens
+            and grammar is not None
+            and scheduler is None
+            and llama.context_params.logits_all
+        ):
+            forced_tokens = ForcedTokens(
+                llama, grammar, len(prompt), draft_model=llama.draft_model
+            )
+            llama.draft_model = forced_tokens
+
+        create_completion = (
+            llama.create_completion if scheduler is None else scheduler.create_completion
+        )
+        try:
+            generated = create_completion(
+                prompt=prompt,
+                stream=stream,
+                logits_processor=logits_processor,
+                grammar=grammar,
+                **kwargs,
+            )
+        finally:
+            if forced_tokens is not None and not stream:
+                llama.draft_model = forced_tokens.draft_model
+        if stream:
+            generated = _observe_generation_after(generated, clock, len(prompt), cached_tokens)
+        else:
+            clock.observe(
+                generated["usage"]["completion_tokens"], len(prompt), cached_tokens
+            )
+        if forced_tokens is not None:
+            if stream:
+                generated = _restore_draft_model_after(generated, llama, forced_tokens)
+            else:
+                generated["usage"]["decode_steps_saved"] = forced_tokens.forced
+                _log_decode_steps_saved(llama, forced_tokens)
+        if session_key is not None:
+            store = cast(SessionStateStore, self.session_store)
+            if stream:
+                generated = _save_state_after(
+                    generated, store, llama, session_key, restored_key
+                )
+            else:
+                store.save(llama, session_key, replaces=restored_key)
+        return generated
+
     def __call__(
         self,
         llama: llama.Llama,
@@ -60,30 +591,7 @@ class EmpowerFunctionsCompletionHandler(LlamaChatCompletionHandler):
         llama_types.CreateChatCompletionResponse,
         Iterator[llama_types.CreateChatCompletionStreamResponse],
     ]:
-        template = "{% set loop_messages = messages %}{% for message in loop_messages %}{% set content = '<|start_header_id|>' + message['role'] + '<|end_header_id|>\n\n'+ message['content'] | trim + '<|eot_id|>' %}{% if loop.index0 == 0 %}{% set content = '<|begin_of_text|>' + content %}{% endif %}{{ content }}{% endfor %}{% if add_generation_prompt %}{{ '<|start_header_id|>assistant<|end_header_id|>\n\n' }}{% endif %}"
-        template_renderer = ImmutableSandboxedEnvironment(
-            autoescape=False,
-            undefined=jinja2.StrictUndefined,
-        ).from_string(template)
-
-        # Convert legacy function_call to tool_choice
-        if function_call is not None:
-            if isinstance(function_call, str) and (
-                function_call == "none" or function_call == "auto"
-            ):
-                tool_choice = function_call
-            if isinstance(function_call, dict) and "name" in function_call:
-                tool_choice = {
-                    "type": "function",
-                    "function": {
-                        "name": function_call["name"],
-                    },
-                }
-        if not tool_choice:
-            tool_choice = "auto"
-
-        assert tool_choice != "any"
-
+        tool_choice = _tool_choice(function_call, tool_choice)
         if functions is None:
             functions = [tool.get("function") for tool in tools]
         stop = (
@@ -92,22 +600,69 @@ class EmpowerFunctionsCompletionHandler(LlamaChatCompletionHandler):
             else stop + ["<|eot_id|>"] if stop else ["<|eot_id|>"]
         )
 
+        session_id = kwargs.get("session_id")
         if tool_choice == "none":
             functions = []
+        elif self.tool_retriever is not None and functions:
+            with PHASE_SECONDS.time("retrieval"):
+                functions = self.tool_retriever.select(
+                    functions, messages, tool_choice, session_id
+                )
 
-        include_thinking = False
-        if "include_thinking" in kwargs:
-            include_thinking = kwargs["include_thinking"]
-        prompted_messages = prompt_messages(
-            messages, functions, include_thinking=include_thinking
+        include_thinking = kwargs.get("include_thinking", False)
+        functions_encoding = kwargs.get("functions_encoding") or self.functions_encoding
+        if self.fit_context:
+            with PHASE_SECONDS.time("fit_context"):
+                messages = self._fit_context(
+                    llama,
+                    messages,
+                    functions,
+                    tool_choice,
+                    include_thinking,
+                    functions_encoding,
+                    max_tokens,
+                )
+        # Only decide between a message and a tool call, see
+        # _convert_completion_to_route.
+        route = kwargs.get("route", False)
+        if route:
+            stream = False
+            temperature = 0.0
+
+        scheduler = self.scheduler(llama)
+        prompt, session_key, restored_key = self._prompt(
+            llama,
+            messages,
+            functions,
+            include_thinking,
+            functions_encoding,
+            session_id,
+            restore=scheduler is None,
+            store=scheduler is None and not route,
         )
-        prompt = template_renderer.render(
-            messages=prompted_messages, add_generation_prompt=True
+        prompt, prefill, grammar = self._prefill(
+            llama, prompt, functions, tool_choice, include_thinking, route, grammar
         )
 
-        # Case 1: No tool choice by user
-        generated = llama.create_completion(
-            prompt=prompt,
+        if scheduler is None and isinstance(llama.draft_model, ToolCallDraftModel):
+            llama.draft_model.prepare(llama, functions, _last_user_message(messages))
+
+        on_tool_call = kwargs.get("on_tool_call", self.on_tool_call)
+        tool_call_observer = None
+        if on_tool_call is not None and functions and not stream and not route:
+            tool_call_observer = ToolCallObserver(llama, on_tool_call, prefill=prefill)
+            logits_processor = llama_cpp.LogitsProcessorList(
+                [*(logits_processor or []), tool_call_observer]
+            )
+
+        generated = self._generate(
+            llama,
+            scheduler,
+            prompt,
+            grammar,
+            logits_processor,
+            session_key,
+            restored_key,
             temperature=temperature,
             top_p=top_p,
             top_k=top_k,
@@ -124,28 +679,185 @@ class EmpowerFunctionsCompletionHandler(LlamaChatCompletionHandler):
             mirostat_tau=mirostat_tau,
             mirostat_eta=mirostat_eta,
             model=model,
-            logits_processor=logits_processor,
-            grammar=grammar,
             logprobs=top_logprobs if logprobs else None,
         )
-        thinking = None
-        content = None
+        if stream:
+            if prefill:
+                generated = _prepend_text(generated, prefill)
+            return _convert_completion_chunks_to_chat_stream(
+                generated, on_tool_call=on_tool_call
+            )
+        if prefill:
+            generated["choices"][0]["text"] = prefill + generated["choices"][0]["text"]
+        if route:
+            RESPONSES.inc(1, "route")
+            return _convert_completion_to_route(generated)
+        if tool_call_observer is not None:
+            tool_call_observer.finish(generated["choices"][0]["text"])
+        with PHASE_SECONDS.time("convert"):
+            return _convert_generated(generated)
 
-        (content, thinking) = _separate_thinking_if_present(
-            generated["choices"][0]["text"]
-        )
-        if content.startswith("<f>"):
-            generated["choices"][0]["text"] = content
+
+def _tool_choice(
+    function_call: Optional[llama_types.ChatCompletionRequestFunctionCall],
+    tool_choice: Optional[llama_types.ChatCompletionToolChoiceOption],
+) -> Any:
+    """`tool_choice`, or the legacy `function_call` converted to it, "auto"
+    when neither is given."""
+    if function_call is not None:
+        if isinstance(function_call, str) and (
+            function_call == "none" or function_call == "auto"
+        ):
+            tool_choice = function_call
+        if isinstance(function_call, dict) and "name" in function_call:
+            tool_choice = {
+                "type": "function",
+                "function": {
+                    "name": function_call["name"],
+                },
+            }
+    return tool_choice or "auto"
+
+
+def _convert_generated(
+    generated: llama_types.CreateCompletionResponse,
+) -> llama_types.CreateChatCompletionResponse:
+    """Chat completion of the text generated for a request: tool calls,
+    or content."""
+    # The response is located by offset in the generated text, which is
+    # only sliced for the parts that are returned.
+    text = generated["choices"][0]["text"]
+    start = _thinking_end(text)
+    if text.startswith(FUNCTIONS_PREFIX, start):
+        RESPONSES.inc(1, "tool_call")
+        try:
             return _convert_completion_to_chat_function(
                 completion_or_chunks=generated,
-                thinking=thinking,
+                thinking=text[:start] if start else None,
+                start=start,
             )
-        elif content.startswith("<c>"):
-            generated["choices"][0]["text"] = thinking + \
-                content[3:] if thinking else content[3:]
-            return _convert_completion_to_chat(generated, stream=stream)
+        except ValueError:
+            JSON_PARSE_FAILURES.inc()
+            raise
+    RESPONSES.inc(1, "content")
+    if text.startswith(CONTENT_PREFIX, start):
+        generated["choices"][0]["text"] = (
+            text[:start] + text[start + len(CONTENT_PREFIX):]
+            if start
+            else text[len(CONTENT_PREFIX):]
+        )
+    return _convert_completion_to_chat(generated, stream=False)
 
-        return _convert_completion_to_chat(generated, stream=stream)
+
+def _last_user_message(
+    messages: List[llama_types.ChatCompletionRequestMessage],
+) -> Optional[str]:
+    for message in reversed(messages):
+        if message["role"] == "user":
+            content = message.get("content")
+            return content if isinstance(content, str) else None
+    return None
+
+
+def _convert_completion_to_route(
+    completion: llama_types.CreateCompletionResponse,
+) -> Dict[str, Any]:
+    """Compact routing decision: whether the model answers with a message
+    (`content`) or a tool call, and the function it calls first. The type
+    is None when max_tokens ran out before the decision, e.g. while
+    thinking."""
+    content, thinking = _separate_thinking_if_present(completion["choices"][0]["text"])
+    content = content.lstrip()
+    kind = function = None
+    if content.startswith(CONTENT_PREFIX):
+        kind = "content"
+    elif content.startswith(FUNCTIONS_PREFIX):
+        # The response stops right after the first function name.
+        try:
+            function = json_backend.loads(content[len(FUNCTIONS_PREFIX):] + "}]")[0]["name"]
+            kind = "tool_call"
+        except ValueError:
+            pass
+    return {
+        "id": "route" + completion["id"],
+        "object": "chat.route",
+        "created": completion["created"],
+        "model": completion["model"],
+        "type": kind,
+        "function": function,
+        "thinking": thinking,
+        "usage": completion["usage"],
+    }
+
+
+def _cached_prompt_tokens(llama: llama.Llama, prompt: List[int]) -> int:
+    """Tokens of `prompt` that Llama.generate will reuse from the KV cache,
+    the last one is always evaluated again."""
+    n = min(llama.n_tokens, len(prompt) - 1)
+    if n <= 0:
+        return 0
+    mismatch = np.nonzero(llama.input_ids[:n] != np.asarray(prompt[:n]))[0]
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+def _observe_generation_after(
+    chunks: Iterator[llama_types.CreateCompletionStreamResponse],
+    clock: GenerationClock,
+    prompt_tokens: int,
+    cached_tokens: int,
+) -> Iterator[llama_types.CreateCompletionStreamResponse]:
+    yield from chunks
+    clock.observe(clock.calls, prompt_tokens, cached_tokens)
+
+
+def _prepend_text(
+    chunks: Iterator[llama_types.CreateCompletionStreamResponse],
+    text: str,
+) -> Iterator[llama_types.CreateCompletionStreamResponse]:
+    for i, chunk in enumerate(chunks):
+        if i == 0:
+            chunk["choices"][0]["text"] = text + chunk["choices"][0]["text"]
+        yield chunk
+
+
+def _restore_draft_model_after(
+    chunks: Iterator[llama_types.CreateCompletionStreamResponse],
+    llama: llama.Llama,
+    forced_tokens: ForcedTokens,
+) -> Iterator[llama_types.CreateCompletionStreamResponse]:
+    try:
+        yield from chunks
+    finally:
+        llama.draft_model = forced_tokens.draft_model
+        _log_decode_steps_saved(llama, forced_tokens)
+
+
+def _log_fit(info: FitInfo):
+    print(
+        f"fit_context: {info.dropped_messages} messages dropped, "
+        f"{info.compacted_results} tool results compacted, "
+        f"about {info.prompt_tokens} prompt tokens",
+        file=sys.stderr,
+    )
+
+
+def _log_decode_steps_saved(llama: llama.Llama, forced_tokens: ForcedTokens):
+    if llama.verbose:
+        print(
+            f"ForcedTokens: {forced_tokens.forced} decode steps saved",
+            file=sys.stderr,
+        )
+
+
+def _save_state_after(
+    chunks: Iterator[llama_types.CreateCompletionStreamResponse],
+    store: SessionStateStore,
+    llama: llama.Llama,
+    key: str,
+    replaces: Optional[str],
+) -> Iterator[llama_types.CreateCompletionStreamResponse]:
+    yield from chunks
+    store.save(llama, key, replaces=replaces)
 
 
 def _convert_completion_to_chat(
@@ -172,36 +884,91 @@ def _maybe_json_dumps(value: Any) -> str:
     return json.dumps(value)
 
 
+def _tool_call_id(name: str, completion_id: str, index: int) -> str:
+    return f"call__0_{name}_{completion_id}_{index}"
+
+
+_JSON_DECODER = json.JSONDecoder()
+_WS = r"[ \t\n\r]*"
+_ARRAY_START = re.compile(_WS + r"\[")
+# An element of the `<f>` array up to its arguments, in the order the model
+# generates them. Control characters are not allowed in JSON strings.
+_CALL_START = re.compile(
+    _WS + r'\{' + _WS + r'"name"' + _WS + ":" + _WS
+    + r'"((?:[^"\\\x00-\x1f]|\\.)*)"' + _WS + "," + _WS + r'"arguments"' + _WS + ":" + _WS
+)
+_CALL_END = re.compile(_WS + r"\}" + _WS + r"([,\]])")
+_TRAILING_WHITESPACE = re.compile(_WS + r"\Z")
+
+
+def _scan_tool_calls(text: str, pos: int = 0) -> Optional[List[Tuple[str, str]]]:
+    """The name and JSON arguments of each call of the `<f>` array at `pos`
+    of `text`, parsing it once.
+
+    Arguments are returned as they were generated, the same text their
+    streamed fragments add up to, instead of being serialized again; string
+    arguments are decoded. Raises a ValueError if an argument is not valid
+    JSON, returns None if the array is not made of `{"name": ...,
+    "arguments": ...}` objects, or not valid JSON otherwise.
+    """
+    match = _ARRAY_START.match(text, pos)
+    if match is None:
+        return None
+    pos = match.end()
+    calls = []
+    while True:
+        match = _CALL_START.match(text, pos)
+        if match is None:
+            return None
+        name = match.group(1)
+        if "\\" in name:
+            name = json_backend.loads('"' + name + '"')
+        start = match.end()
+        arguments, pos = _JSON_DECODER.raw_decode(text, start)
+        match = _CALL_END.match(text, pos)
+        if match is None:
+            return None
+        calls.append((name, arguments if isinstance(arguments, str) else text[start:pos]))
+        pos = match.end()
+        if match.group(1) == "]":
+            break
+    if _TRAILING_WHITESPACE.match(text, pos) is None:
+        return None
+    return calls
+
+
 def _convert_completion_to_chat_function(
     completion_or_chunks: llama_types.CreateCompletionResponse,
     thinking: Optional[str] = None,
+    start: int = 0,
 ):
+    """Chat completion with the tool calls of the `<f>` response at `start`
+    of the completion text."""
     completion: llama_types.CreateCompletionResponse = completion_or_chunks  # type: ignore
     assert "usage" in completion
-    # tool_id = "call_" + "_0_" + tool_name + "_" + completion["id"]
     # TODO: Fix for legacy function calls
-    json_object = json.loads(completion["choices"][0]["text"][3:])
+    text = completion["choices"][0]["text"]
+    calls = _scan_tool_calls(text, start + len(FUNCTIONS_PREFIX))
+    if calls is None:
+        # Any other shape is parsed in full, and fails as it always has.
+        calls = [
+            (tool["name"], _maybe_json_dumps(tool["arguments"]))
+            for tool in json_backend.loads(text[start + len(FUNCTIONS_PREFIX):])
+        ]
 
+    completion_id = completion["id"]
     tool_calls = [
         {
-            "id": "call_"
-            + "_0_"
-            + tool["name"]
-            + "_"
-            + completion["id"]
-            + "_"
-            + str(i),
+            "id": _tool_call_id(name, completion_id, i),
             "type": "function",
             "function": {
-                "name": tool["name"],
-                "arguments": _maybe_json_dumps(tool["arguments"]),
+                "name": name,
+                "arguments": arguments,
             },
         }
-        for (i, tool) in enumerate(json_object)
+        for (i, (name, arguments)) in enumerate(calls)
     ]
 
-    json_object = json.loads(completion["choices"][0]["text"][3:])
-
     chat_completion: llama_types.CreateChatCompletionResponse = {
         "id": "chat" + completion["id"],
         "object": "chat.completion",
@@ -224,6 +991,85 @@ def _convert_completion_to_chat_function(
     return chat_completion
 
 
+def _convert_completion_chunks_to_chat_stream(
+    chunks: Iterator[llama_types.CreateCompletionStreamResponse],
+    on_tool_call: Optional[Callable[[ToolCall], None]] = None,
+) -> Iterator[llama_types.ChatCompletionChunk]:
+    """Stream `<c>` responses as content deltas and `<f>` responses as
+    OpenAI `tool_calls` deltas, the function name of each call arriving as
+    a single chunk followed by its argument fragments."""
+    parser = ToolCallStreamParser(on_tool_call=on_tool_call)
+    for i, chunk in enumerate(chunks):
+        if i == 0:
+            yield _chat_chunk(chunk, {"role": "assistant"})
+
+        choice = chunk["choices"][0]
+        logprobs = choice["logprobs"]
+        events = parser.feed(choice["text"])
+        if choice["finish_reason"] is not None:
+            events += parser.close()
+        for event in events:
+            if event.kind == "content":
+                delta = {"content": event.value}
+            elif event.kind == "tool_call":
+                delta = {
+                    "tool_calls": [
+                        {
+                            "index": event.index,
+                            "id": _tool_call_id(event.value, chunk["id"], event.index),
+                            "type": "function",
+                            "function": {
+                                "name": event.value,
+                                "arguments": "",
+                            },
+                        }
+                    ]
+                }
+            else:
+                delta = {
+                    "tool_calls": [
+                        {
+                            "index": event.index,
+                            "function": {"arguments": event.value},
+                        }
+                    ]
+                }
+            yield _chat_chunk(chunk, delta, logprobs=logprobs)
+            logprobs = None
+
+        if choice["finish_reason"] is not None:
+            RESPONSES.inc(1, "tool_call" if parser.has_tool_calls else "content")
+            yield _chat_chunk(
+                chunk,
+                {},
+                finish_reason=(
+                    "tool_calls" if parser.has_tool_calls else choice["finish_reason"]
+                ),
+            )
+
+
+def _chat_chunk(
+    chunk: llama_types.CreateCompletionStreamResponse,
+    delta: Dict[str, Any],
+    logprobs: Optional[llama_types.CompletionLogprobs] = None,
+    finish_reason: Optional[str] = None,
+) -> llama_types.ChatCompletionChunk:
+    return {
+        "id": "chat" + chunk["id"],
+        "model": chunk["model"],
+        "created": chunk["created"],
+        "object": "chat.completion.chunk",
+        "choices": [
+            {
+                "index": 0,
+                "delta": delta,
+                "logprobs": logprobs,
+                "finish_reason": finish_reason,
+            }
+        ],
+    }
+
+
 def _convert_text_completion_chunks_to_chat(
     chunks: Iterator[llama_types.CreateCompletionStreamResponse],
 ) -> Iterator[llama_types.ChatCompletionChunk]:
@@ -352,14 +1198,16 @@ def _convert_text_completion_chunks_to_chat(
         }
 
 
-def _separate_thinking_if_present(text):
-    tag = "</thinking>"
-    tag_position = text.find(tag)
+def _thinking_end(text: str) -> int:
+    """Offset of the response after the thinking block, 0 without one."""
+    tag_position = text.find(THINKING_END_TAG)
+    return tag_position + len(THINKING_END_TAG) if tag_position != -1 else 0
 
-    if tag_position != -1:
+
+def _separate_thinking_if_present(text):
+    end = _thinking_end(text)
+    if end:
         # Split the string into two parts
-        part1 = text[: tag_position + len(tag)]
-        part2 = text[tag_position + len(tag):]
-        return part2, part1
+        return text[end:], text[:end]
     else:
         return text, None
@@ -0,0 +1,221 @@
+"""Prompt tokens, prefill time and accuracy of each functions encoding
+(see encode_functions) for a tool set, to choose the server's
+`functions_encoding` knowing both what it saves and what it costs.
+
+TOOLS is a JSON file with a list of tools (or of functions) in the OpenAI
+format. EVAL is an optional JSONL file of requests, each with `messages`,
+optionally its own `tools`, and the `expected` response: a list of
+`{"name", "arguments"}` calls, or null when the model should answer with
+a message. Every request is run with each encoding at temperature 0 and
+the response is compared with `expected`.
+
+Usage: python -m empower_functions.encoding_report --model MODEL.gguf
+           --tools tools.json [--eval eval.jsonl] [--encodings indent compact minified]
+           [--n_ctx 8192] [--repeats 3]
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import llama_cpp
+
+from empower_functions.chat_handler import (
+    EmpowerFunctionsCompletionHandler,
+    _render_llama3_prompt,
+)
+from empower_functions.monkey_patch.app import _create_chat_completion_patched
+from empower_functions.prompt import FUNCTIONS_ENCODINGS, functions_block, prompt_messages
+
+_SAMPLE_MESSAGES = [{"role": "user", "content": "Hi"}]
+
+
+class EncodingReport(NamedTuple):
+    encoding: str
+    functions_tokens: int
+    prompt_tokens: int
+    prefill_seconds: float
+
+
+class EncodingAccuracy(NamedTuple):
+    encoding: str
+    requests: int
+    # Responses of the expected kind (message or tool calls).
+    kind: float
+    # Tool call responses calling the expected functions, in order.
+    names: float
+    # Tool call responses with the expected functions and arguments.
+    exact: float
+
+
+def _functions(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [tool["function"] if "function" in tool else tool for tool in tools]
+
+
+def _prefill_seconds(llama: llama_cpp.Llama, tokens: List[int], repeats: int) -> float:
+    seconds = []
+    for _ in range(repeats):
+        llama.reset()
+        start = time.perf_counter()
+        llama.eval(tokens)
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds)
+
+
+def encoding_report(
+    llama: llama_cpp.Llama,
+    functions: List[Dict[str, Any]],
+    encodings=FUNCTIONS_ENCODINGS,
+    repeats: int = 3,
+) -> List[EncodingReport]:
+    """Tokens of the Functions block and of a first prompt with a short
+    user message, and the time to prefill that prompt, for each encoding."""
+    reports = []
+    for encoding in encodings:
+        block = functions_block(functions, encoding)
+        prompt = _render_llama3_prompt(
+            prompt_messages(_SAMPLE_MESSAGES, functions, functions_encoding=encoding)
+        )
+        tokens = llama.tokenize(prompt.encode("utf-8"), special=True)
+        reports.append(
+            EncodingReport(
+                encoding=encoding,
+                functions_tokens=len(
+                    llama.tokenize(block.text.encode("utf-8"), add_bos=False)
+                ),
+                prompt_tokens=len(tokens),
+                prefill_seconds=(
+                    _prefill_seconds(llama, tokens, repeats)
+                    if len(tokens) <= llama.n_ctx()
+                    else float("nan")
+                ),
+            )
+        )
+    return reports
+
+
+def _calls(response: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    tool_calls = response["choices"][0]["message"].get("tool_calls")
+    if not tool_calls:
+        return None
+    calls = []
+    for tool_call in tool_calls:
+        try:
+            arguments = json.loads(tool_call["function"]["arguments"])
+        except ValueError:
+            arguments = None
+        calls.append({"name": tool_call["function"]["name"], "arguments": arguments})
+    return calls
+
+
+def encoding_accuracy(
+    llama: llama_cpp.Llama,
+    records: List[Dict[str, Any]],
+    tools: List[Dict[str, Any]],
+    encodings=FUNCTIONS_ENCODINGS,
+    max_tokens: int = 512,
+) -> List[EncodingAccuracy]:
+    """Accuracy of the responses to `records` with each encoding, see the
+    module docstring for their format."""
+    results = []
+    for encoding in encodings:
+        kind = names = exact = tool_call_records = 0
+        for record in records:
+            expected = record.get("expected")
+            try:
+                response = _create_chat_completion_patched(
+                    llama,
+                    messages=record["messages"],
+                    tools=record.get("tools", tools),
+                    tool_choice=record.get("tool_choice"),
+                    max_tokens=max_tokens,
+                    temperature=0,
+                    functions_encoding=encoding,
+                )
+                calls = _calls(response)
+            except Exception:  # noqa: BLE001
+                # Malformed responses count as wrong.
+                calls = []
+            if expected is None:
+                kind += calls is None
+                continue
+
+            tool_call_records += 1
+            kind += bool(calls)
+            if calls and [call["name"] for call in calls] == [call["name"] for call in expected]:
+                names += 1
+                exact += all(
+                    call["arguments"] == expected_call.get("arguments")
+                    for call, expected_call in zip(calls, expected)
+                )
+        results.append(
+            EncodingAccuracy(
+                encoding=encoding,
+                requests=len(records),
+                kind=kind / len(records) if records else float("nan"),
+                names=names / tool_call_records if tool_call_records else float("nan"),
+                exact=exact / tool_call_records if tool_call_records else float("nan"),
+            )
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--tools", type=str, required=True)
+    parser.add_argument("--eval", type=str, help="JSONL file of requests with the expected response.")
+    parser.add_argument(
+        "--encodings", nargs="+", choices=FUNCTIONS_ENCODINGS, default=list(FUNCTIONS_ENCODINGS)
+    )
+    parser.add_argument("--n_ctx", type=int, default=8192)
+    parser.add_argument("--n_gpu_layers", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3, help="Prefills timed per encoding.")
+    parser.add_argument("--max_tokens", type=int, default=512)
+    parser.add_argument("--tool_call_grammar", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.tools, "r") as f:
+        tools = json.load(f)
+    llama = llama_cpp.Llama(
+        model_path=args.model,
+        n_ctx=args.n_ctx,
+        n_gpu_layers=args.n_gpu_layers,
+        chat_handler=EmpowerFunctionsCompletionHandler(
+            fast_template=True, tool_call_grammar=args.tool_call_grammar
+        ),
+        verbose=False,
+    )
+
+    reports = encoding_report(llama, _functions(tools), args.encodings, args.repeats)
+    baseline = reports[0]
+    print(f"{'encoding':<10} {'functions tok':>14} {'prompt tok':>11} {'saved':>7} {'prefill ms':>11}")
+    for report in reports:
+        print(
+            f"{report.encoding:<10} {report.functions_tokens:14d} {report.prompt_tokens:11d} "
+            f"{1 - report.prompt_tokens / baseline.prompt_tokens:7.0%} "
+            f"{report.prefill_seconds * 1000:11.1f}"
+        )
+    if any(report.prompt_tokens > llama.n_ctx() for report in reports):
+        print("Prompts longer than n_ctx are not prefilled.", file=sys.stderr)
+
+    if args.eval is not None:
+        with open(args.eval, "r") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        print()
+        print(f"{'encoding':<10} {'requests':>9} {'kind':>7} {'names':>7} {'exact':>7}")
+        for accuracy in encoding_accuracy(
+            llama, records, tools, args.encodings, args.max_tokens
+        ):
+            print(
+                f"{accuracy.encoding:<10} {accuracy.requests:9d} {accuracy.kind:7.1%} "
+                f"{accuracy.names:7.1%} {accuracy.exact:7.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
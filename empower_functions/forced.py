@@ -0,0 +1,178 @@
+import ctypes
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+import llama_cpp
+import llama_cpp.llama as llama
+from llama_cpp.llama_speculative import LlamaDraftModel
+
+from empower_functions.scheduler import _copy_grammar
+
+
+class _Vocabulary(NamedTuple):
+    # Token of each byte, the candidates forced text is looked for with.
+    byte_tokens: npt.NDArray[np.intc]
+    eog_tokens: npt.NDArray[np.intc]
+    pieces: Dict[bytes, int]
+    max_piece_length: int
+
+
+_vocabularies: Dict[Tuple[str, int], Optional[_Vocabulary]] = {}
+_vocabularies_lock = threading.Lock()
+
+
+def _vocabulary(llama: llama.Llama) -> Optional[_Vocabulary]:
+    """The model's pieces, or None if some byte has no token of its own, as
+    forced text can then not be told from a single candidate."""
+    key = (llama.model_path, llama.n_vocab())
+    with _vocabularies_lock:
+        if key in _vocabularies:
+            return _vocabularies[key]
+
+    pieces: Dict[bytes, int] = {}
+    eog_tokens = []
+    for token in range(llama.n_vocab()):
+        if llama_cpp.llama_token_is_eog(llama._model.model, token):
+            eog_tokens.append(token)
+            continue
+        piece = llama._model.detokenize([token])
+        if piece:
+            pieces.setdefault(piece, token)
+
+    vocabulary = None
+    byte_tokens = [pieces.get(bytes([byte])) for byte in range(256)]
+    if all(token is not None for token in byte_tokens):
+        vocabulary = _Vocabulary(
+            byte_tokens=np.array(byte_tokens, dtype=np.intc),
+            eog_tokens=np.array(eog_tokens, dtype=np.intc),
+            pieces=pieces,
+            max_piece_length=max(map(len, pieces)),
+        )
+    with _vocabularies_lock:
+        _vocabularies[key] = vocabulary
+    return vocabulary
+
+
+class ForcedTokens(LlamaDraftModel):
+    """Appends the text a grammar leaves as the only legal continuation,
+    e.g. the rest of a function name once its prefix is unique or the
+    `"arguments"` key, to the token just sampled, so that it is evaluated
+    in the same batch instead of one decode step per token.
+
+    The forced text is found byte by byte on a copy of the grammar state
+    and tokenized greedily with the longest pieces of the vocabulary. Its
+    last token is left to the model, which may write it merged with the
+    text that follows.
+
+    Installed by the handler as the Llama's draft model for one
+    generation, in front of the configured draft model which it calls when
+    nothing is forced. The Llama must compute the logits of every position
+    (logits_all, as with any draft model): the model's own logits verify
+    the forced tokens like a draft, so the output is the same as without
+    them. Only the decode steps are saved, not the text: a forced token the
+    model would have written differently, e.g. split into other pieces, is
+    rejected and generated normally.
+    """
+
+    def __init__(
+        self,
+        llama: llama.Llama,
+        grammar: llama.LlamaGrammar,
+        n_prompt_tokens: int,
+        draft_model: Optional[LlamaDraftModel] = None,
+        max_forced_bytes: int = 256,
+    ):
+        self.llama = llama
+        self.draft_model = draft_model
+        self.max_forced_bytes = max_forced_bytes
+        self.forced = 0
+        self._vocabulary = _vocabulary(llama)
+        self._grammar = _copy_grammar(grammar)
+        self._n_accepted = n_prompt_tokens
+        self._last: Optional[Tuple[int, npt.NDArray[np.intc]]] = None
+
+        if self._vocabulary is not None:
+            candidate_ids = np.concatenate(
+                [self._vocabulary.byte_tokens, self._vocabulary.eog_tokens]
+            )
+            self._candidates_data = np.zeros(
+                len(candidate_ids),
+                dtype=np.dtype(
+                    [("id", np.intc), ("logit", np.single), ("p", np.single)], align=True
+                ),
+            )
+            self._candidate_ids = candidate_ids
+            self._candidates = llama_cpp.llama_token_data_array(
+                data=self._candidates_data.ctypes.data_as(llama_cpp.llama_token_data_p),
+                size=len(candidate_ids),
+                sorted=False,
+            )
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        if self._last is not None:
+            start, proposal = self._last
+            generated = input_ids[start:start + len(proposal)]
+            mismatch = np.nonzero(generated != proposal[:len(generated)])[0]
+            self.forced += int(mismatch[0]) if len(mismatch) else len(generated)
+            self._last = None
+
+        for token in input_ids[self._n_accepted:].tolist():
+            llama_cpp.llama_grammar_accept_token(
+                self.llama._ctx.ctx, self._grammar.grammar, token
+            )
+        self._n_accepted = len(input_ids)
+
+        forced = self._tokenize(self._forced_text())[:-1]
+        if not forced:
+            if self.draft_model is None:
+                return np.array([], dtype=np.intc)
+            return self.draft_model(input_ids, **kwargs)
+
+        draft = np.array(forced, dtype=np.intc)
+        self._last = (len(input_ids), draft)
+        return draft
+
+    def _forced_text(self) -> bytes:
+        if self._vocabulary is None:
+            return b""
+        text = bytearray()
+        grammar = llama_cpp.llama_grammar_copy(self._grammar.grammar)
+        try:
+            while len(text) < self.max_forced_bytes:
+                self._candidates_data["id"] = self._candidate_ids
+                self._candidates_data["logit"] = 0.0
+                self._candidates.size = len(self._candidate_ids)
+                llama_cpp.llama_sample_grammar(
+                    self.llama._ctx.ctx, ctypes.byref(self._candidates), grammar
+                )
+                legal = np.flatnonzero(np.isfinite(self._candidates_data["logit"]))
+                if len(legal) != 1 or legal[0] >= 256:
+                    break
+                text.append(int(legal[0]))
+                llama_cpp.llama_grammar_accept_token(
+                    self.llama._ctx.ctx, grammar, int(self._candidate_ids[legal[0]])
+                )
+        finally:
+            llama_cpp.llama_grammar_free(grammar)
+        return bytes(text)
+
+    def _tokenize(self, text: bytes) -> List[int]:
+        if not text:
+            return []
+        vocabulary = self._vocabulary
+        assert vocabulary is not None
+        tokens = []
+        start = 0
+        while start < len(text):
+            for end in range(min(len(text), start + vocabulary.max_piece_length), start, -1):
+                token = vocabulary.pieces.get(text[start:end])
+                if token is not None:
+                    tokens.append(token)
+                    start = end
+                    break
+        return tokens
@@ -0,0 +1,181 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import llama_cpp
+from llama_cpp.llama_grammar import BuiltinRule, DOTALL, SchemaConverter, _build_repetition
+
+from empower_functions.prompt import functions_fingerprint
+
+# The model is trained on `json.dumps(..., indent=2)` output, so unlike the
+# single optional space llama.cpp uses by default, allow a newline followed by
+# indentation between JSON tokens.
+TOOL_CALL_SPACE_RULE = '( " " | "\\n" ' + \
+    _build_repetition('" "', 0, 24, item_rule_is_literal=True) + ' )?'
+
+# llama.cpp's string characters include control characters, which JSON
+# strings must escape: json.loads rejects arguments containing them.
+TOOL_CALL_CHAR_RULE = BuiltinRule(
+    r'[^"\\\x7F\x00-\x1F] | [\\] (["\\bfnrt/] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F])',
+    [],
+)
+
+
+class _ToolCallSchemaConverter(SchemaConverter):
+    def __init__(self):
+        super().__init__(
+            prop_order={"name": 0, "arguments": 1},
+            allow_fetch=False,
+            dotall=False,
+            raw_pattern=False,
+        )
+        self._rules["space"] = TOOL_CALL_SPACE_RULE
+
+    def _add_primitive(self, name, rule):
+        if name == "char":
+            rule = TOOL_CALL_CHAR_RULE
+        return super()._add_primitive(name, rule)
+
+    def _generate_constant_rule(self, value):
+        # Constants and enum values may be followed by a line break before
+        # the closing brace, like every other value.
+        return super()._generate_constant_rule(value) + " space"
+
+
+def tool_calls_schema(functions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """JSON schema of the array following `<f>`: one or more calls to the
+    known functions, each with schema-valid arguments."""
+    return {
+        "type": "array",
+        "minItems": 1,
+        "items": {
+            "anyOf": [
+                {
+                    "type": "object",
+                    "properties": {
+                        "name": {"const": function["name"]},
+                        "arguments": function["parameters"],
+                    },
+                    "required": ["name", "arguments"],
+                }
+                for function in functions
+            ]
+        },
+    }
+
+
+def tool_call_gbnf(functions: List[Dict[str, Any]], include_thinking: bool = False) -> str:
+    """GBNF grammar for the model response: `<c>` followed by free text, or
+    `<f>` followed by a valid tool call array, optionally preceded by a
+    `<thinking>` block."""
+    converter = _ToolCallSchemaConverter()
+    schema = converter.resolve_refs(tool_calls_schema(functions), "tools")
+    calls = converter.visit(schema, "tool-calls")
+
+    response = f'"<c>" {DOTALL}* | "<f>" {calls}'
+    if include_thinking:
+        root = f'"<thinking>" [^<]* "</thinking>" ( {response} )'
+    else:
+        root = response
+    return f"root ::= {root}\n" + converter.format_grammar()
+
+
+def tool_call_continuation_gbnf(
+    functions: List[Dict[str, Any]], function_name: Optional[str] = None
+) -> str:
+    """GBNF grammar for the rest of a response prefilled for a forced tool
+    choice (see tool_choice_prefill): the tool call array following `<f>`,
+    or the arguments of `function_name` and the end of its call."""
+    converter = _ToolCallSchemaConverter()
+    if function_name is None:
+        schema = converter.resolve_refs(tool_calls_schema(functions), "tools")
+        root = converter.visit(schema, "tool-calls")
+    else:
+        function = next(f for f in functions if f["name"] == function_name)
+        schema = converter.resolve_refs(function["parameters"], "arguments")
+        root = converter.visit(schema, "arguments") + ' "}" space "]" space'
+    return f"root ::= {root}\n" + converter.format_grammar()
+
+
+def routing_gbnf(
+    functions: List[Dict[str, Any]], include_thinking: bool = False, prefilled: bool = False
+) -> str:
+    """GBNF grammar for the start of the model response, up to the decision
+    between `<c>` and `<f>` and, for `<f>`, the name of the first function
+    called, which is one of `functions`. `prefilled` when the response was
+    prefilled with `<f>` (see tool_choice_prefill)."""
+    converter = _ToolCallSchemaConverter()
+    call = '"[" space "{" space ' + converter._format_literal('"name"') + ' space ":" space'
+    if functions:
+        call += ' ( ' + ' | '.join(
+            converter._format_literal(json.dumps(function["name"]))
+            for function in functions
+        ) + ' )'
+    if prefilled:
+        root = call
+    elif not functions:
+        root = '"<c>"'
+    else:
+        root = f'"<c>" | "<f>" {call}'
+    if include_thinking and not prefilled:
+        root = f'"<thinking>" [^<]* "</thinking>" ( {root} )'
+    return f"root ::= {root}\n" + converter.format_grammar()
+
+
+class ToolCallGrammarCache:
+    """Compiled tool call grammars keyed by tool-set fingerprint.
+
+    A LlamaGrammar holds parse state while sampling, so a cache must not be
+    shared by models generating concurrently; the handler owns one per model.
+    """
+
+    def __init__(self, maxsize: int = 32, verbose: bool = False):
+        self.maxsize = maxsize
+        self.verbose = verbose
+        self._grammars: 'OrderedDict[tuple, llama_cpp.LlamaGrammar]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self, functions: List[Dict[str, Any]], include_thinking: bool = False
+    ) -> llama_cpp.LlamaGrammar:
+        return self._get(
+            (functions_fingerprint(functions), include_thinking),
+            lambda: tool_call_gbnf(functions, include_thinking),
+        )
+
+    def get_continuation(
+        self, functions: List[Dict[str, Any]], function_name: Optional[str] = None
+    ) -> llama_cpp.LlamaGrammar:
+        """Grammar of a response prefilled for a forced tool choice, see
+        tool_call_continuation_gbnf."""
+        return self._get(
+            (functions_fingerprint(functions), "continuation", function_name),
+            lambda: tool_call_continuation_gbnf(functions, function_name),
+        )
+
+    def get_routing(
+        self,
+        functions: List[Dict[str, Any]],
+        include_thinking: bool = False,
+        prefilled: bool = False,
+    ) -> llama_cpp.LlamaGrammar:
+        """Grammar of a routing response, see routing_gbnf."""
+        return self._get(
+            (functions_fingerprint(functions), "routing", include_thinking, prefilled),
+            lambda: routing_gbnf(functions, include_thinking, prefilled),
+        )
+
+    def _get(self, key: tuple, gbnf: Callable[[], str]) -> llama_cpp.LlamaGrammar:
+        with self._lock:
+            grammar = self._grammars.get(key)
+            if grammar is not None:
+                self._grammars.move_to_end(key)
+                return grammar
+
+        grammar = llama_cpp.LlamaGrammar.from_string(gbnf(), verbose=self.verbose)
+        with self._lock:
+            self._grammars[key] = grammar
+            while len(self._grammars) > self.maxsize:
+                self._grammars.popitem(last=False)
+        return grammar
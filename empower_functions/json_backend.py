@@ -0,0 +1,132 @@
+import codecs
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKENDS = ("auto", "orjson", "json")
+
+_backend = "orjson" if orjson is not None else "json"
+
+# orjson only writes floats differently from json, which uses repr, when it
+# writes them with an exponent (1e16 for 1e+16, 1e-7 for 1e-07) or below
+# 1e-4 as decimals (0.00001 for 1e-05). Output is mapped through this
+# table, so that looking for these forms is a few substring searches.
+_NUMBER_FORMS = bytes.maketrans(
+    bytes(range(256)),
+    bytes(b if b in b"0.-e" else b"1"[0] if b in b"123456789" else b" "[0] for b in range(256)),
+)
+_FLOAT_DIFFERENCES = (b"0e0", b"0e1", b"1e0", b"1e1", b"0e-", b"1e-", b"0.0000")
+# orjson parses integers over 64 bits as floats.
+_DIGITS = bytes.maketrans(
+    bytes(range(256)), bytes(b"0"[0] if b in b"0123456789" else b" "[0] for b in range(256))
+)
+_LONG_NUMBER = b"0" * 19
+# Types json can not serialize, or serializes as their base type, make
+# orjson raise.
+_DUMPS_OPTIONS = (
+    orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS
+    if orjson is not None
+    else 0
+)
+
+
+def use(name: str):
+    """Select the JSON backend of the process: "orjson", "json" (the
+    standard library) or "auto", orjson when it is installed."""
+    global _backend
+    if name not in JSON_BACKENDS:
+        raise ValueError(f'Unknown JSON backend "{name}", must be one of {", ".join(JSON_BACKENDS)}')
+    if name == "orjson" and orjson is None:
+        raise ValueError('JSON backend "orjson" is not installed, `pip install orjson`')
+    _backend = name if name != "auto" else ("orjson" if orjson is not None else "json")
+
+
+def backend() -> str:
+    return _backend
+
+
+def loads(text) -> Any:
+    """json.loads(text). orjson rejects a few documents json accepts, such as
+    NaN and lone surrogates, they are parsed by json (which raises the errors
+    of invalid documents), as are documents with integers that may not fit
+    in 64 bits."""
+    if _backend == "orjson" and isinstance(text, str):
+        encoded = text.encode("utf-8", "surrogatepass")
+        if _LONG_NUMBER not in encoded.translate(_DIGITS):
+            try:
+                return orjson.loads(encoded)
+            except orjson.JSONDecodeError:
+                pass
+    return json.loads(text)
+
+
+def dumps(value: Any, indent: bool = False, ensure_ascii: bool = False) -> str:
+    """The exact text of json.dumps(value, indent=2) with `indent`, else of
+    json.dumps(value, separators=(",", ":")), with either backend, so that
+    prompts do not depend on it.
+
+    orjson output is used when it can be checked to be the same: it has no
+    floats written differently, and when it has nulls it parses back to
+    `value` (orjson writes NaN and infinities as null). With `ensure_ascii`,
+    the characters json escapes are escaped afterwards. Otherwise json
+    writes it.
+    """
+    if _backend == "orjson":
+        option = _DUMPS_OPTIONS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            encoded = orjson.dumps(value, option=option)
+        except orjson.JSONEncodeError:
+            encoded = None
+        if encoded is not None and _same_as_json(encoded, value):
+            text = encoded.decode("utf-8")
+            if ensure_ascii:
+                if not text.isascii():
+                    text = text.encode("ascii", "json_escape").decode("ascii")
+                if "\x7f" in text:
+                    text = text.replace("\x7f", "\\u007f")
+            return text
+    return json.dumps(
+        value,
+        indent=2 if indent else None,
+        separators=None if indent else (",", ":"),
+        ensure_ascii=ensure_ascii,
+    )
+
+
+def dumps_response(value: Any) -> str:
+    """JSON of a response or a streamed chunk, compact with orjson, as
+    json.dumps(value) with json."""
+    if _backend == "orjson":
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(value)
+
+
+def _same_as_json(encoded: bytes, value: Any) -> bool:
+    forms = encoded.translate(_NUMBER_FORMS)
+    if any(form in forms for form in _FLOAT_DIFFERENCES):
+        return False
+    return b"null" not in encoded or orjson.loads(encoded) == value
+
+
+def _escape(error: UnicodeEncodeError):
+    """Escapes characters as json does with ensure_ascii, astral ones as
+    surrogate pairs."""
+    escaped = []
+    for char in error.object[error.start:error.end]:
+        code = ord(char)
+        if code < 0x10000:
+            escaped.append("\\u{0:04x}".format(code))
+        else:
+            code -= 0x10000
+            escaped.append("\\u{0:04x}\\u{1:04x}".format(0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF)))
+    return "".join(escaped), error.end
+
+
+codecs.register_error("json_escape", _escape)
@@ -0,0 +1,268 @@
+import bisect
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Seconds, from tokenizing a message to generating a long response.
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500, 1000)
+
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic count, one per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Counters without labels are exported from the start, as 0.
+        self._values: Dict[Tuple[str, ...], float] = {} if self.labelnames else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labelvalues: str):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{_labels(self.labelnames, labels)} {_format(value)}"
+            for labels, value in values
+        ]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, e.g. the size of a cache, one per
+    combination of label values."""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, *labelvalues: str):
+        self.inc(-amount, *labelvalues)
+
+    def set(self, value: float, *labelvalues: str):
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram:
+    """Counts of observations per bucket, their sum and count, one set per
+    combination of label values. Observing is a bisect and three additions
+    under a lock; cumulative counts are only computed when rendering."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: bucket counts (the last one is +Inf), sum.
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labelvalues)
+            if values is None:
+                values = self._values[labelvalues] = ([0] * (len(self.buckets) + 1), [0.0])
+            values[0][i] += 1
+            values[1][0] += value
+
+    def time(self, *labelvalues: str) -> "_Timer":
+        """Context manager observing the seconds spent in its block."""
+        return _Timer(self, labelvalues)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (labels, (list(counts), total[0]))
+                for labels, (counts, total) in self._values.items()
+            )
+        lines = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format(bound)
+                bucket_labels = _labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_format(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labelvalues", "_start")
+
+    def __init__(self, histogram: Histogram, labelvalues: Tuple[str, ...]):
+        self._histogram = histogram
+        self._labelvalues = labelvalues
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labelvalues)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    "empower_phase_seconds",
+    "Seconds spent in each phase of a chat completion: fit_context, "
+    "retrieval, prompt (prompt_messages), render, tokenize, queue_wait, "
+    "prefill, decode, convert and sse.",
+    labelnames=("phase",),
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "empower_request_seconds",
+    "Seconds from receiving a chat completion request until its response "
+    "is returned, or its last chunk is sent when streaming.",
+    labelnames=("stream",),
+))
+PROMPT_TOKENS = REGISTRY.register(Counter(
+    "empower_prompt_tokens_total", "Prompt tokens of chat completions."
+))
+CACHED_PROMPT_TOKENS = REGISTRY.register(Counter(
+    "empower_cached_prompt_tokens_total",
+    "Prompt tokens reused from the KV cache instead of being prefilled.",
+))
+COMPLETION_TOKENS = REGISTRY.register(Counter(
+    "empower_completion_tokens_total", "Generated tokens of chat completions."
+))
+DECODE_TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "empower_decode_tokens_per_second",
+    "Generated tokens per second of each chat completion, after its first token.",
+    buckets=TOKENS_PER_SECOND_BUCKETS,
+))
+RESPONSES = REGISTRY.register(Counter(
+    "empower_responses_total",
+    "Chat completions by response type: content (<c>), tool_call (<f>) or route.",
+    labelnames=("type",),
+))
+FUNCTIONS_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "empower_functions_cache_lookups_total",
+    "Lookups of the serialized Functions blocks by result: hit or miss.",
+    labelnames=("result",),
+))
+FUNCTIONS_CACHE_ENTRIES = REGISTRY.register(Gauge(
+    "empower_functions_cache_entries", "Serialized Functions blocks cached."
+))
+PREFIX_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "empower_prefix_cache_lookups_total",
+    "Lookups of the pinned first-turn prefix states by result: hit or miss.",
+    labelnames=("result",),
+))
+PREFIX_CACHE_RESTORED_TOKENS = REGISTRY.register(Counter(
+    "empower_prefix_cache_restored_tokens_total",
+    "Prefix tokens restored from a pinned state instead of being prefilled.",
+))
+PREFIX_CACHE_BYTES = REGISTRY.register(Gauge(
+    "empower_prefix_cache_bytes", "Size of the pinned first-turn prefix states."
+))
+SESSION_STORE_LOOKUPS = REGISTRY.register(Counter(
+    "empower_session_store_lookups_total",
+    "Lookups of saved conversation states by result: hit or miss.",
+    labelnames=("result",),
+))
+SESSION_STORE_RESTORED_TOKENS = REGISTRY.register(Counter(
+    "empower_session_store_restored_tokens_total",
+    "Prompt tokens restored from the session store instead of being prefilled.",
+))
+SESSION_STORE_EVICTIONS = REGISTRY.register(Counter(
+    "empower_session_store_evictions_total",
+    "Conversation states removed from the session store, expired, replaced "
+    "by a later turn or over its size limit.",
+))
+SESSION_STORE_BYTES = REGISTRY.register(Gauge(
+    "empower_session_store_bytes", "Size of the saved conversation states."
+))
+JSON_PARSE_FAILURES = REGISTRY.register(Counter(
+    "empower_json_parse_failures_total",
+    "<f> responses whose tool calls are not valid JSON.",
+))
+
+
+class GenerationClock:
+    """Logits processor timing a generation: it is called once per sampled
+    token, so its first call ends the prefill and the following ones are
+    the decode steps."""
+
+    __slots__ = ("start", "first_token", "last_token", "calls")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.last_token: Optional[float] = None
+        self.calls = 0
+
+    def __call__(self, input_ids, scores):
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        self.last_token = now
+        self.calls += 1
+        return scores
+
+    def observe(self, completion_tokens: int, prompt_tokens: int, cached_tokens: int):
+        """Record the prefill and decode phases and the token counters."""
+        PROMPT_TOKENS.inc(prompt_tokens)
+        CACHED_PROMPT_TOKENS.inc(cached_tokens)
+        COMPLETION_TOKENS.inc(completion_tokens)
+        if self.first_token is None:
+            return
+        end = time.perf_counter()
+        PHASE_SECONDS.observe(self.first_token - self.start, "prefill")
+        PHASE_SECONDS.observe(end - self.first_token, "decode")
+        if completion_tokens > 1 and end > self.first_token:
+            DECODE_TOKENS_PER_SECOND.observe((completion_tokens - 1) / (end - self.first_token))
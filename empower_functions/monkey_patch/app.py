@@ -1,36 +1,58 @@
 from __future__ import annotations
+from functools import partial
 from typing import Any, Dict, Iterator, List, Optional, Union
 
+import itertools
+import time
+
 import anyio
-from fastapi.concurrency import run_in_threadpool
+from anyio.streams.memory import MemoryObjectSendStream
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 import llama_cpp
 from llama_cpp.server.model import LlamaProxy
 from llama_cpp.server.app import (
     get_llama_proxy,
-    create_chat_completion as _create_chat_completion,
     router,
     authenticate,
     openai_v1_tag,
     _logit_bias_tokens_to_input_ids,
-    get_event_publisher,
+    get_server_settings,
+    llama_outer_lock,
     _ping_message_factory
 )
 from llama_cpp.server.types import (
     ChatCompletionRequestMessage,
 )
 
-import llama_cpp
-
-from fastapi import Depends, Request, Body
+from fastapi import Depends, Request, Body, Response
+from fastapi.responses import JSONResponse
 
-from llama_cpp.server.model import (
-    LlamaProxy,
-)
 from sse_starlette import EventSourceResponse
 from .types import (
     CreateChatCompletionRequestPatched,
 )
 import llama_cpp.llama_chat_format as llama_chat_format
+import llama_cpp.server.app as llama_server_app
+from empower_functions import json_backend
+from empower_functions.metrics import PHASE_SECONDS, REGISTRY, REQUEST_SECONDS
+from empower_functions.pool import LlamaPool
+from empower_functions.workers import WorkerPool
+
+# Set by patch_app(concurrent=True) when the model batches concurrent
+# requests itself, see get_llama_proxy_concurrent.
+_concurrent = False
+# Set by patch_app(workers=...) to serve chat completions in worker processes.
+_workers: Optional[WorkerPool] = None
+
+
+def get_llama_proxy_concurrent():
+    # get_llama_proxy holds a global lock for the whole request, so requests
+    # are served one at a time. A model with a BatchScheduler decodes
+    # concurrent requests together and does not need it.
+    if _concurrent:
+        yield llama_server_app._llama_proxy
+    else:
+        yield from get_llama_proxy()
 
 
 def _create_chat_completion_patched(
@@ -104,6 +126,93 @@ def _create_chat_completion_patched(
     )
 
 
+def _chat_completion_kwargs(
+    llama: llama_cpp.Llama, body: CreateChatCompletionRequestPatched
+) -> Dict[str, Any]:
+    exclude = {
+        "n",
+        "logit_bias_type",
+        "user",
+        "min_tokens",
+    }
+    kwargs = body.model_dump(exclude=exclude)
+    if body.logit_bias is not None:
+        kwargs["logit_bias"] = (
+            _logit_bias_tokens_to_input_ids(llama, body.logit_bias)
+            if body.logit_bias_type == "tokens"
+            else body.logit_bias
+        )
+
+    if body.grammar is not None:
+        kwargs["grammar"] = llama_cpp.LlamaGrammar.from_string(body.grammar)
+
+    if body.min_tokens > 0:
+        _min_tokens_logits_processor = llama_cpp.LogitsProcessorList(
+            [llama_cpp.MinTokensLogitsProcessor(
+                body.min_tokens, llama.token_eos())]
+        )
+        if "logits_processor" not in kwargs:
+            kwargs["logits_processor"] = _min_tokens_logits_processor
+        else:
+            kwargs["logits_processor"].extend(_min_tokens_logits_processor)
+    return kwargs
+
+
+async def _create_chat_completion_in_worker(
+    request: Request, body: CreateChatCompletionRequestPatched
+):
+    # The worker returns the response already JSON encoded.
+    response = await run_in_threadpool(
+        _workers.create_chat_completion, body.model_dump()
+    )
+    if isinstance(response, str):
+        return Response(content=response, media_type="application/json")
+
+    send_chan, recv_chan = anyio.create_memory_object_stream(10)
+    return EventSourceResponse(
+        recv_chan,
+        data_sender_callable=partial(  # type: ignore
+            _publish_encoded_events,
+            request=request,
+            inner_send_chan=send_chan,
+            iterator=response,
+        ),
+        sep="\n",
+        ping_message_factory=_ping_message_factory,
+    )
+
+
+async def _publish_encoded_events(
+    request: Request,
+    inner_send_chan: MemoryObjectSendStream,
+    iterator: Iterator[str],
+    interrupt: bool = False,
+):
+    # Like get_event_publisher, for chunks that are already JSON encoded.
+    # With `interrupt`, the stream stops when another request waits for the
+    # model and the server settings allow interrupting requests.
+    async with inner_send_chan:
+        try:
+            async for data in iterate_in_threadpool(iterator):
+                await inner_send_chan.send(dict(data=data))
+                if await request.is_disconnected():
+                    raise anyio.get_cancelled_exc_class()()
+                if (
+                    interrupt
+                    and next(get_server_settings()).interrupt_requests
+                    and llama_outer_lock.locked()
+                ):
+                    await inner_send_chan.send(dict(data="[DONE]"))
+                    raise anyio.get_cancelled_exc_class()()
+            await inner_send_chan.send(dict(data="[DONE]"))
+        except anyio.get_cancelled_exc_class() as e:
+            # Stops generation in the worker.
+            await run_in_threadpool(iterator.close)
+            with anyio.move_on_after(1, shield=True):
+                print(f"Disconnected from client (via refresh/close) {request.client}")
+                raise e
+
+
 @router.post(
     "/v1/chat/completions",
     summary="Chat",
@@ -140,40 +249,28 @@ def _create_chat_completion_patched(
 async def create_chat_completion(
     request: Request,
     body: CreateChatCompletionRequestPatched = Body(),
-    llama_proxy: LlamaProxy = Depends(get_llama_proxy),
+    llama_proxy: LlamaProxy = Depends(get_llama_proxy_concurrent),
 ):
-    exclude = {
-        "n",
-        "logit_bias_type",
-        "user",
-        "min_tokens",
-    }
-    kwargs = body.model_dump(exclude=exclude)
-    llama = llama_proxy(body.model)
-    if body.logit_bias is not None:
-        kwargs["logit_bias"] = (
-            _logit_bias_tokens_to_input_ids(llama, body.logit_bias)
-            if body.logit_bias_type == "tokens"
-            else body.logit_bias
-        )
-
-    if body.grammar is not None:
-        kwargs["grammar"] = llama_cpp.LlamaGrammar.from_string(body.grammar)
-
-    if body.min_tokens > 0:
-        _min_tokens_logits_processor = llama_cpp.LogitsProcessorList(
-            [llama_cpp.MinTokensLogitsProcessor(
-                body.min_tokens, llama.token_eos())]
-        )
-        if "logits_processor" not in kwargs:
-            kwargs["logits_processor"] = _min_tokens_logits_processor
-        else:
-            kwargs["logits_processor"].extend(_min_tokens_logits_processor)
+    start = time.perf_counter()
+    if _workers is not None:
+        return await _create_chat_completion_in_worker(request, body)
 
-    kwargs["llama"] = llama
+    llama = llama_proxy(body.model)
+    kwargs = _chat_completion_kwargs(llama, body)
+    create_chat_completion = _create_chat_completion_patched
+    if isinstance(llama, LlamaPool):
+        # Run on the least-loaded replica, which is passed as `llama`.
+        create_chat_completion = partial(llama.run, _create_chat_completion_patched)
+    else:
+        kwargs["llama"] = llama
     iterator_or_completion: Union[
         llama_cpp.ChatCompletion, Iterator[llama_cpp.ChatCompletionChunk]
-    ] = await run_in_threadpool(_create_chat_completion_patched, **kwargs)
+    ] = await run_in_threadpool(create_chat_completion, **kwargs)
+
+    if body.route:
+        # A routing decision, not a chat completion.
+        REQUEST_SECONDS.observe(time.perf_counter() - start, "false")
+        return JSONResponse(iterator_or_completion)
 
     if isinstance(iterator_or_completion, Iterator):
         # EAFP: It's easier to ask for forgiveness than permission
@@ -181,28 +278,80 @@ async def create_chat_completion(
 
         # If no exception was raised from first_response, we can assume that
         # the iterator is valid and we can use it to stream the response.
-        def iterator() -> Iterator[llama_cpp.ChatCompletionChunk]:
-            yield first_response
-            yield from iterator_or_completion
+        def iterator() -> Iterator[str]:
+            # Time spent between chunks outside of generation is encoding
+            # them and the publisher sending them.
+            sse = 0.0
+            try:
+                for chunk in itertools.chain((first_response,), iterator_or_completion):
+                    yielded = time.perf_counter()
+                    yield json_backend.dumps_response(chunk)
+                    sse += time.perf_counter() - yielded
+            finally:
+                PHASE_SECONDS.observe(sse, "sse")
+                REQUEST_SECONDS.observe(time.perf_counter() - start, "true")
 
         send_chan, recv_chan = anyio.create_memory_object_stream(10)
         return EventSourceResponse(
             recv_chan,
             data_sender_callable=partial(  # type: ignore
-                get_event_publisher,
+                _publish_encoded_events,
                 request=request,
                 inner_send_chan=send_chan,
                 iterator=iterator(),
+                interrupt=True,
             ),
             sep="\n",
             ping_message_factory=_ping_message_factory,
         )
     else:
-        return iterator_or_completion
-    # return await _create_chat_completion(request, body, llama_proxy)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, "false")
+        # Encoded as the worker processes do, without validating the
+        # completion against the response model again.
+        return Response(
+            content=json_backend.dumps_response(iterator_or_completion),
+            media_type="application/json",
+        )
+
+
+@router.get(
+    "/v1/pool",
+    summary="Replica pool",
+    dependencies=[Depends(authenticate)],
+)
+async def get_pool():
+    """In-flight and queued requests of each replica or worker process of
+    the current model, an empty list when there is a single instance."""
+    llama_proxy = llama_server_app._llama_proxy
+    model = _workers if _workers is not None else (
+        llama_proxy._current_model if llama_proxy is not None else None
+    )
+    return {
+        "model": llama_proxy._current_model_alias if llama_proxy is not None else None,
+        "replicas": [
+            stats._asdict() for stats in model.stats()
+        ] if isinstance(model, (LlamaPool, WorkerPool)) else [],
+    }
+
+
+@router.get(
+    "/metrics",
+    summary="Metrics",
+    dependencies=[Depends(authenticate)],
+)
+async def get_metrics():
+    """Latency of each phase of chat completions, token counters and
+    response types in the Prometheus text format. With n_workers, only the
+    request and sse timings of the server process are recorded."""
+    return Response(
+        content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
-def patch_app():
+def patch_app(concurrent: bool = False, workers: Optional[WorkerPool] = None):
+    global _concurrent, _workers
+    _concurrent = concurrent or workers is not None
+    _workers = workers
     for route in router.routes:
         if route.name == "create_chat_completion":
             router.routes.remove(route)
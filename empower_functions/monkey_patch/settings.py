@@ -0,0 +1,99 @@
+from typing import List, Literal, Optional
+
+from pydantic import Field
+from llama_cpp.server.settings import ModelSettings, ServerSettings
+
+
+class EmpowerModelSettings(ModelSettings):
+    draft_model: Optional[str] = Field(
+        default=None,
+        description="Method to use for speculative decoding. One of (prompt-lookup-decoding, tool-call). tool-call drafts the `<f>` scaffolding of the request's functions (names, property keys) and n-grams of the user message, only with the empower-functions chat format.",
+    )
+    prefix_cache_size: int = Field(
+        default=0,
+        description="Bytes of pinned KV state for the shared system instruction + functions prefix of the first user turn, keyed by tool set. 0 disables it. Only used with the empower-functions chat format.",
+    )
+    tool_call_grammar: bool = Field(
+        default=False,
+        description="Constrain responses with a grammar generated from the tool schemas so that tool calls are always valid JSON with known function names. Only used with the empower-functions chat format.",
+    )
+    forced_tokens: bool = Field(
+        default=False,
+        description="Append the text the grammar leaves as the only legal continuation (e.g. function names and property keys) without a decode step per token. The model's logits verify the forced tokens, so the output does not change; enables logits_all. Requires tool_call_grammar or a grammar in the request, not used with n_parallel > 1.",
+    )
+    tool_retrieval_top_k: int = Field(
+        default=0,
+        ge=0,
+        description="Only put this many functions most relevant to the last user message in the prompt (plus those forced by tool_choice or already called in the conversation), so that large tool catalogs fit in the context. Functions selected for a session_id stay selected for its later turns while within this limit, the least recently selected being dropped first; without one the selection may change every turn, which changes the prompt prefix and misses the prefix and session caches. 0 prompts every function. Only used with the empower-functions chat format.",
+    )
+    tool_retrieval_embedding_model: Optional[str] = Field(
+        default=None,
+        description="Path of a GGUF model whose embeddings rank the functions for tool_retrieval_top_k. Functions are ranked with BM25 over their names and descriptions when not set.",
+    )
+    functions_encoding: Literal["indent", "compact", "minified"] = Field(
+        default="indent",
+        description="How function definitions are written in the prompt: indent (indent=2, the format the model was trained with), compact (no whitespace) or minified (no whitespace, descriptions cut to their first sentence). Fewer prompt tokens may cost accuracy, compare them with python -m empower_functions.encoding_report. Only used with the empower-functions chat format.",
+    )
+    fit_context: bool = Field(
+        default=False,
+        description="Cut the history of conversations that would not fit in the context instead of failing: earlier tool results are compacted (long arrays and strings cut), then the oldest messages dropped, keeping the system message, the functions and the latest turns. Only used with the empower-functions chat format.",
+    )
+    reserve_tokens: int = Field(
+        default=512,
+        ge=0,
+        description="Tokens left for the response by fit_context when a request does not set max_tokens.",
+    )
+    session_cache_size: int = Field(
+        default=0,
+        ge=0,
+        description="Number of conversations whose rendered and tokenized prompt is kept, so that each turn only prompts and tokenizes the newly appended messages. Conversations are identified by the request's session_id, or else by their message history. 0 disables it. Only used with the empower-functions chat format.",
+    )
+    session_store_path: Optional[str] = Field(
+        default=None,
+        description="Directory where the llama.cpp state of each conversation is saved after every turn, and restored from on its next turn, so that resuming a conversation (even after a restart) does not prefill its history again. Conversations are identified by the request's session_id, or else by their message history. Only used with the empower-functions chat format, without n_parallel.",
+    )
+    session_store_size: int = Field(
+        default=8 << 30,
+        ge=0,
+        description="Size limit in bytes of the session store, least recently used conversations are removed first.",
+    )
+    session_store_ttl: float = Field(
+        default=3600.0,
+        description="Seconds after which an unused conversation is removed from the session store.",
+    )
+    n_parallel: int = Field(
+        default=1,
+        ge=1,
+        description="Number of requests decoded together with continuous batching. Above 1, concurrent requests share decode steps instead of being served one at a time. Only used with the empower-functions chat format.",
+    )
+    n_parallel_ctx: Optional[int] = Field(
+        default=None,
+        description="KV cache size shared by the parallel requests, defaults to n_ctx.",
+    )
+    n_replicas: int = Field(
+        default=1,
+        ge=1,
+        description="Number of replicas of the model, each request goes to the least-loaded one. The replicas share the weights through mmap (keep use_mmap on) and split n_threads and n_threads_batch between them.",
+    )
+    n_workers: int = Field(
+        default=0,
+        ge=0,
+        description="Serve chat completions from this many worker processes, each owning a replica of the model, so that prompt building and response encoding run outside the server process. 0 serves them in process. Other generation endpoints are not available in this mode.",
+    )
+
+
+class EmpowerServerSettings(ServerSettings):
+    json_backend: Literal["auto", "orjson", "json"] = Field(
+        default="auto",
+        description="JSON library used to build prompts, parse responses and encode chat completions and streamed chunks: orjson, json (the standard library) or auto, orjson when it is installed. Prompts are the same text with either. Applies to the whole process, and to its workers.",
+    )
+
+
+class EmpowerSettings(EmpowerServerSettings, EmpowerModelSettings):
+    pass
+
+
+class EmpowerConfigFileSettings(EmpowerServerSettings):
+    models: List[EmpowerModelSettings] = Field(
+        default=[], description="Model configs"
+    )
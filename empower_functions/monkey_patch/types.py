@@ -1,6 +1,13 @@
+from typing import Literal, Optional
 
 from llama_cpp.server.types import CreateChatCompletionRequest
 
 
 class CreateChatCompletionRequestPatched(CreateChatCompletionRequest):
     include_thinking: bool = False
+    session_id: Optional[str] = None
+    # Return the routing decision (message or tool call, and the function
+    # called) instead of generating the whole response.
+    route: bool = False
+    # Overrides the server's functions_encoding for this request.
+    functions_encoding: Optional[Literal["indent", "compact", "minified"]] = None
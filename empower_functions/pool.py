@@ -0,0 +1,138 @@
+import contextlib
+import itertools
+import threading
+from typing import Any, Callable, Iterator, List, NamedTuple, TypeVar
+
+import llama_cpp.llama as llama
+
+T = TypeVar("T")
+
+# Llama methods that evaluate the model, and so need a replica of their own.
+_GENERATION_METHODS = frozenset(
+    (
+        "__call__",
+        "create_completion",
+        "create_chat_completion",
+        "create_embedding",
+        "embed",
+        "eval",
+        "generate",
+    )
+)
+
+
+class ReplicaStats(NamedTuple):
+    index: int
+    in_flight: int
+    queued: int
+    completed: int
+
+
+class _Replica:
+    def __init__(self, index: int, llama: llama.Llama, slots: int):
+        self.index = index
+        self.llama = llama
+        self.slots = threading.Semaphore(slots)
+        self.in_flight = 0
+        self.completed = 0
+
+
+class LlamaPool:
+    """Replicas of one model, each request runs on the least-loaded one.
+
+    Replicas should load the same GGUF file with mmap (the llama.cpp
+    default) so the weights are mapped once and shared, only the KV caches
+    and compute buffers are per replica. Each replica serves `slots`
+    requests at a time, 1 unless it batches requests itself (see
+    BatchScheduler); the others wait for it in its queue.
+
+    The pool stands in for a Llama in the server: generation methods run on
+    a replica acquired for the whole call, including a returned stream, and
+    any other attribute is read from the first replica.
+    """
+
+    def __init__(self, replicas: List[llama.Llama], slots: int = 1):
+        assert len(replicas) > 0, "No replicas provided!"
+        self.slots = slots
+        self._replicas = [
+            _Replica(index, replica, slots) for index, replica in enumerate(replicas)
+        ]
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+
+    @property
+    def replicas(self) -> List[llama.Llama]:
+        return [replica.llama for replica in self._replicas]
+
+    def _pick(self) -> _Replica:
+        with self._lock:
+            # Rotate the starting point so that ties are spread evenly.
+            start = next(self._next) % len(self._replicas)
+            candidates = self._replicas[start:] + self._replicas[:start]
+            replica = min(candidates, key=lambda r: r.in_flight)
+            replica.in_flight += 1
+            return replica
+
+    def _release(self, replica: _Replica):
+        replica.slots.release()
+        with self._lock:
+            replica.in_flight -= 1
+            replica.completed += 1
+
+    @contextlib.contextmanager
+    def acquire(self) -> Iterator[llama.Llama]:
+        """The least-loaded replica, held until the block exits."""
+        replica = self._pick()
+        replica.slots.acquire()
+        try:
+            yield replica.llama
+        finally:
+            self._release(replica)
+
+    def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Call `fn(*args, llama=replica, **kwargs)` on the least-loaded
+        replica. If it returns an iterator (a stream), the replica is held
+        until the iterator is exhausted or closed."""
+        replica = self._pick()
+        replica.slots.acquire()
+        try:
+            result = fn(*args, llama=replica.llama, **kwargs)
+        except BaseException:
+            self._release(replica)
+            raise
+        if isinstance(result, Iterator):
+            return self._hold(replica, result)
+        self._release(replica)
+        return result
+
+    def _hold(self, replica: _Replica, iterator: Iterator[T]) -> Iterator[T]:
+        try:
+            yield from iterator
+        finally:
+            self._release(replica)
+
+    def stats(self) -> List[ReplicaStats]:
+        with self._lock:
+            return [
+                ReplicaStats(
+                    index=replica.index,
+                    in_flight=replica.in_flight,
+                    queued=max(0, replica.in_flight - self.slots),
+                    completed=replica.completed,
+                )
+                for replica in self._replicas
+            ]
+
+    def __call__(self, *args: Any, **kwargs: Any):
+        return self.run(_call_method, "__call__", *args, **kwargs)
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") and name != "__call__":
+            raise AttributeError(name)
+        if name in _GENERATION_METHODS:
+            return lambda *args, **kwargs: self.run(_call_method, name, *args, **kwargs)
+        return getattr(self._replicas[0].llama, name)
+
+
+def _call_method(name: str, *args: Any, llama: llama.Llama, **kwargs: Any):
+    return getattr(llama, name)(*args, **kwargs)
@@ -0,0 +1,139 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, NamedTuple, Union
+
+import llama_cpp.llama as llama
+
+from empower_functions.metrics import (
+    PREFIX_CACHE_BYTES,
+    PREFIX_CACHE_LOOKUPS,
+    PREFIX_CACHE_RESTORED_TOKENS,
+)
+
+
+class PrefixCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    hit_rate: float
+    prefill_tokens_saved: int
+    currsize: int
+    size_bytes: int
+
+
+class _PinnedPrefix:
+    __slots__ = ('tokens', 'state')
+
+    def __init__(self, tokens: List[int], state: llama.LlamaState):
+        self.tokens = tokens
+        self.state = state
+
+
+class PrefixStateCache:
+    """Pins the evaluated KV state of the shared first-turn prefix
+    (system instruction + functions block, up to "User Message:").
+
+    Unlike llama.cpp's LlamaRAMCache/LlamaDiskCache, entries are keyed on
+    the tool set rather than on the full prompt, so a new conversation
+    against a known tool set restores the state and only prefills the
+    user's text.
+    """
+
+    def __init__(self, capacity_bytes: int = (2 << 30)):
+        self.capacity_bytes = capacity_bytes
+        self.hits = 0
+        self.misses = 0
+        self.prefill_tokens_saved = 0
+        self._entries: 'OrderedDict[Hashable, _PinnedPrefix]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(entry.state.llama_state_size for entry in self._entries.values())
+
+    def prepare(
+        self,
+        llama: llama.Llama,
+        key: Hashable,
+        prefix: str,
+        prompt: Union[str, List[int]],
+    ) -> List[int]:
+        """Tokenize `prompt` (unless already tokenized) and make sure
+        `llama` holds the KV state of `prefix` so that generation only
+        evaluates the remaining tokens.
+
+        Returns the prompt tokens, to be passed to `create_completion`.
+        """
+        if not isinstance(prompt, str):
+            prompt_tokens = prompt
+        else:
+            prompt_tokens = llama.tokenize(prompt.encode("utf-8"), special=True)
+            if not prompt.startswith(prefix):
+                return prompt_tokens
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            n_prefix = len(entry.tokens)
+            if prompt_tokens[:n_prefix] != entry.tokens:
+                return prompt_tokens
+            with self._lock:
+                self.hits += 1
+            PREFIX_CACHE_LOOKUPS.inc(1, "hit")
+            # A model still holding the prefix reuses it without the cache.
+            if not _holds_prefix(llama, entry.tokens):
+                llama.load_state(entry.state)
+                with self._lock:
+                    self.prefill_tokens_saved += n_prefix
+                PREFIX_CACHE_RESTORED_TOKENS.inc(n_prefix)
+            return prompt_tokens
+
+        prefix_tokens = llama.tokenize(prefix.encode("utf-8"), special=True)
+        if prompt_tokens[:len(prefix_tokens)] != prefix_tokens:
+            # The user text merged with the end of the prefix when
+            # tokenized, the pinned state would not be reusable.
+            return prompt_tokens
+
+        llama.reset()
+        llama.eval(prefix_tokens)
+        self._put(key, _PinnedPrefix(prefix_tokens, llama.save_state()))
+        return prompt_tokens
+
+    def _put(self, key: Hashable, entry: _PinnedPrefix):
+        PREFIX_CACHE_LOOKUPS.inc(1, "miss")
+        with self._lock:
+            self.misses += 1
+            if entry.state.llama_state_size > self.capacity_bytes:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                PREFIX_CACHE_BYTES.dec(previous.state.llama_state_size)
+            self._entries[key] = entry
+            PREFIX_CACHE_BYTES.inc(entry.state.llama_state_size)
+            while self.size_bytes > self.capacity_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                PREFIX_CACHE_BYTES.dec(evicted.state.llama_state_size)
+
+    def info(self) -> PrefixCacheInfo:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return PrefixCacheInfo(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                prefill_tokens_saved=self.prefill_tokens_saved,
+                currsize=len(self._entries),
+                size_bytes=self.size_bytes,
+            )
+
+    def clear(self):
+        with self._lock:
+            PREFIX_CACHE_BYTES.dec(self.size_bytes)
+            self._entries.clear()
+
+
+def _holds_prefix(llama: llama.Llama, tokens: List[int]) -> bool:
+    n = len(tokens)
+    return llama.n_tokens >= n and llama.input_ids[:n].tolist() == tokens
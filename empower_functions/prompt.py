@@ -1,4 +1,10 @@
-import json
+import functools
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from empower_functions import json_backend
+from empower_functions.metrics import FUNCTIONS_CACHE_ENTRIES, FUNCTIONS_CACHE_LOOKUPS
 
 SYSTEM_INSTRUCTION = "In this environment you have access to a set of functions defined in the JSON format you can use to address user's requests, use them if needed."
 
@@ -29,102 +35,346 @@ def _check_functions_def(functions_def):
             raise 'Function parameters required must be an array'
 
 
+FUNCTIONS_ENCODINGS = ('indent', 'compact', 'minified')
+MINIFIED_DESCRIPTION_LENGTH = 120
+
+
+def _truncate_description(description):
+    """First sentence of `description`, at most MINIFIED_DESCRIPTION_LENGTH
+    characters."""
+    end = description.find('. ')
+    if end >= 0:
+        description = description[:end + 1]
+    if len(description) > MINIFIED_DESCRIPTION_LENGTH:
+        description = description[:MINIFIED_DESCRIPTION_LENGTH - 3].rstrip() + '...'
+    return description
+
+
+def _minify(value):
+    """Copy of a function definition or schema with every description
+    truncated (see _truncate_description)."""
+    if isinstance(value, list):
+        return [_minify(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {
+        key: _truncate_description(item)
+        if key == 'description' and isinstance(item, str)
+        else _minify(item)
+        for key, item in value.items()
+    }
+
+
+def encode_functions(functions_def, encoding='indent'):
+    """JSON of the "Functions:" block.
+
+    "indent" is the format the model was trained with (indent=2),
+    "compact" drops all whitespace and "minified" also truncates the
+    descriptions of functions and parameters to their first sentence.
+    """
+    if encoding == 'indent':
+        return json_backend.dumps(functions_def, indent=True)
+    if encoding == 'compact':
+        return json_backend.dumps(functions_def)
+    if encoding == 'minified':
+        return json_backend.dumps(_minify(functions_def))
+    raise Exception(f'Unknown functions encoding "{encoding}", must be one of {", ".join(FUNCTIONS_ENCODINGS)}')
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def functions_fingerprint(functions_def):
+    """Stable fingerprint of a tool list, order and key order included."""
+    encoded = json_backend.dumps(functions_def)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class FunctionsBlock:
+    """Validated and serialized "Functions:" block of the first user message.
+
+    The fingerprint identifies the functions and their encoding."""
+
+    __slots__ = ('fingerprint', 'text')
+
+    def __init__(self, fingerprint, text):
+        self.fingerprint = fingerprint
+        self.text = text
+
+
+class _FunctionsBlockCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, functions_def, encoding='indent'):
+        fingerprint = functions_fingerprint(functions_def)
+        if encoding != 'indent':
+            fingerprint += ':' + encoding
+        with self._lock:
+            block = self._entries.get(fingerprint)
+            if block is not None:
+                self._entries.move_to_end(fingerprint)
+                self.hits += 1
+                FUNCTIONS_CACHE_LOOKUPS.inc(1, 'hit')
+                return block
+            self.misses += 1
+        FUNCTIONS_CACHE_LOOKUPS.inc(1, 'miss')
+
+        _check_functions_def(functions_def)
+        block = FunctionsBlock(fingerprint, (
+            "Functions:\n"
+            + encode_functions(functions_def, encoding)
+        ))
+        if self.maxsize > 0:
+            with self._lock:
+                self._entries[fingerprint] = block
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                FUNCTIONS_CACHE_ENTRIES.set(len(self._entries))
+        return block
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            FUNCTIONS_CACHE_ENTRIES.set(0)
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > max(maxsize, 0):
+                self._entries.popitem(last=False)
+            FUNCTIONS_CACHE_ENTRIES.set(len(self._entries))
+
+
+_functions_cache = _FunctionsBlockCache(maxsize=128)
+
+
+def functions_block(functions_def, encoding='indent'):
+    """Return the cached FunctionsBlock for `functions_def`, building it on a miss."""
+    return _functions_cache.get(functions_def, encoding)
+
+
+def functions_cache_info():
+    """Hit/miss counters and size of the functions block cache, also
+    exported on /metrics."""
+    return _functions_cache.info()
+
+
+def functions_cache_clear():
+    _functions_cache.clear()
+
+
+def set_functions_cache_size(maxsize):
+    """Resize the functions block cache, 0 disables caching."""
+    _functions_cache.resize(maxsize)
+
+
+# Only small results are cached, which bounds the cache to a few MiB; large
+# ones cost more to keep than to serialize again.
+_TOOL_RESULT_CACHE_MAX_LENGTH = 2048
+
+
+@functools.lru_cache(maxsize=1024)
+def _tool_result(content, tool_call_id):
+    """One element of a "<r>" array, already indented as an array item.
+
+    Tool results are resent with every later turn of a conversation, so
+    they are parsed and serialized once, not on every request.
+    """
+    try:
+        value = json_backend.loads(content)
+    except:
+        raise Exception(
+            'Content of a message with role "tool" must be a valid JSON string')
+    # Newlines only appear between tokens in indented JSON, strings escape
+    # theirs, so indenting every line nests the object one level deeper.
+    return json_backend.dumps({
+        "value": value,
+        'tool_call_id': tool_call_id
+    }, indent=True, ensure_ascii=True).replace('\n', '\n  ')
+
+
+def _check_tool_message(message):
+    if 'content' not in message:
+        raise Exception(
+            '"content" must be provided for message with role "tool"')
+    if 'tool_call_id' not in message or not message['tool_call_id']:
+        raise Exception(
+            '"tool_call_id" must be provided for message with role "tool"')
+
+    content, tool_call_id = message['content'], message['tool_call_id']
+    if not isinstance(content, (str, bytes)):
+        raise Exception(
+            'Content of a message with role "tool" must be a valid JSON string')
+    if not isinstance(tool_call_id, str) or len(content) > _TOOL_RESULT_CACHE_MAX_LENGTH:
+        return _tool_result.__wrapped__(content, tool_call_id)
+    return _tool_result(content, tool_call_id)
+
+
+def _check_assistant_message(message):
+    if 'content' not in message and 'tool_calls' not in message:
+        raise Exception(
+            'Either "content" or "tool_calls" must be provided message with role "assistant"')
+
+    if 'tool_calls' in message:
+        tool_calls = message['tool_calls']
+        if not isinstance(tool_calls, list):
+            raise Exception('Tool calls must be an array')
+        for tool_call in tool_calls:
+            if not isinstance(tool_call, dict):
+                raise Exception('Tool call must be an object')
+            if 'id' not in tool_call:
+                raise Exception(
+                    '"id" must be provided for tool call')
+            if 'function' not in tool_call:
+                raise Exception(
+                    '"function" must be provided for tool call')
+
+            function = tool_call['function']
+            if not isinstance(function, dict):
+                raise Exception('Tool call function must be an object')
+            if 'name' not in function:
+                raise Exception(
+                    '"name" must be provided for the function in tool call')
+            if 'arguments' not in function:
+                raise Exception(
+                    '"arguments" must be provided for the function in tool call')
+
+    if 'content' in message and message['content'] and len(message['content']) > 0:
+        return '<c>' + message['content']
+    functions = [tool_call['function'] for tool_call in message['tool_calls']]
+    return '<f>' + json_backend.dumps(functions, indent=True)
+
+
+def tool_choice_prefill(tool_choice, functions_def):
+    """Return the start of the response forced by `tool_choice`, written the
+    way the model writes tool calls (see _check_assistant_message): "<f>"
+    for "any" (or "required"), and the call up to its arguments for a named
+    function.
+    Returns an empty string for "auto" and "none"."""
+    if tool_choice in ('any', 'required'):
+        if not functions_def:
+            raise Exception(f'Functions must be provided for tool_choice "{tool_choice}"')
+        return '<f>'
+    if not isinstance(tool_choice, dict):
+        return ''
+
+    name = tool_choice['function']['name']
+    if not any(function['name'] == name for function in functions_def or []):
+        raise Exception(f'Function "{name}" in tool_choice is not provided')
+    return ''.join((
+        '<f>[\n  {\n    "name": ',
+        json_backend.dumps(name),
+        ',\n    "arguments": ',
+    ))
+
+
 def _check_and_merge_messages(messages):
-    """Check if the messages are valid."""
+    """Check if the messages are valid, merging consecutive user and tool
+    messages.
+
+    Returns (role, parts) turns, system message excluded: the contents of
+    user turns, the "<r>" array items of tool turns and the rendered
+    assistant message.
+    """
     if len(messages) == 0:
         raise 'Messages cannot be empty'
 
-    first_message = messages[0]
-    updated_messages = []
-    if first_message['role'] == 'system':
+    if messages[0]['role'] == 'system':
         messages = messages[1:]
-        updated_messages.append(first_message)
 
     if len(messages) == 0:
         raise 'At least user message must be provided'
 
+    turns = []
     previous_role = ''
     for message in messages:
         if 'role' not in message or message['role'] not in ['user', 'assistant', 'tool']:
             raise Exception('Invalid role')
 
-        if message['role'] == 'tool':
-            if 'content' not in message:
-                raise Exception(
-                    '"content" must be provided for message with role "tool"')
-            if 'tool_call_id' not in message or not message['tool_call_id']:
-                raise Exception(
-                    '"tool_call_id" must be provided for message with role "tool"')
-
-            try:
-                content = json.loads(message['content'])
-            except:
-                raise Exception(
-                    'Content of a message with role "tool" must be a valid JSON string')
-
-            if previous_role == 'tool':
-                updated_messages[-1]['content'].append({
-                    "value": content,
-                    'tool_call_id': message['tool_call_id']
-                })
-            else:
-                updated_messages.append({
-                    "role": "tool",
-                    "content": [{
-                        "value": content,
-                        'tool_call_id': message['tool_call_id']
-                    }]
-                })
-
-        elif message['role'] == 'user':
+        role = message['role']
+        if role == 'tool':
+            part = _check_tool_message(message)
+        elif role == 'user':
             if 'content' not in message:
                 raise Exception(
                     '"content" must be provided for message with role "user"')
-            if previous_role == 'user':
-                updated_messages[-1]['content'] += "\n\n" + message['content']
-            else:
-                updated_messages.append(message)
-        elif message['role'] == 'assistant':
+            part = message['content']
+        else:
             if previous_role == 'assistant':
                 raise Exception(
                     'Consecutive assistant messages are not allowed')
+            part = _check_assistant_message(message)
 
-            if 'content' not in message and 'tool_calls' not in message:
-                raise Exception(
-                    'Either "content" or "tool_calls" must be provided message with role "assistant"')
-
-            if 'tool_calls' in message:
-                tool_calls = message['tool_calls']
-                if not isinstance(tool_calls, list):
-                    raise Exception('Tool calls must be an array')
-                for tool_call in tool_calls:
-                    if not isinstance(tool_call, dict):
-                        raise Exception('Tool call must be an object')
-                    if 'id' not in tool_call:
-                        raise Exception(
-                            '"id" must be provided for tool call')
-                    if 'function' not in tool_call:
-                        raise Exception(
-                            '"function" must be provided for tool call')
-
-                    function = tool_call['function']
-                    if not isinstance(function, dict):
-                        raise Exception('Tool call function must be an object')
-                    if 'name' not in function:
-                        raise Exception(
-                            '"name" must be provided for the function in tool call')
-                    if 'arguments' not in function:
-                        raise Exception(
-                            '"arguments" must be provided for the function in tool call')
-
-            updated_messages.append(message)
-
-        previous_role = message['role']
-
-    return updated_messages
-
-
-def prompt_messages(messages, functions_def, include_thinking=False):
+        if role == previous_role:
+            turns[-1][1].append(part)
+        else:
+            turns.append((role, [part]))
+        previous_role = role
+
+    return turns
+
+
+def _render_turn(role, parts):
+    if role == 'tool':
+        return {'role': 'user', 'content': '<r>[\n  ' + ',\n  '.join(parts) + '\n]'}
+    if role == 'user':
+        return {'role': 'user', 'content': '<u>' + '\n\n'.join(parts)}
+    return {'role': 'assistant', 'content': parts[0]}
+
+
+def _system_instruction(messages, include_thinking):
+    if len(messages) > 0 and messages[0]['role'] == 'system':
+        return messages[0]['content']
+
+    system_instruction = SYSTEM_INSTRUCTION
+    if include_thinking:
+        system_instruction += "\nMake sure to include your thinking inside < thinking > </thinking > before response."
+    return system_instruction
+
+
+def _first_user_prefix(system_instruction, block):
+    return (
+        system_instruction
+        + "\n"
+        + block.text
+        + "\n\n"
+        + "User Message:\n"
+    )
+
+
+PromptPrefix = namedtuple(
+    'PromptPrefix', ['system_instruction', 'functions_block', 'text'])
+
+
+def prompt_prefix(messages, functions_def, include_thinking=False,
+                  functions_encoding='indent'):
+    """Return the PromptPrefix shared by every conversation with the same
+    system instruction and functions, i.e. the first user message up to
+    "User Message:". Returns None when no functions are given."""
+    if not functions_def:
+        return None
+
+    system_instruction = _system_instruction(messages, include_thinking)
+    block = functions_block(functions_def, functions_encoding)
+    return PromptPrefix(system_instruction, block,
+                        _first_user_prefix(system_instruction, block))
+
+
+def prompt_messages(messages, functions_def, include_thinking=False,
+                    functions_encoding='indent'):
+    """Prompt `messages` in the model's format, with `functions_def`
+    encoded with `functions_encoding` (see encode_functions)."""
     if not functions_def:
         functions_def = []
 
@@ -132,55 +382,43 @@ def prompt_messages(messages, functions_def, include_thinking=False):
         raise Exception(
             'Currently thinking mode is only supported with tools. Please provide functions_def to enable thinking mode.')
 
-    _check_functions_def(functions_def)
-    messages = _check_and_merge_messages(messages)
+    turns = _check_and_merge_messages(messages)
 
-    system_instruction = SYSTEM_INSTRUCTION
-    if include_thinking:
-        system_instruction += "\nMake sure to include your thinking inside < thinking > </thinking > before response."
+    system_instruction = _system_instruction(messages, include_thinking)
 
-    first_user_message = messages[0]
-    starting_index = 1
-    if messages[0]['role'] == 'system':
-        system_instruction = messages[0]['content']
-        first_user_message = messages[1]
-        starting_index = 2
+    role, parts = turns[0]
+    if role == 'assistant':
+        # The first message is prompted with its content as is, after the
+        # functions like a user message.
+        first_message = messages[1] if messages[0]['role'] == 'system' else messages[0]
+        if first_message.get('content'):
+            parts = [first_message['content']]
+    elif role == 'tool':
+        parts = [_render_turn(role, parts)['content']]
 
     if len(functions_def) == 0:
-        prompted_messages = [first_user_message]
+        prompted_messages = [{
+            'role': 'assistant' if role == 'assistant' else 'user',
+            'content': '\n\n'.join(parts),
+        }]
     else:
-        prompted_messages = [{'role': 'user', 'content': (
-            system_instruction
-            + "\n"
-            + "Functions:\n"
-            + json.dumps(functions_def, indent=2, ensure_ascii=False)
-            + "\n\n"
-            + "User Message:\n"
-            + first_user_message['content']
-        )}]
-
-    for message in messages[starting_index:]:
-        if message['role'] == 'tool':
-            prompted_messages.append({
-                'role': 'user',
-                'content': '<r>' + json.dumps(message['content'], indent=2, ensure_ascii=True)
-            })
-        elif message['role'] == 'user':
-            prompted_messages.append({
-                'role': 'user',
-                'content': '<u>' + message['content']
-            })
-        elif message['role'] == 'assistant':
-            if 'content' in message and message['content'] and len(message['content']) > 0:
-                prompted_messages.append({
-                    'role': 'assistant',
-                    'content': '<c>' + message['content']
-                })
-            else:
-                functions = [tool_call['function']
-                             for tool_call in message['tool_calls']]
-                prompted_messages.append({
-                    'role': 'assistant', 'content': '<f>' + json.dumps(functions, indent=2, ensure_ascii=False)
-                })
+        prompted_messages = [{'role': 'user', 'content': ''.join((
+            _first_user_prefix(
+                system_instruction, functions_block(functions_def, functions_encoding)),
+            '\n\n'.join(parts),
+        ))}]
 
+    prompted_messages.extend(_render_turn(role, parts) for role, parts in turns[1:])
     return prompted_messages
+
+
+def prompt_continuation(messages):
+    """Prompted messages for `messages` appended to a conversation that was
+    prompted before, i.e. the suffix of a history whose prefix is already
+    rendered. The first message must not merge with the last one of the
+    prefix (see prompt_messages)."""
+    if len(messages) == 0:
+        return []
+    if messages[0].get('role') == 'system':
+        raise Exception('Invalid role')
+    return [_render_turn(role, parts) for role, parts in _check_and_merge_messages(messages)]
@@ -0,0 +1,240 @@
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set
+
+import numpy as np
+import numpy.typing as npt
+
+from empower_functions.prompt import functions_fingerprint
+
+_WORD = re.compile(r"[a-z0-9]+")
+_CAMEL_CASE = re.compile(r"([a-z0-9])([A-Z])")
+
+
+def _terms(text: str) -> List[str]:
+    """Lowercase words of `text`, with snake_case and camelCase names split."""
+    return _WORD.findall(_CAMEL_CASE.sub(r"\1 \2", text).lower())
+
+
+def tool_document(function: Dict[str, Any]) -> str:
+    """Text a function is retrieved by: its name, its description and the
+    names and descriptions of its parameters."""
+    parts = [function.get("name", ""), function.get("description", "")]
+    properties = (function.get("parameters") or {}).get("properties") or {}
+    for name, schema in properties.items():
+        parts.append(name)
+        if isinstance(schema, dict) and isinstance(schema.get("description"), str):
+            parts.append(schema["description"])
+    return "\n".join(part for part in parts if isinstance(part, str))
+
+
+class BM25ToolIndex:
+    """Okapi BM25 over the tool documents of a function list.
+
+    The weight of each term in each document is computed once, scoring a
+    query sums the columns of its terms.
+    """
+
+    def __init__(
+        self, functions: List[Dict[str, Any]], k1: float = 1.2, b: float = 0.75
+    ):
+        documents = [Counter(_terms(tool_document(function))) for function in functions]
+        self._columns: Dict[str, int] = {}
+        for document in documents:
+            for term in document:
+                self._columns.setdefault(term, len(self._columns))
+
+        counts = np.zeros((len(documents), len(self._columns)), dtype=np.float32)
+        for row, document in enumerate(documents):
+            for term, count in document.items():
+                counts[row, self._columns[term]] = count
+
+        lengths = counts.sum(axis=1, keepdims=True)
+        average_length = max(float(lengths.mean()), 1.0) if len(documents) else 1.0
+        document_frequency = (counts > 0).sum(axis=0)
+        idf = np.log(
+            1.0 + (len(documents) - document_frequency + 0.5) / (document_frequency + 0.5)
+        )
+        self._weights = (
+            idf
+            * counts
+            * (k1 + 1.0)
+            / (counts + k1 * (1.0 - b + b * lengths / average_length))
+        ).astype(np.float32)
+
+    def scores(self, query: str) -> npt.NDArray[np.float32]:
+        columns = [self._columns[term] for term in _terms(query) if term in self._columns]
+        if not columns:
+            return np.zeros(self._weights.shape[0], dtype=np.float32)
+        return self._weights[:, columns].sum(axis=1)
+
+
+class EmbeddingToolIndex:
+    """Cosine similarity between the embedding of a query and those of the
+    tool documents, embedded once with `embed` (e.g. a Llama created with
+    `embedding=True`, see ToolRetriever)."""
+
+    def __init__(
+        self,
+        functions: List[Dict[str, Any]],
+        embed: Callable[[str], npt.NDArray[np.float32]],
+    ):
+        self._embed = embed
+        self._matrix = (
+            np.stack([embed(tool_document(function)) for function in functions])
+            if functions
+            else np.zeros((0, 0), dtype=np.float32)
+        )
+
+    def scores(self, query: str) -> npt.NDArray[np.float32]:
+        if len(self._matrix) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self._matrix @ self._embed(query)
+
+
+class ToolRetriever:
+    """Narrows a request's functions to the `top_k` most relevant to the
+    conversation, so the Functions block of the prompt stays small with
+    large tool catalogs.
+
+    Functions are ranked against the last user message with a BM25 index,
+    or with an embedding index when `embedding_model_path` is given, that
+    model being loaded with `embedding=True` on first use. Indexes are
+    built once per function list and kept for the `cache_size` most
+    recently used lists.
+
+    Functions forced by tool_choice or already called in the conversation
+    are always kept. The selected functions keep their order in the
+    request, so that the same selection renders the same prompt prefix.
+
+    With a `session_id`, functions selected for earlier turns of the
+    conversation stay selected, ahead of those added for later turns, while
+    there is room: at most `top_k` besides the forced and called ones, the
+    least recently selected being dropped first. The Functions block, and
+    so the prefix, session and state caches, then only change when the
+    conversation needs other functions. The selections of the
+    `session_cache_size` most recently used sessions are kept.
+    """
+
+    def __init__(
+        self,
+        top_k: int,
+        embedding_model_path: Optional[str] = None,
+        cache_size: int = 32,
+        session_cache_size: int = 1024,
+    ):
+        self.top_k = top_k
+        self.embedding_model_path = embedding_model_path
+        self.cache_size = cache_size
+        self.session_cache_size = session_cache_size
+        self._indexes: "OrderedDict[str, Any]" = OrderedDict()
+        # Names in the order first selected, with the turn last selected.
+        self._sessions: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._embedding_llama = None
+        self._embedding_lock = threading.Lock()
+
+    def _embed(self, text: str) -> npt.NDArray[np.float32]:
+        with self._embedding_lock:
+            if self._embedding_llama is None:
+                import llama_cpp
+
+                # The model's training context, tool documents are only
+                # cut to it (embed truncates them to the batch size).
+                self._embedding_llama = llama_cpp.Llama(
+                    model_path=self.embedding_model_path,
+                    embedding=True,
+                    n_ctx=0,
+                    n_batch=1 << 20,
+                    verbose=False,
+                )
+            embedding = np.asarray(self._embedding_llama.embed(text), dtype=np.float32)
+        if embedding.ndim == 2:
+            # Models without pooling return one embedding per token.
+            embedding = embedding.mean(axis=0)
+        norm = float(np.linalg.norm(embedding))
+        return embedding / norm if norm > 0 else embedding
+
+    def index(self, functions: List[Dict[str, Any]]):
+        """The index of `functions`, built on first use."""
+        fingerprint = functions_fingerprint(functions)
+        with self._lock:
+            index = self._indexes.get(fingerprint)
+            if index is not None:
+                self._indexes.move_to_end(fingerprint)
+                return index
+
+        index = (
+            EmbeddingToolIndex(functions, self._embed)
+            if self.embedding_model_path is not None
+            else BM25ToolIndex(functions)
+        )
+        with self._lock:
+            self._indexes[fingerprint] = index
+            while len(self._indexes) > self.cache_size:
+                self._indexes.popitem(last=False)
+        return index
+
+    def select(
+        self,
+        functions: List[Dict[str, Any]],
+        messages: Sequence[Dict[str, Any]],
+        tool_choice: Any = None,
+        session_id: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """The functions of `functions` to prompt `messages` with."""
+        if len(functions) <= self.top_k:
+            return functions
+
+        required = _called_functions(messages)
+        if isinstance(tool_choice, dict):
+            required.add(tool_choice["function"]["name"])
+
+        query = _query(messages)
+        scores = self.index(functions).scores(query) if query else None
+        if scores is None:
+            selected = set(range(self.top_k))
+        else:
+            # Stable, so ties keep the request's order.
+            selected = set(np.argsort(-scores, kind="stable")[: self.top_k].tolist())
+        selection = [
+            function
+            for i, function in enumerate(functions)
+            if i in selected or function["name"] in required
+        ]
+        if session_id is None:
+            return selection
+
+        limit = self.top_k + sum(1 for function in selection if function["name"] in required)
+        with self._lock:
+            chosen = self._sessions.pop(session_id, {})
+            turn = max(chosen.values(), default=0) + 1
+            for function in selection:
+                chosen[function["name"]] = turn
+            # Stable, so ties drop the first selected.
+            for name in sorted(chosen, key=chosen.__getitem__)[: max(len(chosen) - limit, 0)]:
+                del chosen[name]
+            self._sessions[session_id] = chosen
+            while len(self._sessions) > self.session_cache_size:
+                self._sessions.popitem(last=False)
+        by_name = {function["name"]: function for function in functions}
+        return [by_name[name] for name in chosen if name in by_name]
+
+
+def _query(messages: Sequence[Dict[str, Any]]) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            return message["content"]
+    return ""
+
+
+def _called_functions(messages: Sequence[Dict[str, Any]]) -> Set[str]:
+    names: Set[str] = set()
+    for message in messages:
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function") if isinstance(tool_call, dict) else None
+            if isinstance(function, dict) and "name" in function:
+                names.add(function["name"])
+    return names
+
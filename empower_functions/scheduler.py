@@ -0,0 +1,471 @@
+import codecs
+import copy
+import ctypes
+import queue
+import threading
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+
+import llama_cpp
+import llama_cpp.llama as llama
+import llama_cpp.llama_types as llama_types
+from llama_cpp._internals import (
+    _LlamaBatch,
+    _LlamaContext,
+    _LlamaSamplingContext,
+    _LlamaSamplingParams,
+)
+
+from empower_functions.metrics import CACHED_PROMPT_TOKENS, PHASE_SECONDS
+from empower_functions.streaming import _partial_suffix_length
+
+
+class _Sequence:
+    """A request being generated in one KV cache sequence."""
+
+    def __init__(
+        self,
+        prompt_tokens: List[int],
+        max_tokens: int,
+        stop: List[str],
+        sampling: _LlamaSamplingContext,
+        logits_processor: Optional[llama.LogitsProcessorList],
+    ):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.stop = stop
+        self.sampling = sampling
+        self.logits_processor = logits_processor
+        self.seq_id = -1
+        self.n_past = 0
+        self.completion_tokens: List[int] = []
+        self.text = ""
+        self.sent = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.events: "queue.Queue" = queue.Queue()
+        self.cancelled = False
+        self.queued_at = time.perf_counter()
+
+    @property
+    def reserved(self) -> int:
+        return len(self.prompt_tokens) + self.max_tokens
+
+    @property
+    def prefilling(self) -> bool:
+        return self.n_past < len(self.prompt_tokens)
+
+
+class BatchScheduler:
+    """Continuous batching for one model.
+
+    Concurrent completions are decoded together in a separate llama.cpp
+    context with one KV cache sequence per request. Every decode step
+    prefills waiting prompts (in chunks of at most `n_batch` tokens) next
+    to the next token of every running sequence; sequences join as soon as
+    a slot and enough KV cache are free and leave as soon as they finish.
+    Like llama.cpp's server, finished slots keep their KV cache and new
+    requests start from the longest matching prefix held by any slot.
+
+    `n_ctx` is the KV cache size shared by all sequences, requests wait
+    until their prompt plus `max_tokens` fit.
+    """
+
+    def __init__(
+        self,
+        llama: llama.Llama,
+        n_parallel: int = 4,
+        n_ctx: Optional[int] = None,
+    ):
+        self.llama = llama
+        self.n_parallel = n_parallel
+        self.n_batch = llama.n_batch
+        self.n_vocab = llama.n_vocab()
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(
+            llama.context_params)
+        params.n_ctx = n_ctx or llama.n_ctx()
+        params.n_seq_max = n_parallel
+        params.logits_all = False
+        self.n_ctx = params.n_ctx
+        self._ctx = _LlamaContext(
+            model=llama._model, params=params, verbose=llama.verbose)
+        self._batch = _LlamaBatch(
+            n_tokens=self.n_batch, embd=0, n_seq_max=1, verbose=llama.verbose)
+
+        self._waiting: "queue.Queue[_Sequence]" = queue.Queue()
+        self._pending: List[_Sequence] = []
+        self._running: List[_Sequence] = []
+        self._free_seq_ids = list(range(n_parallel))
+        self._cached: Dict[int, List[int]] = {}
+        self.prefill_tokens_saved = 0
+        self._thread = threading.Thread(
+            target=self._run, name="empower-batch-scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting.qsize() + len(self._pending) + len(self._running)
+
+    def create_completion(
+        self,
+        prompt: Union[str, List[int]],
+        temperature: float = 0.8,
+        top_p: float = 0.95,
+        top_k: int = 40,
+        min_p: float = 0.05,
+        typical_p: float = 1.0,
+        stream: bool = False,
+        stop: Optional[Union[str, List[str]]] = [],
+        max_tokens: Optional[int] = 16,
+        presence_penalty: float = 0.0,
+        frequency_penalty: float = 0.0,
+        repeat_penalty: float = 1.1,
+        tfs_z: float = 1.0,
+        mirostat_mode: int = 0,
+        mirostat_tau: float = 5.0,
+        mirostat_eta: float = 0.1,
+        model: Optional[str] = None,
+        logits_processor: Optional[llama.LogitsProcessorList] = None,
+        grammar: Optional[llama.LlamaGrammar] = None,
+        logprobs: Optional[int] = None,
+    ) -> Union[
+        llama_types.CreateCompletionResponse,
+        Iterator[llama_types.CreateCompletionStreamResponse],
+    ]:
+        """Same arguments and return value as `Llama.create_completion`,
+        generated in a shared batch. Blocks until the request finishes
+        (or, when streaming, yields as tokens are generated)."""
+        if logprobs is not None:
+            raise ValueError(
+                "logprobs are not supported with batched decoding")
+
+        prompt_tokens = (
+            self.llama.tokenize(prompt.encode("utf-8"), special=True)
+            if isinstance(prompt, str)
+            else list(prompt)
+        )
+        if len(prompt_tokens) >= self.llama.n_ctx():
+            raise ValueError(
+                f"Requested tokens ({len(prompt_tokens)}) exceed context window of {self.llama.n_ctx()}"
+            )
+        if max_tokens is None or max_tokens <= 0:
+            max_tokens = self.llama.n_ctx() - len(prompt_tokens)
+        max_tokens = min(max_tokens, self.n_ctx - len(prompt_tokens))
+        if max_tokens <= 0:
+            raise ValueError(
+                f"Requested tokens ({len(prompt_tokens)}) exceed the batch KV cache size of {self.n_ctx}"
+            )
+
+        sampling = _LlamaSamplingContext(
+            params=_LlamaSamplingParams(
+                top_k=top_k,
+                top_p=top_p,
+                min_p=min_p,
+                tfs_z=tfs_z,
+                typical_p=typical_p,
+                temp=temperature,
+                penalty_last_n=self.llama.last_n_tokens_size,
+                penalty_repeat=repeat_penalty,
+                penalty_freq=frequency_penalty,
+                penalty_present=presence_penalty,
+                mirostat=mirostat_mode,
+                mirostat_tau=mirostat_tau,
+                mirostat_eta=mirostat_eta,
+            ),
+            grammar=_copy_grammar(grammar) if grammar is not None else None,
+        )
+        sampling.mirostat_mu = ctypes.c_float(2.0 * mirostat_tau)
+        sampling.prev = list(prompt_tokens)
+
+        sequence = _Sequence(
+            prompt_tokens=prompt_tokens,
+            max_tokens=max_tokens,
+            stop=[stop] if isinstance(stop, str) else list(stop or []),
+            sampling=sampling,
+            logits_processor=logits_processor,
+        )
+        self._waiting.put(sequence)
+
+        completion_id = f"cmpl-{uuid.uuid4()}"
+        created = int(time.time())
+        model_name = model if model is not None else self.llama.model_path
+        if stream:
+            return self._stream(sequence, completion_id, created, model_name)
+
+        texts = []
+        for kind, value in iter(sequence.events.get, None):
+            if kind == "error":
+                raise value
+            if kind == "text":
+                texts.append(value)
+            else:
+                finish_reason = value
+        return {
+            "id": completion_id,
+            "object": "text_completion",
+            "created": created,
+            "model": model_name,
+            "choices": [
+                {
+                    "text": "".join(texts),
+                    "index": 0,
+                    "logprobs": None,
+                    "finish_reason": finish_reason,
+                }
+            ],
+            "usage": _usage(sequence),
+        }
+
+    def _stream(
+        self,
+        sequence: _Sequence,
+        completion_id: str,
+        created: int,
+        model_name: str,
+    ) -> Iterator[llama_types.CreateCompletionStreamResponse]:
+        try:
+            yield from self._stream_chunks(sequence, completion_id, created, model_name)
+        finally:
+            # Stop generating for clients that went away.
+            sequence.cancelled = True
+
+    def _stream_chunks(
+        self,
+        sequence: _Sequence,
+        completion_id: str,
+        created: int,
+        model_name: str,
+    ) -> Iterator[llama_types.CreateCompletionStreamResponse]:
+        for kind, value in iter(sequence.events.get, None):
+            if kind == "error":
+                raise value
+            yield {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": model_name,
+                "choices": [
+                    {
+                        "text": value if kind == "text" else "",
+                        "index": 0,
+                        "logprobs": None,
+                        "finish_reason": None if kind == "text" else value,
+                    }
+                ],
+            }
+
+    def _run(self):
+        while True:
+            if not self._running and not self._pending:
+                self._pending.append(self._waiting.get())
+            while True:
+                try:
+                    self._pending.append(self._waiting.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._admit()
+                self._step()
+            except Exception as e:  # noqa: BLE001
+                # Nothing would be left to serve the requests, fail them all
+                # rather than leave them waiting.
+                for sequence in list(self._running):
+                    self._finish(sequence, error=e)
+                for sequence in self._pending:
+                    sequence.events.put(("error", e))
+                    sequence.events.put(None)
+                self._pending.clear()
+
+    def _admit(self):
+        reserved = sum(sequence.reserved for sequence in self._running)
+        while self._pending and self._free_seq_ids:
+            sequence = self._pending[0]
+            if self._running and reserved + sequence.reserved > self.n_ctx:
+                break
+            self._pending.pop(0)
+            self._running.append(sequence)
+            self._assign(sequence, reserved)
+            reserved += sequence.reserved
+
+    def _assign(self, sequence: _Sequence, reserved: int):
+        """Give `sequence` a free slot, reusing as much of its prompt as is
+        already in the KV cache (left there by a finished request in that
+        slot, or being held by a running one)."""
+        prompt = sequence.prompt_tokens
+        seq_id = max(
+            self._free_seq_ids,
+            key=lambda i: _common_prefix_length(self._cached.get(i, ()), prompt),
+        )
+        self._free_seq_ids.remove(seq_id)
+        sequence.seq_id = seq_id
+        n_cached = _common_prefix_length(self._cached.pop(seq_id, ()), prompt)
+        source = None
+        for other in self._running:
+            n = min(_common_prefix_length(other.prompt_tokens, prompt), other.n_past)
+            if n > n_cached:
+                source, n_cached = other, n
+        # The last prompt token is always evaluated, its logits are needed.
+        n_cached = min(n_cached, len(prompt) - 1)
+
+        if source is not None:
+            self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+            self._ctx.kv_cache_seq_cp(source.seq_id, seq_id, 0, n_cached)
+        else:
+            self._ctx.kv_cache_seq_rm(seq_id, n_cached, -1)
+        sequence.n_past = n_cached
+        self.prefill_tokens_saved += n_cached
+        PHASE_SECONDS.observe(time.perf_counter() - sequence.queued_at, "queue_wait")
+        CACHED_PROMPT_TOKENS.inc(n_cached)
+
+        # Drop what idle slots hold once it no longer fits next to the
+        # running requests.
+        cached = sum(len(tokens) for tokens in self._cached.values())
+        for i in list(self._cached):
+            if reserved + sequence.reserved + cached <= self.n_ctx:
+                break
+            self._ctx.kv_cache_seq_rm(i, -1, -1)
+            cached -= len(self._cached.pop(i))
+
+    def _step(self):
+        for sequence in [s for s in self._running if s.cancelled]:
+            self._finish(sequence, "stop")
+
+        batch = self._batch.batch
+        batch.n_tokens = 0
+        sampled: List[tuple] = []
+        budget = self.n_batch
+
+        # Decode the next token of every generating sequence first so that
+        # long prompts never stall the running ones.
+        for sequence in self._running:
+            if sequence.prefilling or budget == 0:
+                continue
+            self._add(sequence, sequence.completion_tokens[-1], True)
+            sampled.append((sequence, batch.n_tokens - 1))
+            budget -= 1
+        for sequence in self._running:
+            if not sequence.prefilling or budget == 0:
+                continue
+            chunk = sequence.prompt_tokens[sequence.n_past:sequence.n_past + budget]
+            for i, token in enumerate(chunk):
+                self._add(sequence, token, i == len(chunk) - 1)
+            budget -= len(chunk)
+            if not sequence.prefilling:
+                sampled.append((sequence, batch.n_tokens - 1))
+
+        if batch.n_tokens == 0:
+            return
+        self._ctx.decode(self._batch)
+
+        for sequence, i in sampled:
+            logits = np.ctypeslib.as_array(
+                self._ctx.get_logits_ith(i), shape=(self.n_vocab,)).copy()
+            try:
+                if sequence.logits_processor is not None:
+                    input_ids = np.array(
+                        sequence.prompt_tokens + sequence.completion_tokens, dtype=np.intc)
+                    logits[:] = sequence.logits_processor(input_ids, logits)
+                token = sequence.sampling.sample(self._ctx, logits_array=logits)
+                sequence.sampling.accept(
+                    self._ctx, token, apply_grammar=sequence.sampling.grammar is not None)
+            except Exception as e:  # noqa: BLE001
+                # e.g. an `on_tool_call` callback, only this request fails.
+                self._finish(sequence, error=e)
+                continue
+            self._on_token(sequence, token)
+
+    def _add(self, sequence: _Sequence, token: int, logits: bool):
+        batch = self._batch.batch
+        j = batch.n_tokens
+        batch.token[j] = token
+        batch.pos[j] = sequence.n_past
+        batch.n_seq_id[j] = 1
+        batch.seq_id[j][0] = sequence.seq_id
+        batch.logits[j] = logits
+        batch.n_tokens += 1
+        sequence.n_past += 1
+
+    def _on_token(self, sequence: _Sequence, token: int):
+        if llama_cpp.llama_token_is_eog(self.llama._model.model, token):
+            # Text held back as a possible start of a stop sequence is not one.
+            self._emit(sequence, len(sequence.text))
+            self._finish(sequence, "stop")
+            return
+
+        sequence.completion_tokens.append(token)
+        sequence.text += sequence.decoder.decode(self.llama.detokenize([token]))
+
+        stops = [sequence.text.find(s, sequence.sent) for s in sequence.stop]
+        stops = [position for position in stops if position != -1]
+        if stops:
+            self._emit(sequence, min(stops))
+            self._finish(sequence, "stop")
+            return
+
+        if len(sequence.completion_tokens) >= sequence.max_tokens:
+            self._emit(sequence, len(sequence.text))
+            self._finish(sequence, "length")
+            return
+
+        # Hold back text that may turn out to be the start of a stop sequence.
+        keep = max(
+            (_partial_suffix_length(sequence.text, s) for s in sequence.stop),
+            default=0,
+        )
+        self._emit(sequence, len(sequence.text) - keep)
+
+    def _emit(self, sequence: _Sequence, end: int):
+        if end > sequence.sent:
+            sequence.events.put(("text", sequence.text[sequence.sent:end]))
+            sequence.sent = end
+
+    def _finish(
+        self,
+        sequence: _Sequence,
+        finish_reason: Optional[str] = None,
+        error: Optional[Exception] = None,
+    ):
+        self._running.remove(sequence)
+        if error is not None:
+            # A sequence that failed while being admitted may have no slot.
+            if sequence.seq_id != -1:
+                self._free_seq_ids.append(sequence.seq_id)
+                self._ctx.kv_cache_seq_rm(sequence.seq_id, -1, -1)
+            sequence.events.put(("error", error))
+        else:
+            self._free_seq_ids.append(sequence.seq_id)
+            # Keep the evaluated tokens for a later request with the same
+            # prefix, e.g. the next turn of the conversation.
+            tokens = sequence.prompt_tokens + sequence.completion_tokens
+            self._cached[sequence.seq_id] = tokens[:sequence.n_past]
+            sequence.events.put(("finish", finish_reason))
+        sequence.events.put(None)
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _copy_grammar(grammar: llama.LlamaGrammar) -> llama.LlamaGrammar:
+    """A LlamaGrammar with its own parse state, sharing the compiled rules,
+    so cached grammars can be used by concurrent sequences."""
+    grammar = copy.copy(grammar)
+    grammar.init()
+    return grammar
+
+
+def _usage(sequence: _Sequence) -> llama_types.CompletionUsage:
+    return {
+        "prompt_tokens": len(sequence.prompt_tokens),
+        "completion_tokens": len(sequence.completion_tokens),
+        "total_tokens": len(sequence.prompt_tokens) + len(sequence.completion_tokens),
+    }
@@ -1,29 +1,82 @@
 from __future__ import annotations
 
+import argparse
+import os
+import sys
+
 import llama_cpp
+import uvicorn
+from llama_cpp.server.app import create_app
+from llama_cpp.server.cli import add_args_from_model, parse_model_from_args
 from llama_cpp.server.model import LlamaProxy
 from llama_cpp.server.settings import ModelSettings
-from llama_cpp.server.__main__ import main
 
+from empower_functions import json_backend
 from empower_functions.chat_handler import EmpowerFunctionsCompletionHandler
-import json
-from typing import Optional, Union, Dict
-import llama_cpp
-from llama_cpp.server.model import (
-    LlamaProxy,
-)
-from llama_cpp.server.settings import (
-    ModelSettings,
+from empower_functions.monkey_patch.settings import (
+    EmpowerConfigFileSettings,
+    EmpowerModelSettings,
+    EmpowerServerSettings,
+    EmpowerSettings,
 )
+import json
+from typing import Optional, Union, Dict, List
+import llama_cpp.llama_speculative as llama_speculative
+import llama_cpp.llama_tokenizer as llama_tokenizer
 from empower_functions.monkey_patch.app import patch_app
+from empower_functions.pool import LlamaPool
+from empower_functions.speculative import ToolCallDraftModel
+from empower_functions.workers import WorkerPool
 
 # Monkey pacthing the LlamaProxy class
 
 
-def load_llama_from_model_settings(settings: ModelSettings) -> llama_cpp.Llama:
+def load_llama_from_model_settings(
+    settings: ModelSettings,
+) -> Union[llama_cpp.Llama, LlamaPool]:
+    if not isinstance(settings, EmpowerModelSettings):
+        settings = EmpowerModelSettings(**settings.model_dump())
+
+    if settings.n_replicas <= 1:
+        return _load_llama(settings)
+
+    replica_settings = _split_threads(settings, settings.n_replicas)
+    return LlamaPool(
+        [_load_llama(replica_settings) for _ in range(settings.n_replicas)],
+        slots=settings.n_parallel,
+    )
+
+
+def _split_threads(settings: EmpowerModelSettings, n: int) -> EmpowerModelSettings:
+    # Split the thread budget between `n` instances of the model, they
+    # share the weights through mmap.
+    return settings.model_copy(
+        update={
+            "n_threads": max(1, settings.n_threads // n),
+            "n_threads_batch": max(1, settings.n_threads_batch // n),
+        }
+    )
+
+
+def _load_llama(settings: EmpowerModelSettings) -> llama_cpp.Llama:
     chat_handler = None
     if settings.chat_format == "empower-functions":
-        chat_handler = EmpowerFunctionsCompletionHandler()
+        chat_handler = EmpowerFunctionsCompletionHandler(
+            prefix_cache_bytes=settings.prefix_cache_size,
+            tool_call_grammar=settings.tool_call_grammar,
+            forced_tokens=settings.forced_tokens,
+            tool_retrieval_top_k=settings.tool_retrieval_top_k,
+            tool_retrieval_embedding_model=settings.tool_retrieval_embedding_model,
+            functions_encoding=settings.functions_encoding,
+            fit_context=settings.fit_context,
+            reserve_tokens=settings.reserve_tokens,
+            n_parallel=settings.n_parallel,
+            n_parallel_ctx=settings.n_parallel_ctx,
+            session_cache_size=settings.session_cache_size,
+            session_store_path=settings.session_store_path,
+            session_store_bytes=settings.session_store_size,
+            session_store_ttl=settings.session_store_ttl,
+        )
     elif settings.chat_format == "llava-1-5":
         assert settings.clip_model_path is not None, "clip model not found"
         if settings.hf_model_repo_id is not None:
@@ -132,7 +185,11 @@ def load_llama_from_model_settings(settings: ModelSettings) -> llama_cpp.Llama:
         )
 
     draft_model = None
-    if settings.draft_model is not None:
+    if settings.draft_model == "tool-call":
+        draft_model = ToolCallDraftModel(
+            num_pred_tokens=settings.draft_model_num_pred_tokens
+        )
+    elif settings.draft_model is not None:
         draft_model = llama_speculative.LlamaPromptLookupDecoding(
             num_pred_tokens=settings.draft_model_num_pred_tokens
         )
@@ -193,7 +250,8 @@ def load_llama_from_model_settings(settings: ModelSettings) -> llama_cpp.Llama:
         yarn_beta_slow=settings.yarn_beta_slow,
         yarn_orig_ctx=settings.yarn_orig_ctx,
         mul_mat_q=settings.mul_mat_q,
-        logits_all=settings.logits_all,
+        # Forced tokens are verified with the logits of every position.
+        logits_all=settings.logits_all or settings.forced_tokens,
         embedding=settings.embedding,
         offload_kqv=settings.offload_kqv,
         flash_attn=settings.flash_attn,
@@ -234,7 +292,87 @@ def load_llama_from_model_settings(settings: ModelSettings) -> llama_cpp.Llama:
 LlamaProxy.load_llama_from_model_settings = staticmethod(
     load_llama_from_model_settings)
 
-if __name__ == "__main__":
-    patch_app()
 
+def main():
+    description = "Empower functions server, llama.cpp python server with the empower-functions chat format."
+    parser = argparse.ArgumentParser(description=description)
+
+    add_args_from_model(parser, EmpowerSettings)
+    parser.add_argument(
+        "--config_file",
+        type=str,
+        help="Path to a config file to load.",
+    )
+    server_settings: Optional[EmpowerServerSettings] = None
+    model_settings: List[EmpowerModelSettings] = []
+    args = parser.parse_args()
+    try:
+        config_file = os.environ.get("CONFIG_FILE", args.config_file)
+        if config_file:
+            if not os.path.exists(config_file):
+                raise ValueError(f"Config file {config_file} not found!")
+            with open(config_file, "rb") as f:
+                if config_file.endswith(".yaml") or config_file.endswith(".yml"):
+                    import yaml
+
+                    config_file_settings = EmpowerConfigFileSettings.model_validate_json(
+                        json.dumps(yaml.safe_load(f))
+                    )
+                else:
+                    config_file_settings = EmpowerConfigFileSettings.model_validate_json(
+                        f.read()
+                    )
+                server_settings = EmpowerServerSettings.model_validate(
+                    config_file_settings)
+                model_settings = config_file_settings.models
+        else:
+            server_settings = parse_model_from_args(EmpowerServerSettings, args)
+            model_settings = [parse_model_from_args(EmpowerModelSettings, args)]
+    except Exception as e:
+        print(e, file=sys.stderr)
+        parser.print_help()
+        sys.exit(1)
+
+    # Process wide, and passed on to the workers.
+    json_backend.use(server_settings.json_backend)
+
+    workers = None
+    if len(model_settings) == 1 and model_settings[0].n_workers > 0:
+        settings = model_settings[0]
+        workers = WorkerPool(
+            _split_threads(settings, settings.n_workers), settings.n_workers
+        )
+        # The workers own the model, the front end only needs the vocabulary
+        # for the tokenize endpoints.
+        model_settings = [
+            settings.model_copy(update={"vocab_only": True, "n_replicas": 1})
+        ]
+
+    # The proxy holds a single model at a time and swaps it when another one
+    # is requested, so requests can only skip the global lock with one model.
+    patch_app(
+        workers=workers,
+        concurrent=len(model_settings) == 1
+        and (
+            model_settings[0].n_replicas > 1
+            or (
+                model_settings[0].chat_format == "empower-functions"
+                and model_settings[0].n_parallel > 1
+            )
+        )
+    )
+    app = create_app(
+        server_settings=server_settings,
+        model_settings=model_settings,
+    )
+    uvicorn.run(
+        app,
+        host=os.getenv("HOST", server_settings.host),
+        port=int(os.getenv("PORT", server_settings.port)),
+        ssl_keyfile=server_settings.ssl_keyfile,
+        ssl_certfile=server_settings.ssl_certfile,
+    )
+
+
+if __name__ == "__main__":
     main()
@@ -0,0 +1,290 @@
+import ctypes
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+import llama_cpp
+import llama_cpp.llama as llama
+
+from empower_functions.metrics import (
+    SESSION_STORE_BYTES,
+    SESSION_STORE_EVICTIONS,
+    SESSION_STORE_LOOKUPS,
+    SESSION_STORE_RESTORED_TOKENS,
+)
+
+# Magic, number of tokens, bytes of llama.cpp state.
+_HEADER = struct.Struct("<8sQQ")
+_MAGIC = b"EMPWRKV1"
+_SUFFIX = ".kv"
+
+
+class SessionStoreInfo(NamedTuple):
+    hits: int
+    misses: int
+    saves: int
+    evictions: int
+    restore_seconds: float
+    prefill_tokens_saved: int
+    prefill_seconds_saved: float
+    currsize: int
+    size_bytes: int
+
+
+class _StoredState:
+    __slots__ = ("size", "last_used")
+
+    def __init__(self, size: int, last_used: float):
+        self.size = size
+        self.last_used = last_used
+
+
+class SessionStateStore:
+    """Saves the llama.cpp state of conversations to files, so that a
+    conversation resumed after its KV cache was evicted from the context or
+    from the state cache (e.g. while its tools run) or after a restart does
+    not prefill its history again.
+
+    A file holds the evaluated tokens and the state as llama.cpp serializes
+    it, only the KV cells in use, without the scores or the full-context
+    token buffer of a LlamaState. It is written and read through a memory
+    map. Files are named after the model, context size and session key,
+    and are removed once unused for `ttl` seconds or, least recently used
+    first, when the store grows past `capacity_bytes`.
+
+    The state is restored before a turn only when it covers more of the
+    prompt than the context already holds.
+    """
+
+    def __init__(self, path: str, capacity_bytes: int = (8 << 30), ttl: float = 3600.0):
+        self.path = path
+        self.capacity_bytes = capacity_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.evictions = 0
+        self.restore_seconds = 0.0
+        self.prefill_tokens_saved = 0
+        self.prefill_seconds_saved = 0.0
+        self._entries: "OrderedDict[str, _StoredState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        stored = []
+        for name in os.listdir(path):
+            if name.endswith(_SUFFIX):
+                stat = os.stat(os.path.join(path, name))
+                stored.append((stat.st_mtime, name, stat.st_size))
+        for last_used, name, size in sorted(stored):
+            self._entries[name] = _StoredState(size, last_used)
+            SESSION_STORE_BYTES.inc(size)
+        with self._lock:
+            self._evict(time.time())
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+    def _name(self, llama: llama.Llama, key: str) -> str:
+        scope = f"{llama.model_path}\0{llama.n_ctx()}\0{key}"
+        return hashlib.sha1(scope.encode("utf-8")).hexdigest() + _SUFFIX
+
+    def restore(
+        self, llama: llama.Llama, keys: Sequence[str], prompt_tokens: List[int]
+    ) -> Optional[str]:
+        """Load the state saved under the first of `keys` found into `llama`
+        if it holds a longer prefix of `prompt_tokens` than the context.
+
+        Returns the key found, if any.
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            for key in keys:
+                name = self._name(llama, key)
+                if name in self._entries:
+                    break
+            else:
+                self.misses += 1
+                SESSION_STORE_LOOKUPS.inc(1, "miss")
+                return None
+
+        held = _common_prefix_length(llama.input_ids[: llama.n_tokens].tolist(), prompt_tokens)
+        start = time.perf_counter()
+        try:
+            restored = self._load(llama, os.path.join(self.path, name), prompt_tokens, held)
+        except (OSError, ValueError):
+            # Removed by another process sharing the store, or not a state file.
+            restored = None
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            if restored is None:
+                self.misses += 1
+                SESSION_STORE_LOOKUPS.inc(1, "miss")
+                entry = self._entries.pop(name, None)
+                if entry is not None:
+                    SESSION_STORE_BYTES.dec(entry.size)
+                return None
+            self.hits += 1
+            SESSION_STORE_LOOKUPS.inc(1, "hit")
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.last_used = now
+                self._entries.move_to_end(name)
+            if restored > held:
+                self.restore_seconds += elapsed
+                self.prefill_tokens_saved += restored - held
+                SESSION_STORE_RESTORED_TOKENS.inc(restored - held)
+                self.prefill_seconds_saved += (restored - held) * _prefill_seconds_per_token(llama)
+        try:
+            os.utime(os.path.join(self.path, name), (now, now))
+        except OSError:
+            pass
+        if restored > held and llama.verbose:
+            print(
+                f"SessionStateStore: restored {restored} tokens in {elapsed * 1e3:.1f} ms, "
+                f"{restored - held} not prefilled",
+                file=sys.stderr,
+            )
+        return key
+
+    def _load(
+        self, llama: llama.Llama, path: str, prompt_tokens: List[int], held: int
+    ) -> int:
+        """Number of prompt tokens the context holds after loading `path`,
+        the file is only loaded when that is more than `held`."""
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) as mm:
+            magic, n_tokens, n_bytes = _HEADER.unpack_from(mm)
+            offset = _HEADER.size + 4 * n_tokens
+            if magic != _MAGIC or len(mm) != offset + n_bytes:
+                raise ValueError(f"Invalid session state file {path}")
+            tokens = np.frombuffer(
+                mm, dtype="<i4", count=n_tokens, offset=_HEADER.size
+            ).copy()
+            restored = _common_prefix_length(tokens.tolist(), prompt_tokens)
+            if restored <= held:
+                return held
+            state = (ctypes.c_uint8 * n_bytes).from_buffer(mm, offset)
+            try:
+                if llama_cpp.llama_set_state_data(llama._ctx.ctx, state) != n_bytes:
+                    raise RuntimeError("Failed to set llama state data")
+            finally:
+                del state
+            llama.input_ids[:n_tokens] = tokens
+            llama.n_tokens = n_tokens
+            return restored
+
+    def save(self, llama: llama.Llama, key: str, replaces: Optional[str] = None):
+        """Save the state of `llama` under `key`, replacing any previous one
+        and the state saved under `replaces`, e.g. the earlier turn of the
+        conversation it continues."""
+        n_tokens = llama.n_tokens
+        if n_tokens == 0:
+            return
+        name = self._name(llama, key)
+        path = os.path.join(self.path, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        offset = _HEADER.size + 4 * n_tokens
+        # Upper bound, the file is sparse until truncated to the used size.
+        bound = int(llama_cpp.llama_get_state_size(llama._ctx.ctx))
+        try:
+            with open(tmp_path, "w+b") as f:
+                f.truncate(offset + bound)
+                with mmap.mmap(f.fileno(), offset + bound) as mm:
+                    state = (ctypes.c_uint8 * bound).from_buffer(mm, offset)
+                    try:
+                        n_bytes = int(llama_cpp.llama_copy_state_data(llama._ctx.ctx, state))
+                    finally:
+                        del state
+                    if n_bytes > bound:
+                        raise RuntimeError("Failed to copy llama state data")
+                    _HEADER.pack_into(mm, 0, _MAGIC, n_tokens, n_bytes)
+                    mm[_HEADER.size:offset] = (
+                        llama.input_ids[:n_tokens].astype("<i4").tobytes()
+                    )
+                f.truncate(offset + n_bytes)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        now = time.time()
+        with self._lock:
+            self.saves += 1
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                SESSION_STORE_BYTES.dec(previous.size)
+            self._entries[name] = _StoredState(offset + n_bytes, now)
+            SESSION_STORE_BYTES.inc(offset + n_bytes)
+            if replaces is not None and replaces != key:
+                replaced = self._name(llama, replaces)
+                if replaced in self._entries:
+                    self._remove(replaced)
+            self._evict(now)
+
+    def _evict(self, now: float):
+        expired = [
+            name for name, entry in self._entries.items() if now - entry.last_used > self.ttl
+        ]
+        for name in expired:
+            self._remove(name)
+        while self._entries and self.size_bytes > self.capacity_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, name: str):
+        SESSION_STORE_BYTES.dec(self._entries.pop(name).size)
+        self.evictions += 1
+        SESSION_STORE_EVICTIONS.inc()
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def info(self) -> SessionStoreInfo:
+        with self._lock:
+            return SessionStoreInfo(
+                hits=self.hits,
+                misses=self.misses,
+                saves=self.saves,
+                evictions=self.evictions,
+                restore_seconds=self.restore_seconds,
+                prefill_tokens_saved=self.prefill_tokens_saved,
+                prefill_seconds_saved=self.prefill_seconds_saved,
+                currsize=len(self._entries),
+                size_bytes=self.size_bytes,
+            )
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._entries):
+                self._remove(name)
+
+
+def _common_prefix_length(a: List[int], b: List[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _prefill_seconds_per_token(llama: llama.Llama) -> float:
+    """Average prompt evaluation time per token of the context so far."""
+    timings = llama_cpp.llama_get_timings(llama._ctx.ctx)
+    if timings.n_p_eval == 0:
+        return 0.0
+    return timings.t_p_eval_ms / timings.n_p_eval / 1e3
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+
+class SessionCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    hit_rate: float
+    tokens_reused: int
+    currsize: int
+
+
+class Session:
+    """A conversation prefix as it was last prompted: its first `n_messages`
+    messages, their digest, rendered text and tokens (None when the model
+    does not tokenize turns independently)."""
+
+    __slots__ = ('n_messages', 'digest', 'text', 'tokens')
+
+    def __init__(self, n_messages: int, digest: str, text: str, tokens: Optional[List[int]]):
+        self.n_messages = n_messages
+        self.digest = digest
+        self.text = text
+        self.tokens = tokens
+
+
+def history_digests(messages: Sequence[Dict[str, Any]]) -> List[str]:
+    """Chained digests of the message history: element i identifies
+    `messages[:i]`, element 0 is the empty history."""
+    digests = ['']
+    for message in messages:
+        encoded = json.dumps(message, sort_keys=True, ensure_ascii=False,
+                             separators=(',', ':'), default=str)
+        digests.append(hashlib.sha1(
+            (digests[-1] + encoded).encode('utf-8')).hexdigest())
+    return digests
+
+
+class SessionCache:
+    """Remembers the rendered and tokenized prompt of recent conversations,
+    so that a new turn only prompts and tokenizes the messages appended
+    since the previous one.
+
+    A conversation is found by the client's session id or, without one, by
+    the digest of its history. The prefix is only reused when the history
+    still starts with exactly the same messages, otherwise the turn is
+    prompted in full. `key` separates entries that render differently for
+    the same messages (model, functions, thinking mode).
+
+    The tokens are those of a full tokenization, so generation still
+    evaluates only the tokens past what the model's context (or its state
+    cache) already holds.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.tokens_reused = 0
+        self._entries: 'OrderedDict[Tuple[Hashable, str], Session]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(
+        self,
+        key: Hashable,
+        messages: Sequence[Dict[str, Any]],
+        digests: List[str],
+        session_id: Optional[str] = None,
+    ) -> Optional[Session]:
+        """The longest prompted prefix of `messages`, `digests` being their
+        history_digests."""
+        with self._lock:
+            session = None
+            if session_id is not None:
+                session = self._entries.get((key, session_id))
+                if session is not None and (
+                    session.n_messages > len(messages)
+                    or digests[session.n_messages] != session.digest
+                ):
+                    session = None
+            else:
+                for n in range(len(messages), 0, -1):
+                    session = self._entries.get((key, digests[n]))
+                    if session is not None:
+                        break
+
+            n = session.n_messages if session is not None else 0
+            if n and n < len(messages) and messages[n].get('role') == messages[n - 1].get('role'):
+                # The next message would merge into the last prompted turn.
+                session = None
+
+            if session is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if session.tokens is not None:
+                self.tokens_reused += len(session.tokens)
+            return session
+
+    def store(self, key: Hashable, session: Session, session_id: Optional[str] = None):
+        if self.maxsize <= 0:
+            return
+        entry_key = (key, session_id if session_id is not None else session.digest)
+        with self._lock:
+            self._entries[entry_key] = session
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def info(self) -> SessionCacheInfo:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return SessionCacheInfo(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                tokens_reused=self.tokens_reused,
+                currsize=len(self._entries),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
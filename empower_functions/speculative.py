@@ -0,0 +1,159 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+import llama_cpp.llama as llama
+from llama_cpp.llama_speculative import LlamaDraftModel
+
+from empower_functions.prompt import functions_fingerprint
+from empower_functions.streaming import FUNCTIONS_PREFIX
+
+_EMPTY = np.array([], dtype=np.intc)
+
+
+class DraftModelInfo(NamedTuple):
+    proposed: int
+    accepted: int
+    acceptance_rate: float
+
+
+def tool_call_fragments(functions: List[Dict[str, Any]]) -> List[str]:
+    """Literal pieces of a `<f>` response calling `functions`, as the model
+    writes it (`json.dumps(..., indent=2)`), cut before each argument
+    value."""
+    fragments = ['\n    }\n  }\n]', '\n    }\n  },\n  {\n    "name": "']
+    for function in functions:
+        keys = list(function.get('parameters', {}).get('properties', {}))
+        call = (
+            '{\n    "name": ' + json.dumps(function['name'], ensure_ascii=False)
+            + ',\n    "arguments": {'
+            + ('\n      ' + json.dumps(keys[0], ensure_ascii=False) + ': ' if keys else '}')
+        )
+        fragments.append(FUNCTIONS_PREFIX + '[\n  ' + call)
+        fragments.append('},\n  ' + call)
+        for key in keys[1:]:
+            fragments.append(',\n      ' + json.dumps(key, ensure_ascii=False) + ': ')
+    return fragments
+
+
+class ToolCallDraftModel(LlamaDraftModel):
+    """Draft model for speculative decoding of tool calls.
+
+    Proposes the continuation of the last generated tokens found in the
+    `<f>` scaffolding of the request's functions (brackets, function names
+    and property keys, see tool_call_fragments) or else in the last user
+    message, where argument values are often copied from. In the
+    scaffolding, only the part of the continuation shared by every match
+    is proposed, i.e. what the schema leaves as the only option.
+
+    The handler calls `prepare` with each request's functions before
+    generating, so a Llama must not generate concurrently with this draft
+    model (requests batched by a BatchScheduler do not use it).
+    """
+
+    def __init__(self, num_pred_tokens: int = 10, max_ngram_size: int = 3):
+        self.num_pred_tokens = num_pred_tokens
+        self.max_ngram_size = max_ngram_size
+        self.proposed = 0
+        self.accepted = 0
+        self._scaffolding = (_EMPTY, _EMPTY)
+        self._user_message = _EMPTY
+        self._last: Optional[Tuple[int, npt.NDArray[np.intc]]] = None
+        self._cache: 'OrderedDict[Tuple[str, str], Tuple[npt.NDArray[np.intc], npt.NDArray[np.intc]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prepare(
+        self,
+        llama: llama.Llama,
+        functions: List[Dict[str, Any]],
+        user_message: Optional[str],
+    ):
+        """Set the functions and the user message of the next generation."""
+        key = (llama.model_path, functions_fingerprint(functions))
+        scaffolding = self._cache.get(key)
+        if scaffolding is None:
+            tokens: List[int] = []
+            ends: List[int] = []
+            for fragment in tool_call_fragments(functions):
+                tokens += llama.tokenize(fragment.encode('utf-8'), add_bos=False)
+                ends += [len(tokens)] * (len(tokens) - len(ends))
+                # Separator, never matches a token.
+                tokens.append(-1)
+                ends.append(len(tokens))
+            scaffolding = (np.array(tokens, dtype=np.intc), np.array(ends, dtype=np.intc))
+            self._cache[key] = scaffolding
+            while len(self._cache) > 32:
+                self._cache.popitem(last=False)
+
+        self._scaffolding = scaffolding
+        self._user_message = (
+            np.array(llama.tokenize(user_message.encode('utf-8'), add_bos=False), dtype=np.intc)
+            if user_message
+            else _EMPTY
+        )
+        self._last = None
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        if self._last is not None:
+            start, proposal = self._last
+            generated = input_ids[start:start + len(proposal)]
+            mismatch = np.nonzero(generated != proposal[:len(generated)])[0]
+            with self._lock:
+                self.accepted += int(mismatch[0]) if len(mismatch) else len(generated)
+
+        draft = self._draft(input_ids)
+        self._last = (len(input_ids), draft) if len(draft) else None
+        with self._lock:
+            self.proposed += len(draft)
+        return draft
+
+    def _draft(self, input_ids: npt.NDArray[np.intc]) -> npt.NDArray[np.intc]:
+        tokens, ends = self._scaffolding
+        for ngram_size in range(min(self.max_ngram_size, len(input_ids)), 0, -1):
+            ngram = input_ids[-ngram_size:]
+
+            # Only what every occurrence in the scaffolding agrees on.
+            common = None
+            for start in _find(tokens, ngram):
+                continuation = tokens[start:min(ends[start - 1], start + self.num_pred_tokens)]
+                if len(continuation) == 0:
+                    continue
+                if common is None:
+                    common = continuation
+                else:
+                    n = min(len(common), len(continuation))
+                    mismatch = np.nonzero(common[:n] != continuation[:n])[0]
+                    common = common[:mismatch[0] if len(mismatch) else n]
+                if len(common) == 0:
+                    break
+            if common is not None and len(common) > 0:
+                return common
+
+            for start in _find(self._user_message, ngram):
+                continuation = self._user_message[start:start + self.num_pred_tokens]
+                if len(continuation) > 0:
+                    return continuation
+        return _EMPTY
+
+    def info(self) -> DraftModelInfo:
+        with self._lock:
+            return DraftModelInfo(
+                proposed=self.proposed,
+                accepted=self.accepted,
+                acceptance_rate=self.accepted / self.proposed if self.proposed else 0.0,
+            )
+
+
+def _find(tokens: npt.NDArray[np.intc], ngram: npt.NDArray[np.intc]) -> List[int]:
+    """Positions right after each occurrence of `ngram` in `tokens`."""
+    if len(tokens) < len(ngram):
+        return []
+    windows = np.lib.stride_tricks.sliding_window_view(tokens, (len(ngram),))
+    matches = np.nonzero(np.all(windows == ngram, axis=1))[0]
+    return (matches + len(ngram)).tolist()
@@ -0,0 +1,332 @@
+import codecs
+from typing import Any, Callable, List, NamedTuple, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+import llama_cpp.llama as llama
+
+from empower_functions import json_backend
+
+THINKING_END_TAG = "</thinking>"
+CONTENT_PREFIX = "<c>"
+FUNCTIONS_PREFIX = "<f>"
+
+_PREFIX = 0
+_THINKING = 1
+_CONTENT = 2
+_TOOL_CALLS = 3
+
+_WHITESPACE = " \t\r\n"
+
+
+class StreamEvent(NamedTuple):
+    """One piece of the response decoded from the model output.
+
+    kind is "content" (text in `value`), "tool_call" (a new call at `index`
+    named `value`) or "arguments" (a fragment of the JSON arguments of the
+    call at `index`).
+    """
+
+    kind: str
+    value: str
+    index: Optional[int] = None
+
+
+class ToolCall(NamedTuple):
+    """A complete element of the `<f>` array, `index` is its position in
+    the response's `tool_calls`."""
+
+    index: int
+    name: str
+    arguments: Any
+
+
+class _JsonValueScanner:
+    """Tracks where a JSON value that starts with `first` ends."""
+
+    def __init__(self, first: str):
+        self.is_string = first == '"'
+        self.is_container = first in "[{"
+        self._depth = 1 if self.is_container else 0
+        self._in_string = self.is_string
+        self._escape = False
+        self.done = False
+
+    def feed(self, ch: str) -> bool:
+        """Consume `ch`, returns False if `ch` is not part of the value."""
+        if not self.is_string and not self.is_container:
+            if ch in _WHITESPACE or ch in ",}]":
+                self.done = True
+                return False
+            return True
+
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                self.done = self.is_string
+            return True
+
+        if ch == '"':
+            self._in_string = True
+        elif ch in "[{":
+            self._depth += 1
+        elif ch in "]}":
+            self._depth -= 1
+            self.done = self._depth == 0
+        return True
+
+
+class ToolCallStreamParser:
+    """Incrementally splits the model output into content and tool call
+    events while it is being generated.
+
+    Mirrors the non-streaming conversion: an optional thinking block up to
+    `</thinking>` is content, `<c>` is followed by content, `<f>` by a JSON
+    array of `{"name": ..., "arguments": ...}` calls, and anything else is
+    passed through as content. Each function name is emitted as a single
+    event once its string is complete, followed by argument fragments as
+    they arrive.
+
+    `on_tool_call` is called with a ToolCall as soon as an element of the
+    array is syntactically complete, while the rest is still generating.
+    """
+
+    def __init__(self, on_tool_call: Optional[Callable[[ToolCall], None]] = None):
+        self.on_tool_call = on_tool_call
+        self._mode = _PREFIX
+        self._buffer = ""
+        self._thinking_seen = False
+        self.has_tool_calls = False
+
+        # Tool call array state, `_depth` is 1 inside the array and 2 inside
+        # a call object; values of a call are tracked by `_value`.
+        self._depth = 0
+        self._index = -1
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self._value: Optional[_JsonValueScanner] = None
+        self._value_chars: List[str] = []
+        self._name: Optional[str] = None
+        self._arguments: Optional[str] = None
+        self._pending_arguments: List[str] = []
+        self._events: List[StreamEvent] = []
+        self._fragment: List[str] = []
+
+    def feed(self, text: str) -> List[StreamEvent]:
+        if self._mode == _CONTENT:
+            return [StreamEvent("content", text)] if text else []
+        if self._mode == _TOOL_CALLS:
+            self._feed_tool_calls(text)
+            return self._take_events()
+
+        self._buffer += text
+        while self._buffer:
+            if self._mode == _PREFIX:
+                buffer = self._buffer
+                if buffer.startswith(CONTENT_PREFIX):
+                    self._mode = _CONTENT
+                    self._buffer = ""
+                    self._emit_content(buffer[len(CONTENT_PREFIX):])
+                elif buffer.startswith(FUNCTIONS_PREFIX):
+                    self._mode = _TOOL_CALLS
+                    self._buffer = ""
+                    self._feed_tool_calls(buffer[len(FUNCTIONS_PREFIX):])
+                elif CONTENT_PREFIX.startswith(buffer) or FUNCTIONS_PREFIX.startswith(buffer):
+                    break
+                elif not self._thinking_seen:
+                    self._mode = _THINKING
+                else:
+                    self._mode = _CONTENT
+                    self._buffer = ""
+                    self._emit_content(buffer)
+            elif self._mode == _THINKING:
+                end = self._buffer.find(THINKING_END_TAG)
+                if end != -1:
+                    end += len(THINKING_END_TAG)
+                    self._emit_content(self._buffer[:end])
+                    self._buffer = self._buffer[end:]
+                    self._thinking_seen = True
+                    self._mode = _PREFIX
+                    continue
+                keep = _partial_suffix_length(self._buffer, THINKING_END_TAG)
+                self._emit_content(self._buffer[:len(self._buffer) - keep])
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+                break
+            else:
+                break
+        return self._take_events()
+
+    def close(self) -> List[StreamEvent]:
+        """Flush whatever is still buffered at the end of generation."""
+        if self._mode in (_PREFIX, _THINKING):
+            self._emit_content(self._buffer)
+            self._buffer = ""
+        elif self._mode == _TOOL_CALLS and self._value is not None \
+                and not (self._value.is_string or self._value.is_container):
+            # A primitive value at the very end has no terminating character.
+            self._end_value()
+        return self._take_events()
+
+    def _emit_content(self, text: str):
+        if text:
+            self._events.append(StreamEvent("content", text))
+
+    def _flush_fragment(self):
+        if self._fragment:
+            self._events.append(StreamEvent(
+                "arguments", "".join(self._fragment), self._index))
+            self._fragment = []
+
+    def _take_events(self) -> List[StreamEvent]:
+        self._flush_fragment()
+        events, self._events = self._events, []
+        return events
+
+    def _feed_tool_calls(self, text: str):
+        for ch in text:
+            if self._value is not None:
+                if self._value.feed(ch):
+                    self._on_value_char(ch)
+                    if self._value.done:
+                        self._end_value()
+                    continue
+                self._end_value()
+
+            if self._depth == 2 and self._key is not None and ch not in _WHITESPACE:
+                if ch == ":":
+                    continue
+                self._start_value(ch)
+            elif self._depth == 2 and self._expect_key and ch == '"':
+                self._expect_key = False
+                self._start_value(ch)
+            elif ch == "[" and self._depth == 0:
+                self._depth = 1
+            elif ch == "{" and self._depth == 1:
+                # Arguments streamed so far belong to the previous call.
+                self._flush_fragment()
+                self._depth = 2
+                self._index += 1
+                self._expect_key = True
+                self._name = None
+                self._arguments = None
+                self._pending_arguments = []
+            elif ch == "," and self._depth == 2:
+                self._expect_key = True
+            elif ch == "}" and self._depth == 2:
+                self._depth = 1
+                self._dispatch()
+            elif ch == "]" and self._depth == 1:
+                self._depth = 0
+
+    def _start_value(self, ch: str):
+        self._value = _JsonValueScanner(ch)
+        self._value_chars = []
+        self._on_value_char(ch)
+        if self._value.done:
+            self._end_value()
+
+    def _on_value_char(self, ch: str):
+        self._value_chars.append(ch)
+        if self._key == "arguments" and not self._value.is_string and self._name is not None:
+            self._fragment.append(ch)
+
+    def _end_value(self):
+        value = "".join(self._value_chars)
+        scanner = self._value
+        self._value = None
+        self._value_chars = []
+
+        if self._key is None:
+            # The value just read is a key.
+            self._key = json_backend.loads(value)
+            return
+
+        key, self._key = self._key, None
+        if key == "name":
+            self._flush_fragment()
+            self._name = json_backend.loads(value)
+            self.has_tool_calls = True
+            self._events.append(StreamEvent("tool_call", self._name, self._index))
+            if self._pending_arguments:
+                self._events.append(StreamEvent(
+                    "arguments", "".join(self._pending_arguments), self._index))
+                self._pending_arguments = []
+        elif key == "arguments":
+            arguments = json_backend.loads(value) if scanner.is_string else value
+            self._arguments = arguments
+            if self._name is None:
+                self._pending_arguments.append(arguments)
+            elif scanner.is_string and arguments:
+                # Non-string arguments were already streamed as fragments.
+                self._flush_fragment()
+                self._events.append(StreamEvent("arguments", arguments, self._index))
+
+    def _dispatch(self):
+        if self.on_tool_call is None or self._name is None:
+            return
+        try:
+            arguments = json_backend.loads(self._arguments) if self._arguments else {}
+        except ValueError:
+            # Malformed arguments can not be dispatched, the response
+            # conversion reports the error.
+            return
+        self.on_tool_call(ToolCall(self._index, self._name, arguments))
+
+
+class ToolCallObserver:
+    """Logits processor that feeds the tokens generated so far to a
+    ToolCallStreamParser, so `on_tool_call` fires during non-streaming
+    generation as well.
+
+    Each call sees the tokens up to the one before the token being sampled,
+    `finish` feeds the remaining text once generation is done. `prefill` is
+    the start of the response that was part of the prompt, if any.
+    """
+
+    def __init__(
+        self,
+        llama: llama.Llama,
+        on_tool_call: Callable[[ToolCall], None],
+        prefill: str = "",
+    ):
+        self._llama = llama
+        self._parser = ToolCallStreamParser(on_tool_call=on_tool_call)
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._start: Optional[int] = None
+        self._seen = 0
+        self._text: List[str] = [prefill]
+        self._parser.feed(prefill)
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], scores: npt.NDArray[np.single]
+    ) -> npt.NDArray[np.single]:
+        if self._start is None:
+            self._start = len(input_ids)
+            return scores
+
+        new_tokens = input_ids[self._start + self._seen:].tolist()
+        if new_tokens:
+            self._seen += len(new_tokens)
+            text = self._decoder.decode(self._llama.detokenize(new_tokens))
+            self._text.append(text)
+            self._parser.feed(text)
+        return scores
+
+    def finish(self, completion_text: str):
+        observed = "".join(self._text)
+        if completion_text.startswith(observed):
+            self._parser.feed(completion_text[len(observed):])
+        self._parser.close()
+
+
+def _partial_suffix_length(text: str, tag: str) -> int:
+    """Length of the longest suffix of `text` that is a prefix of `tag`."""
+    for n in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:n]):
+            return n
+    return 0
@@ -0,0 +1,269 @@
+import itertools
+import multiprocessing
+import pickle
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Any, Dict, Iterator, List, Union
+
+from empower_functions import json_backend
+from empower_functions.pool import ReplicaStats
+
+
+class _Worker:
+    def __init__(self, index: int, process: multiprocessing.Process, conn: Connection):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.requests: Dict[int, queue.Queue] = {}
+        self.in_flight = 0
+        self.completed = 0
+        self.alive = True
+        self._send_lock = threading.Lock()
+
+    def send(self, *message):
+        with self._send_lock:
+            self.conn.send(message)
+
+
+class WorkerPool:
+    """Worker processes that each own a model and serve chat completions
+    end to end: prompt building, tokenization, generation, response
+    conversion and JSON encoding of every chunk all run in the worker, out
+    of the front end's GIL.
+
+    Requests go to the worker with the fewest in-flight requests over a
+    pipe, as the request body; responses come back JSON encoded, ready to
+    be sent to the client. A worker serves `settings.n_parallel` requests
+    at a time. A worker that exits fails its requests and is replaced, no
+    request is routed to it in the meantime.
+    """
+
+    def __init__(self, settings, n_workers: int):
+        self.slots = settings.n_parallel
+        self._context = multiprocessing.get_context("spawn")
+        self._settings_json = settings.model_dump_json()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._next = itertools.count()
+
+        # Started together so the models load in parallel.
+        self._workers = [self._spawn(index) for index in range(n_workers)]
+        for worker in self._workers:
+            self._wait_ready(worker)
+        for worker in self._workers:
+            self._start_reader(worker)
+
+    def _spawn(self, index: int) -> _Worker:
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_serve,
+            args=(child_conn, self._settings_json, json_backend.backend()),
+            name=f"empower-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        return _Worker(index, process, conn)
+
+    def _wait_ready(self, worker: _Worker):
+        try:
+            kind, _, payload = worker.conn.recv()
+        except EOFError:
+            kind, payload = "error", None
+        if kind != "ready":
+            raise RuntimeError(
+                f"Worker {worker.index} failed to load the model: {payload}")
+
+    def _start_reader(self, worker: _Worker):
+        threading.Thread(
+            target=self._read,
+            args=(worker,),
+            name=f"empower-worker-{worker.index}-reader",
+            daemon=True,
+        ).start()
+
+    def _read(self, worker: _Worker):
+        while True:
+            try:
+                kind, request_id, payload = worker.conn.recv()
+            except EOFError:
+                break
+            events = worker.requests.get(request_id)
+            if events is not None:
+                events.put((kind, payload))
+
+        with self._lock:
+            worker.alive = False
+        error = RuntimeError(f"Worker {worker.index} exited")
+        for events in list(worker.requests.values()):
+            events.put(("error", error))
+        self._respawn(worker)
+
+    def _respawn(self, worker: _Worker):
+        worker.process.join()
+        worker.conn.close()
+        try:
+            replacement = self._spawn(worker.index)
+            self._wait_ready(replacement)
+        except Exception:
+            # e.g. the interpreter is exiting, or the model can no longer be
+            # loaded: the worker stays out of rotation.
+            return
+        with self._lock:
+            replacement.completed = worker.completed
+            self._workers[self._workers.index(worker)] = replacement
+        self._start_reader(replacement)
+
+    def _pick(self) -> _Worker:
+        with self._lock:
+            workers = [worker for worker in self._workers if worker.alive]
+            if not workers:
+                raise RuntimeError("No worker is running")
+            start = next(self._next) % len(workers)
+            candidates = workers[start:] + workers[:start]
+            worker = min(candidates, key=lambda w: w.in_flight)
+            worker.in_flight += 1
+            return worker
+
+    def _release(self, worker: _Worker, request_id: int):
+        with self._lock:
+            del worker.requests[request_id]
+            worker.in_flight -= 1
+            worker.completed += 1
+
+    def create_chat_completion(self, body: Dict[str, Any]) -> Union[str, Iterator[str]]:
+        """Run the chat completion request `body` on a worker.
+
+        Returns the JSON encoded response, or for streaming requests an
+        iterator over the JSON encoded chunks. Errors raised before the
+        first chunk are raised here.
+        """
+        worker = self._pick()
+        request_id = next(self._ids)
+        events: queue.Queue = queue.Queue()
+        worker.requests[request_id] = events
+        try:
+            worker.send("chat", request_id, body)
+            kind, payload = events.get()
+        except BaseException:
+            self._release(worker, request_id)
+            raise
+
+        if kind == "chunk":
+            return self._stream(worker, request_id, events, payload)
+        self._release(worker, request_id)
+        if kind == "error":
+            raise payload
+        if kind == "done":
+            return iter(())
+        return payload
+
+    def _stream(
+        self, worker: _Worker, request_id: int, events: queue.Queue, first: str
+    ) -> Iterator[str]:
+        done = False
+        try:
+            yield first
+            while True:
+                kind, payload = events.get()
+                if kind == "error":
+                    done = True
+                    raise payload
+                if kind == "done":
+                    done = True
+                    return
+                yield payload
+        finally:
+            if not done:
+                # The client went away, stop generating.
+                worker.send("cancel", request_id, None)
+            self._release(worker, request_id)
+
+    def stats(self) -> List[ReplicaStats]:
+        with self._lock:
+            return [
+                ReplicaStats(
+                    index=worker.index,
+                    in_flight=worker.in_flight,
+                    queued=max(0, worker.in_flight - self.slots),
+                    completed=worker.completed,
+                )
+                for worker in self._workers
+            ]
+
+
+def _serve(conn: Connection, settings_json: str, backend: str):
+    """Worker process main loop, with the JSON backend of the front end."""
+    from empower_functions.monkey_patch.app import (
+        _chat_completion_kwargs,
+        _create_chat_completion_patched,
+    )
+    from empower_functions.monkey_patch.settings import EmpowerModelSettings
+    from empower_functions.monkey_patch.types import CreateChatCompletionRequestPatched
+    from empower_functions.server import _load_llama
+
+    try:
+        json_backend.use(backend)
+        settings = EmpowerModelSettings.model_validate_json(settings_json)
+        llama = _load_llama(settings)
+    except Exception as e:
+        conn.send(("error", None, str(e)))
+        return
+
+    send_lock = threading.Lock()
+    # Requests being handled, and those of them the front end cancelled.
+    # Cancels can arrive after the request finished, they are ignored.
+    requests_lock = threading.Lock()
+    live = set()
+    cancelled = set()
+
+    def send(*message):
+        with send_lock:
+            conn.send(message)
+
+    def handle(request_id: int, body: Dict[str, Any]):
+        try:
+            request = CreateChatCompletionRequestPatched.model_validate(body)
+            result = _create_chat_completion_patched(
+                llama=llama, **_chat_completion_kwargs(llama, request)
+            )
+            if isinstance(result, Iterator):
+                for chunk in result:
+                    if request_id in cancelled:
+                        result.close()
+                        break
+                    send("chunk", request_id, json_backend.dumps_response(chunk))
+                send("done", request_id, None)
+            else:
+                send("result", request_id, json_backend.dumps_response(result))
+        except Exception as e:
+            send("error", request_id, _picklable(e))
+        finally:
+            with requests_lock:
+                live.discard(request_id)
+                cancelled.discard(request_id)
+
+    with ThreadPoolExecutor(max_workers=settings.n_parallel) as executor:
+        send("ready", None, None)
+        while True:
+            try:
+                kind, request_id, body = conn.recv()
+            except EOFError:
+                break
+            with requests_lock:
+                if kind == "cancel":
+                    if request_id in live:
+                        cancelled.add(request_id)
+                    continue
+                live.add(request_id)
+            executor.submit(handle, request_id, body)
+
+
+def _picklable(e: Exception) -> Exception:
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError(f"{type(e).__name__}: {e}")
@@ -0,0 +1,58 @@
+import os
+
+import llama_cpp
+import pytest
+
+from empower_functions import EmpowerFunctionsCompletionHandler
+
+# Tests that generate need a GGUF model, any small one works since the
+# grammar constrains the structure of the output, e.g.
+# EMPOWER_TEST_MODEL=tiny.gguf python -m pytest tests
+MODEL = os.environ.get("EMPOWER_TEST_MODEL")
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_weather",
+            "description": "Get the current weather in a given location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {"type": "string", "description": "The city and state"},
+                    "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+                    "days": {"type": "integer"},
+                },
+                "required": ["location"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_time",
+            "description": "Get the current time in a time zone",
+            "parameters": {
+                "type": "object",
+                "properties": {"zone": {"type": "string"}},
+            },
+        },
+    },
+]
+
+
+@pytest.fixture(scope="session")
+def load_llama():
+    if MODEL is None:
+        pytest.skip("EMPOWER_TEST_MODEL is not set")
+
+    def load(logits_all=False, **handler_kwargs):
+        return llama_cpp.Llama(
+            model_path=MODEL,
+            n_ctx=2048,
+            logits_all=logits_all,
+            chat_handler=EmpowerFunctionsCompletionHandler(**handler_kwargs),
+            verbose=False,
+        )
+
+    return load
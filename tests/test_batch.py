@@ -0,0 +1,47 @@
+import json
+
+from conftest import TOOLS
+from empower_functions.batch import _Record, _Window, run_batch
+
+
+def record(line, tool):
+    return _Record(line, 0, {"tools": [{"type": "function", "function": {"name": tool}}]})
+
+
+def test_small_groups_are_not_starved():
+    window = _Window(max_age=4)
+    lines = iter(range(100))
+    window.add(record(next(lines), "rare"))
+    for _ in range(3):
+        window.add(record(next(lines), "common"))
+
+    # The window is refilled with records of the largest group as it is
+    # drained, the rare record must still be submitted.
+    popped = []
+    while len(popped) < 20:
+        popped.append(window.pop().line)
+        window.add(record(next(lines), "common"))
+    assert 0 in popped[:5]
+
+
+def test_resume_without_the_output_starts_over(load_llama, tmp_path):
+    llama = load_llama()
+    input_path, output_path = tmp_path / "input.jsonl", tmp_path / "output.jsonl"
+    checkpoint_path = tmp_path / "output.jsonl.checkpoint"
+    input_path.write_text("".join(
+        json.dumps({
+            "messages": [{"role": "user", "content": f"Hello {i}"}],
+            "tools": TOOLS,
+            "max_tokens": 4,
+        }) + "\n"
+        for i in range(3)
+    ))
+
+    def run():
+        return run_batch(llama, str(input_path), str(output_path), str(checkpoint_path),
+                         verbose=False)
+
+    assert run().completed == 3
+    output_path.unlink()
+    assert run().completed == 3
+    assert len(output_path.read_text().splitlines()) == 3
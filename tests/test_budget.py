@@ -0,0 +1,30 @@
+from empower_functions.budget import fit_history
+
+
+def test_dropped_turns_are_subtracted():
+    messages = [{"role": "system", "content": "s"}]
+    for i in range(10):
+        messages += [
+            {"role": "user", "content": f"question {i}"},
+            {"role": "assistant", "content": f"answer {i}"},
+        ]
+    counted = []
+
+    def count_tokens(candidate):
+        counted.append(len(candidate))
+        return 100 + sum(len(message["content"]) for message in candidate)
+
+    def count_turns(turns):
+        return sum(len(message["content"]) for message in turns)
+
+    fitted, info = fit_history(messages, 150, count_tokens, count_turns)
+    assert fitted[0]["role"] == "system" and fitted[1]["content"] == "question 8"
+    assert info.dropped_messages == 16
+    assert info.prompt_tokens == count_tokens(fitted) <= 150
+    # The untrimmed prompt and the trimmed one, not each cut.
+    assert counted[:-1] == [21, 5]
+
+    counted.clear()
+    fitted, info = fit_history(messages, 1000, count_tokens, count_turns)
+    assert fitted == messages and info.dropped_messages == 0
+    assert counted == [21]
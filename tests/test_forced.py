@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from conftest import TOOLS
+from empower_functions.monkey_patch.app import _create_chat_completion_patched
+
+TOOL_CHOICES = {
+    "named": {"type": "function", "function": {"name": "get_current_weather"}},
+    "required": "required",
+    "auto": "auto",
+}
+
+
+def generate(llama, tool_choice, i):
+    response = _create_chat_completion_patched(
+        llama,
+        messages=[{"role": "user", "content": f"What's the weather in Paris? ({i})"}],
+        tools=TOOLS,
+        tool_choice=TOOL_CHOICES[tool_choice],
+        max_tokens=200,
+        temperature=0,
+    )
+    choice = response["choices"][0]
+    message = choice["message"]
+    tool_calls = [
+        (tool_call["function"]["name"], tool_call["function"]["arguments"])
+        for tool_call in message.get("tool_calls") or []
+    ]
+    return choice["finish_reason"], message.get("content"), tool_calls
+
+
+@pytest.mark.parametrize("tool_choice", TOOL_CHOICES)
+def test_forced_tokens_do_not_change_output(load_llama, tool_choice):
+    # Forced tokens go through the draft model hook and are verified with
+    # the model's logits, at temperature 0 the same tokens must be picked.
+    sampled = load_llama(tool_call_grammar=True)
+    forced = load_llama(logits_all=True, tool_call_grammar=True, forced_tokens=True)
+    for i in range(3):
+        expected = generate(sampled, tool_choice, i)
+        assert generate(forced, tool_choice, i) == expected
+        finish_reason, _, tool_calls = expected
+        if finish_reason != "length":
+            for _, arguments in tool_calls:
+                json.loads(arguments)
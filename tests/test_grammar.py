@@ -0,0 +1,86 @@
+import json
+
+import llama_cpp
+import numpy as np
+import pytest
+
+from conftest import TOOLS
+from empower_functions.grammar import routing_gbnf, tool_call_gbnf
+from empower_functions.monkey_patch.app import _create_chat_completion_patched
+
+TOOL_CHOICES = {
+    "named": {"type": "function", "function": {"name": "get_current_weather"}},
+    "required": "required",
+    "auto": "auto",
+}
+
+
+def test_strings_exclude_control_characters():
+    functions = [tool["function"] for tool in TOOLS]
+    char = next(
+        line for line in tool_call_gbnf(functions).splitlines() if line.startswith("char ::=")
+    )
+    assert "\\x00-\\x1F" in char
+
+
+@pytest.mark.parametrize("tool_choice", TOOL_CHOICES)
+@pytest.mark.parametrize("seed", range(4))
+def test_constrained_tool_calls_are_valid_json(load_llama, tool_choice, seed):
+    llama = load_llama(tool_call_grammar=True)
+    response = _create_chat_completion_patched(
+        llama,
+        messages=[{"role": "user", "content": f"What's the weather in Paris? ({seed})"}],
+        tools=TOOLS,
+        tool_choice=TOOL_CHOICES[tool_choice],
+        max_tokens=1000,
+        temperature=0.8,
+        seed=seed,
+    )
+    choice = response["choices"][0]
+    if choice["finish_reason"] == "length":
+        pytest.skip("response cut by max_tokens")
+    for tool_call in choice["message"].get("tool_calls") or []:
+        json.loads(tool_call["function"]["arguments"])
+
+
+def steer(llama, n_prompt, text, favored):
+    """Logits processor writing `text`, then favoring the `favored` tokens."""
+    pieces = [llama.detokenize([token]) for token in range(llama.n_vocab())]
+
+    def processor(input_ids, scores):
+        written = llama.detokenize(list(input_ids[n_prompt:]))
+        rest = text[len(written):]
+        if not rest:
+            scores[favored] += 1e4
+            return scores
+        token = max(
+            (token for token, piece in enumerate(pieces) if piece and rest.startswith(piece)),
+            key=lambda token: len(pieces[token]),
+        )
+        forced = np.full_like(scores, -np.inf)
+        forced[token] = 0.0
+        return forced
+
+    return llama_cpp.LogitsProcessorList([processor])
+
+
+@pytest.mark.parametrize("gbnf", [tool_call_gbnf, routing_gbnf])
+def test_response_follows_the_thinking_block(load_llama, gbnf):
+    # The converters only look for <c> or <f> right after </thinking>.
+    llama = load_llama()
+    functions = [tool["function"] for tool in TOOLS]
+    prompt = llama.tokenize(b"Hello")
+    whitespace = [
+        token for token in range(llama.n_vocab()) if llama.detokenize([token]).isspace()
+    ]
+    completion = llama.create_completion(
+        prompt,
+        grammar=llama_cpp.LlamaGrammar.from_string(
+            gbnf(functions, include_thinking=True), verbose=False
+        ),
+        logits_processor=steer(llama, len(prompt), b"<thinking>ok</thinking>", whitespace),
+        max_tokens=40,
+        temperature=0,
+    )
+    text = completion["choices"][0]["text"]
+    assert text.startswith("<thinking>ok</thinking><")
@@ -0,0 +1,41 @@
+from empower_functions.metrics import REGISTRY
+from empower_functions.prefix_cache import PrefixStateCache
+
+PREFIX = "Functions: get_current_weather, get_time\n\nUser Message:"
+
+
+def test_only_restored_prefixes_count_as_saved(load_llama):
+    llama = load_llama()
+    cache = PrefixStateCache()
+    prompt = llama.tokenize((PREFIX + " Hello").encode("utf-8"), special=True)
+
+    cache.prepare(llama, "tools", PREFIX, prompt)
+    assert cache.info().misses == 1
+
+    # The model still holds the prefix it just evaluated.
+    cache.prepare(llama, "tools", PREFIX, prompt)
+    assert cache.info().hits == 1
+    assert cache.info().prefill_tokens_saved == 0
+
+    llama.reset()
+    llama.eval(llama.tokenize(b"Another conversation"))
+    cache.prepare(llama, "tools", PREFIX, prompt)
+    info = cache.info()
+    assert info.hits == 2
+    assert info.prefill_tokens_saved == len(llama.tokenize(PREFIX.encode("utf-8"), special=True))
+    assert llama.input_ids[:llama.n_tokens].tolist() == prompt[:llama.n_tokens]
+
+
+def test_exported_on_metrics(load_llama):
+    llama = load_llama()
+    cache = PrefixStateCache()
+    prompt = llama.tokenize((PREFIX + " Hello").encode("utf-8"), special=True)
+    cache.prepare(llama, "tools", PREFIX, prompt)
+
+    metrics = REGISTRY.render()
+    assert 'empower_prefix_cache_lookups_total{result="miss"}' in metrics
+    assert "empower_prefix_cache_restored_tokens_total" in metrics
+    size = next(
+        line for line in metrics.splitlines() if line.startswith("empower_prefix_cache_bytes ")
+    )
+    assert float(size.split()[1]) >= cache.info().size_bytes > 0
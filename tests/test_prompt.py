@@ -0,0 +1,199 @@
+import copy
+import json
+
+import pytest
+
+from conftest import TOOLS
+from empower_functions import json_backend
+from empower_functions.metrics import REGISTRY
+from empower_functions.prompt import (
+    FUNCTIONS_ENCODINGS,
+    SYSTEM_INSTRUCTION,
+    functions_block,
+    functions_cache_clear,
+    functions_cache_info,
+    prompt_messages,
+)
+
+
+def test_functions_cache_exported_on_metrics():
+    functions = [tool["function"] for tool in TOOLS]
+    functions_cache_clear()
+    assert functions_block(functions) is functions_block(functions)
+    assert functions_cache_info()[:2] == (1, 1)
+
+    metrics = REGISTRY.render().splitlines()
+    assert 'empower_functions_cache_lookups_total{result="hit"}' in " ".join(metrics)
+    assert "empower_functions_cache_entries 1" in metrics
+
+
+def baseline_prompt_messages(messages, functions_def, include_thinking=False):
+    """prompt_messages as it was before the single-pass prompt builder,
+    without the validation."""
+    merged = []
+    previous_role = ''
+    for message in copy.deepcopy(messages):
+        role = message['role']
+        if role == 'system':
+            merged.append(message)
+        elif role == 'tool':
+            result = {'value': json.loads(message['content']), 'tool_call_id': message['tool_call_id']}
+            if previous_role == 'tool':
+                merged[-1]['content'].append(result)
+            else:
+                merged.append({'role': 'tool', 'content': [result]})
+        elif role == 'user' and previous_role == 'user':
+            merged[-1]['content'] += "\n\n" + message['content']
+        else:
+            merged.append(message)
+        previous_role = role
+
+    system_instruction = SYSTEM_INSTRUCTION
+    if include_thinking:
+        system_instruction += "\nMake sure to include your thinking inside < thinking > </thinking > before response."
+    first, start = merged[0], 1
+    if first['role'] == 'system':
+        system_instruction, first, start = first['content'], merged[1], 2
+
+    if not functions_def:
+        prompted = [{'role': first['role'], 'content': first['content']}]
+    else:
+        prompted = [{'role': 'user', 'content': (
+            system_instruction + "\nFunctions:\n"
+            + json.dumps(functions_def, indent=2, ensure_ascii=False)
+            + "\n\nUser Message:\n" + first['content']
+        )}]
+    for message in merged[start:]:
+        if message['role'] == 'tool':
+            content = '<r>' + json.dumps(message['content'], indent=2, ensure_ascii=True)
+            prompted.append({'role': 'user', 'content': content})
+        elif message['role'] == 'user':
+            prompted.append({'role': 'user', 'content': '<u>' + message['content']})
+        elif message.get('content'):
+            prompted.append({'role': 'assistant', 'content': '<c>' + message['content']})
+        else:
+            functions = [tool_call['function'] for tool_call in message['tool_calls']]
+            content = '<f>' + json.dumps(functions, indent=2, ensure_ascii=False)
+            prompted.append({'role': 'assistant', 'content': content})
+    return prompted
+
+
+TOOL_CALL = {
+    'role': 'assistant',
+    'tool_calls': [{
+        'id': 'call_1',
+        'type': 'function',
+        'function': {'name': 'get_current_weather', 'arguments': '{"location": "Zürich"}'},
+    }],
+}
+HISTORIES = {
+    'user': [{'role': 'user', 'content': 'Weather in Zürich?'}],
+    'system': [
+        {'role': 'system', 'content': 'You are a helpful assistant.'},
+        {'role': 'user', 'content': 'Weather in Zürich?'},
+    ],
+    'assistant first': [
+        {'role': 'assistant', 'content': 'How can I help?'},
+        {'role': 'user', 'content': 'Weather in Zürich?'},
+    ],
+    'system and assistant first': [
+        {'role': 'system', 'content': 'Be brief.'},
+        {'role': 'assistant', 'content': 'Hi, ask me about the weather.'},
+        {'role': 'user', 'content': 'Zürich?'},
+    ],
+    'tool calls': [
+        {'role': 'user', 'content': 'Weather in Zürich?'},
+        {'role': 'user', 'content': 'And the time?'},
+        TOOL_CALL,
+        {'role': 'tool', 'tool_call_id': 'call_1', 'content': '{"temperature": 1e-07, "wind": null}'},
+        {'role': 'tool', 'tool_call_id': 'call_2', 'content': '{"time": "12:00", "offset": 1e16}'},
+        {'role': 'assistant', 'content': 'It is cold, and noon.'},
+        {'role': 'user', 'content': 'Thanks ☀'},
+    ],
+}
+
+
+@pytest.mark.parametrize("backend", [name for name in ("json", "orjson") if name != "orjson" or json_backend.orjson])
+@pytest.mark.parametrize("tools", [True, False], ids=["tools", "no tools"])
+@pytest.mark.parametrize("history", HISTORIES)
+def test_prompt_matches_baseline(backend, tools, history):
+    functions = [tool["function"] for tool in TOOLS] if tools else []
+    messages = HISTORIES[history]
+    json_backend.use(backend)
+    try:
+        functions_cache_clear()
+        assert prompt_messages(messages, functions) == baseline_prompt_messages(messages, functions)
+        if tools:
+            assert prompt_messages(messages, functions, include_thinking=True) == (
+                baseline_prompt_messages(messages, functions, include_thinking=True)
+            )
+    finally:
+        json_backend.use("auto")
+        functions_cache_clear()
+
+
+FUNCTIONS = [{
+    'name': 'convert',
+    'description': 'Convert a quantity, e.g. 5 °C to °F. Précis ☀',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'value': {'type': 'number', 'minimum': 1e-07, 'maximum': 1e16, 'default': 0.1},
+            'unit': {'type': ['string', 'null'], 'enum': ['°C', '°F', None], 'default': None},
+            'precision': {'type': 'integer', 'default': 12345678901234567890},
+        },
+        'required': ['value'],
+    },
+}]
+
+
+@pytest.mark.skipif(json_backend.orjson is None, reason="orjson is not installed")
+@pytest.mark.parametrize("encoding", FUNCTIONS_ENCODINGS)
+@pytest.mark.parametrize("history", HISTORIES)
+def test_prompt_is_the_same_with_either_backend(encoding, history):
+    messages = HISTORIES[history] + [
+        {'role': 'assistant', 'tool_calls': [{
+            'id': 'call_3',
+            'type': 'function',
+            'function': {'name': 'convert', 'arguments': '{"value": 1e16, "unit": null}'},
+        }]},
+        {'role': 'tool', 'tool_call_id': 'call_3', 'content': '{"value": 1e-7, "unit": "°F", "note": null}'},
+        {'role': 'tool', 'tool_call_id': 'call_4', 'content': '[1.0, 0.1, 1e16, -0.0, "naïve"]'},
+        {'role': 'user', 'content': 'Merci'},
+    ]
+    prompts = {}
+    for backend in ("json", "orjson"):
+        json_backend.use(backend)
+        try:
+            functions_cache_clear()
+            prompts[backend] = [
+                prompt_messages(messages, FUNCTIONS, include_thinking=include_thinking,
+                                functions_encoding=encoding)
+                for include_thinking in (False, True)
+            ]
+        finally:
+            json_backend.use("auto")
+            functions_cache_clear()
+    assert prompts["orjson"] == prompts["json"]
+
+
+def test_only_small_tool_results_are_cached():
+    from empower_functions.prompt import _tool_result
+
+    def history(content):
+        return [
+            {'role': 'user', 'content': 'Weather?'},
+            TOOL_CALL,
+            {'role': 'tool', 'tool_call_id': 'call_1', 'content': content},
+        ]
+
+    _tool_result.cache_clear()
+    large = history(json.dumps({'forecast': ['sunny'] * 1000}))
+    assert prompt_messages(large, []) == baseline_prompt_messages(large, [])
+    assert _tool_result.cache_info().currsize == 0
+
+    small = history(json.dumps({'temperature': 20}))
+    prompt_messages(small, [])
+    prompt_messages(small, [])
+    assert _tool_result.cache_info().currsize == 1
+    assert _tool_result.cache_info().hits == 1
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from empower_functions import json_backend
+from empower_functions.chat_handler import (
+    _convert_completion_to_chat_function,
+    _scan_tool_calls,
+)
+
+ARGUMENTS = {"city": "Zürich", "limit": 1e-07, "unit": None, "tags": ["a \"b\"", {}]}
+
+
+def completion(text):
+    return {
+        "id": "cmpl-1",
+        "object": "text_completion",
+        "created": 0,
+        "model": "model",
+        "choices": [{"index": 0, "text": text, "logprobs": None, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+def tool_calls(text):
+    message = _convert_completion_to_chat_function(completion(text))["choices"][0]["message"]
+    return [
+        (tool_call["id"], tool_call["function"]["name"], tool_call["function"]["arguments"])
+        for tool_call in message["tool_calls"]
+    ]
+
+
+def test_scan_returns_arguments_as_generated():
+    arguments = json.dumps(ARGUMENTS, indent=1, ensure_ascii=False)
+    text = (
+        '<f>[{"name": "get_weather", "arguments": ' + arguments + '},\n'
+        ' {"name": "get_\\u0074ime", "arguments": "{\\"zone\\": \\"UTC\\"}"}]\n'
+    )
+    assert _scan_tool_calls(text, len("<f>")) == [
+        ("get_weather", arguments),
+        ("get_time", '{"zone": "UTC"}'),
+    ]
+    assert tool_calls(text) == [
+        ("call__0_get_weather_cmpl-1_0", "get_weather", arguments),
+        ("call__0_get_time_cmpl-1_1", "get_time", '{"zone": "UTC"}'),
+    ]
+
+
+@pytest.mark.parametrize("text", [
+    '<f>[{"arguments": {}, "name": "f"}]',
+    '<f>[{"name": "f", "arguments": {}, "id": 1}]',
+    '<f>[{"name": "f", "arguments": {}}] trailing',
+])
+def test_scan_leaves_other_shapes_to_the_full_parse(text):
+    assert _scan_tool_calls(text, len("<f>")) is None
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_fallback_serializes_arguments_with_json_dumps(backend):
+    text = '<f>[{"arguments": ' + json.dumps(ARGUMENTS) + ', "name": "f"},' \
+        ' {"name": "g", "arguments": "raw", "extra": true}]'
+    json_backend.use(backend)
+    try:
+        assert tool_calls(text) == [
+            ("call__0_f_cmpl-1_0", "f", json.dumps(ARGUMENTS)),
+            ("call__0_g_cmpl-1_1", "g", "raw"),
+        ]
+    finally:
+        json_backend.use("auto")
+
+
+def test_invalid_arguments_still_fail():
+    with pytest.raises(ValueError):
+        tool_calls('<f>[{"name": "f", "arguments": {"a": }}]')
@@ -0,0 +1,75 @@
+from conftest import MODEL
+import pytest
+
+from empower_functions.retrieval import ToolRetriever
+
+FUNCTIONS = [
+    {"name": "get_current_weather", "description": "Get the current weather in a city"},
+    {"name": "get_time", "description": "Get the current time in a time zone"},
+    {"name": "send_email", "description": "Send an email to a recipient"},
+    {"name": "book_flight", "description": "Book a flight between two airports"},
+]
+WEATHER = [{"role": "user", "content": "What is the weather in Paris?"}]
+EMAIL = WEATHER + [
+    {"role": "assistant", "content": "It is sunny."},
+    {"role": "user", "content": "Send an email about it"},
+]
+FLIGHT = EMAIL + [
+    {"role": "assistant", "content": "Sent."},
+    {"role": "user", "content": "Book a flight to Paris"},
+]
+
+
+def names(functions):
+    return [function["name"] for function in functions]
+
+
+def test_session_keeps_earlier_selections_within_top_k():
+    retriever = ToolRetriever(top_k=2)
+    assert names(retriever.select(FUNCTIONS, WEATHER[:1], session_id="a"))[0] == (
+        "get_current_weather"
+    )
+    # Earlier selections come first, so the Functions block keeps its prefix.
+    assert names(retriever.select(FUNCTIONS, EMAIL, session_id="a")) == [
+        "get_current_weather",
+        "send_email",
+    ]
+    # Full, the least recently selected function makes room.
+    assert names(retriever.select(FUNCTIONS, FLIGHT, session_id="a")) == [
+        "send_email",
+        "book_flight",
+    ]
+    assert names(retriever.select(FUNCTIONS, EMAIL, session_id="b")) == [
+        "get_current_weather",
+        "send_email",
+    ]
+
+
+def test_session_selection_is_bounded():
+    retriever = ToolRetriever(top_k=1)
+    called = [
+        {
+            "role": "assistant",
+            "tool_calls": [
+                {"id": "1", "function": {"name": "get_time", "arguments": "{}"}}
+            ],
+        },
+        {"role": "tool", "tool_call_id": "1", "content": "{}"},
+    ]
+    for query in ["weather", "email", "flight", "weather"] * 3:
+        messages = called + [{"role": "user", "content": query}]
+        selected = names(retriever.select(FUNCTIONS, messages, session_id="a"))
+        # top_k, and the function already called.
+        assert len(selected) == 2 and "get_time" in selected
+    assert names(retriever.select(FUNCTIONS, EMAIL)) == ["send_email"]
+
+
+@pytest.mark.skipif(MODEL is None, reason="EMPOWER_TEST_MODEL is not set")
+def test_long_tool_documents_are_embedded():
+    retriever = ToolRetriever(top_k=1, embedding_model_path=MODEL)
+    long_function = {"name": "describe", "description": "Describe things. " * 100}
+    selected = retriever.select([long_function] + FUNCTIONS, WEATHER)
+    assert len(selected) == 1
+    # Embedded whole, not cut to the default 512 tokens.
+    llama = retriever._embedding_llama
+    assert llama.n_batch >= len(llama.tokenize(long_function["description"].encode("utf-8"))) > 512
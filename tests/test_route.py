@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import TOOLS
+
+MESSAGES = [{"role": "user", "content": "What's the weather in Paris?"}]
+
+
+def route(llama, tool_choice):
+    return llama.chat_handler(
+        llama=llama, messages=MESSAGES, tools=TOOLS, tool_choice=tool_choice, route=True
+    )
+
+
+def test_route_returns_the_decision(load_llama):
+    llama = load_llama()
+    response = route(llama, "auto")
+    assert response["object"] == "chat.route"
+    assert response["type"] in ("content", "tool_call", None)
+    if response["type"] == "tool_call":
+        assert response["function"] in ("get_current_weather", "get_time")
+    assert response["usage"]["completion_tokens"] > 0
+
+
+@pytest.mark.parametrize(
+    "tool_choice, function",
+    [
+        ("required", None),
+        ({"type": "function", "function": {"name": "get_time"}}, "get_time"),
+    ],
+)
+def test_forced_route_is_a_tool_call(load_llama, tool_choice, function):
+    response = route(load_llama(), tool_choice)
+    assert response["type"] == "tool_call"
+    if function is not None:
+        assert response["function"] == function
+    else:
+        assert response["function"] in ("get_current_weather", "get_time")
+
+
+def test_create_chat_completion_rejects_route(load_llama):
+    llama = load_llama()
+    with pytest.raises(TypeError):
+        llama.create_chat_completion(messages=MESSAGES, tools=TOOLS, route=True)
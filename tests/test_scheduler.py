@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import llama_cpp
+import numpy as np
+import pytest
+
+from empower_functions.scheduler import BatchScheduler
+
+
+def script(llama, n_prompt, tokens):
+    """Logits processor generating `tokens`, whatever the model."""
+    def processor(input_ids, scores):
+        forced = np.full_like(scores, -np.inf)
+        forced[tokens[len(input_ids) - n_prompt]] = 0.0
+        return forced
+    return llama_cpp.LogitsProcessorList([processor])
+
+
+def test_held_back_text_is_sent_at_end_of_generation(load_llama):
+    llama = load_llama()
+    scheduler = BatchScheduler(llama, n_parallel=2)
+    prompt = llama.tokenize(b"Hello")
+    # "<" may be the start of the stop sequence until the model ends.
+    less_than = next(t for t in range(llama.n_vocab()) if llama.detokenize([t]) == b"<")
+    tokens = [less_than, llama.token_eos()]
+    completion = scheduler.create_completion(
+        prompt,
+        stop=["<|stop|>"],
+        max_tokens=8,
+        logits_processor=script(llama, len(prompt), tokens),
+    )
+    assert completion["choices"][0]["text"] == "<"
+    assert completion["choices"][0]["finish_reason"] == "stop"
+
+
+def test_failed_admission_fails_the_requests(load_llama, monkeypatch):
+    llama = load_llama()
+    scheduler = BatchScheduler(llama, n_parallel=2)
+
+    def fail(sequence, reserved):
+        raise RuntimeError("KV cache copy failed")
+
+    monkeypatch.setattr(scheduler, "_assign", fail)
+    with ThreadPoolExecutor() as executor:
+        futures = [
+            executor.submit(
+                scheduler.create_completion, llama.tokenize(b"Hello"), max_tokens=4)
+            for _ in range(3)
+        ]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="KV cache copy failed"):
+                future.result(timeout=30)
+
+
+def test_failed_logits_processor_fails_only_its_request(load_llama):
+    llama = load_llama()
+    scheduler = BatchScheduler(llama, n_parallel=3)
+    prompt = llama.tokenize(b"Hello")
+    letters = [next(t for t in range(llama.n_vocab()) if llama.detokenize([t]) == c)
+               for c in (b"a", b"b", b"c")]
+
+    def fail(input_ids, scores):
+        # Fail once the other requests are being generated alongside.
+        if len(scheduler._running) == 3:
+            raise RuntimeError("on_tool_call failed")
+        forced = np.full_like(scores, -np.inf)
+        forced[letters[0]] = 0.0
+        return forced
+
+    with ThreadPoolExecutor() as executor:
+        failing = executor.submit(
+            scheduler.create_completion, prompt, max_tokens=1000,
+            logits_processor=llama_cpp.LogitsProcessorList([fail]))
+        futures = [
+            executor.submit(
+                scheduler.create_completion, prompt, max_tokens=3,
+                logits_processor=script(llama, len(prompt), letters))
+            for _ in range(2)
+        ]
+        with pytest.raises(RuntimeError, match="on_tool_call failed"):
+            failing.result(timeout=30)
+        for future in futures:
+            assert future.result(timeout=30)["choices"][0]["text"] == "abc"
@@ -0,0 +1,42 @@
+import pytest
+
+from conftest import TOOLS
+from empower_functions.prompt import prompt_messages
+from empower_functions.sessions import history_digests
+
+TOOL_CALL = {
+    "role": "assistant",
+    "tool_calls": [{
+        "id": "call_1",
+        "type": "function",
+        "function": {"name": "get_current_weather", "arguments": '{"location": "Zürich"}'},
+    }],
+}
+# Each element is appended to the conversation before the next turn.
+TURNS = [
+    [{"role": "system", "content": "You are a helpful assistant."},
+     {"role": "user", "content": "Weather in Zürich?"}],
+    [TOOL_CALL,
+     {"role": "tool", "tool_call_id": "call_1", "content": '{"temperature": 1e-07}'}],
+    [{"role": "assistant", "content": "It is cold."},
+     {"role": "user", "content": "And tomorrow?"}],
+    [{"role": "assistant", "content": "Colder."},
+     {"role": "user", "content": "Thanks ☀"}],
+]
+
+
+@pytest.mark.parametrize("session_id", [None, "conversation"], ids=["digest", "session id"])
+@pytest.mark.parametrize("tools", [True, False], ids=["tools", "no tools"])
+def test_cached_prompt_matches_full_prompt(load_llama, session_id, tools):
+    llama = load_llama(session_cache_size=8)
+    handler = llama.chat_handler
+    functions = [tool["function"] for tool in TOOLS] if tools else []
+    messages = []
+    for turn in TURNS:
+        messages = messages + turn
+        tokens = handler._session_prompt(
+            llama, messages, functions, False, "indent", session_id, history_digests(messages)
+        )
+        full = handler._render(prompt_messages(messages, functions, functions_encoding="indent"))
+        assert tokens == llama.tokenize(full.encode("utf-8"), special=True)
+    assert handler.session_cache.info().hits == len(TURNS) - 1
@@ -0,0 +1,31 @@
+from empower_functions.metrics import REGISTRY
+from empower_functions.session_store import SessionStateStore
+
+
+def metric(name):
+    for line in REGISTRY.render().splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    return 0.0
+
+
+def test_exported_on_metrics(load_llama, tmp_path):
+    llama = load_llama()
+    store = SessionStateStore(str(tmp_path))
+    size = metric("empower_session_store_bytes")
+    evictions = metric("empower_session_store_evictions_total")
+
+    prompt = llama.tokenize(b"Hello there")
+    llama.reset()
+    llama.eval(prompt)
+    store.save(llama, "first")
+    assert metric("empower_session_store_bytes") == size + store.info().size_bytes
+
+    llama.reset()
+    assert store.restore(llama, ["first"], prompt) == "first"
+    assert 'empower_session_store_lookups_total{result="hit"}' in REGISTRY.render()
+    assert metric("empower_session_store_restored_tokens_total") >= len(prompt)
+
+    store.clear()
+    assert metric("empower_session_store_bytes") == size
+    assert metric("empower_session_store_evictions_total") == evictions + 1
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from empower_functions.streaming import ToolCall, ToolCallStreamParser
+
+NESTED = {"q": 'a "quoted" }] [{ thing \\', "n": {"m": [1, {"x": "é\n"}]}}
+
+
+def calls(*elements):
+    return "<f>" + json.dumps(list(elements), indent=2, ensure_ascii=False)
+
+
+# Model output, expected content and (name, arguments) of each tool call.
+CASES = {
+    "content": ("<c>Hello <f> world", "Hello <f> world", []),
+    "no prefix": ("Hello there", "Hello there", []),
+    "thinking and content": (
+        "<thinking>Just say hi</thinking><c>Hi!",
+        "<thinking>Just say hi</thinking>Hi!",
+        [],
+    ),
+    "thinking and tool calls": (
+        "<thinking>Call f</thinking>" + calls({"name": "f", "arguments": {"a": 1}}),
+        "<thinking>Call f</thinking>",
+        [("f", json.dumps({"a": 1}, indent=2).replace("\n", "\n    "))],
+    ),
+    "nested and escaped": (
+        calls({"name": "f", "arguments": NESTED}, {"name": "g", "arguments": {}}),
+        "",
+        [
+            ("f", json.dumps(NESTED, indent=2, ensure_ascii=False).replace("\n", "\n    ")),
+            ("g", "{}"),
+        ],
+    ),
+    "arguments before the name": (
+        calls({"arguments": {"city": "Paris"}, "name": "weather"}),
+        "",
+        [("weather", json.dumps({"city": "Paris"}, indent=2).replace("\n", "\n    "))],
+    ),
+    "string arguments": (
+        calls({"name": "f", "arguments": json.dumps({"a": "b"})}),
+        "",
+        [("f", json.dumps({"a": "b"}))],
+    ),
+    "array and number arguments": (
+        '<f>[{"name": "f", "arguments": [1, [2]]}, {"name": "g", "arguments": 5}]',
+        "",
+        [("f", "[1, [2]]"), ("g", "5")],
+    ),
+    "number arguments at the end": ('<f>[{"name": "f", "arguments": 5', "", [("f", "5")]),
+}
+
+
+def parse(chunks):
+    dispatched = []
+    parser = ToolCallStreamParser(on_tool_call=dispatched.append)
+    events = []
+    for chunk in chunks:
+        events += parser.feed(chunk)
+    events += parser.close()
+
+    content = []
+    tool_calls = []
+    for event in events:
+        if event.kind == "content":
+            content.append(event.value)
+        elif event.kind == "tool_call":
+            assert event.index == len(tool_calls)
+            tool_calls.append([event.value, ""])
+        else:
+            assert event.index == len(tool_calls) - 1
+            tool_calls[-1][1] += event.value
+    return "".join(content), [tuple(call) for call in tool_calls], dispatched
+
+
+def splits(text):
+    yield [text]
+    yield list(text)
+    for i in range(1, len(text)):
+        yield [text[:i], text[i:]]
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_any_chunking_gives_the_same_events(case):
+    text, content, tool_calls = CASES[case]
+    expected_dispatch = [
+        ToolCall(index, name, json.loads(arguments) if arguments else {})
+        for index, (name, arguments) in enumerate(tool_calls)
+        if case != "number arguments at the end"
+    ]
+    for chunks in splits(text):
+        assert parse(chunks) == (content, tool_calls, expected_dispatch), chunks
@@ -0,0 +1,48 @@
+import json
+import time
+
+import pytest
+
+from conftest import MODEL, TOOLS
+from empower_functions.workers import WorkerPool
+
+pytestmark = pytest.mark.skipif(MODEL is None, reason="EMPOWER_TEST_MODEL is not set")
+
+BODY = {
+    "messages": [{"role": "user", "content": "Hello"}],
+    "tools": TOOLS,
+    "max_tokens": 4,
+    "temperature": 0,
+}
+
+
+@pytest.fixture(scope="module")
+def pool():
+    from empower_functions.monkey_patch.settings import EmpowerModelSettings
+
+    settings = EmpowerModelSettings(
+        model=MODEL, chat_format="empower-functions", n_ctx=2048, verbose=False)
+    return WorkerPool(settings, 1)
+
+
+def test_dead_worker_is_replaced(pool):
+    assert json.loads(pool.create_chat_completion(BODY))["object"] == "chat.completion"
+
+    worker = pool._workers[0]
+    worker.process.kill()
+    deadline = time.monotonic() + 60
+    while pool._workers[0] is worker:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+    assert json.loads(pool.create_chat_completion(BODY))["object"] == "chat.completion"
+    assert pool.stats()[0].completed == 2
+
+
+def test_closed_stream_leaves_the_worker_serving(pool):
+    chunks = pool.create_chat_completion(dict(BODY, stream=True))
+    next(chunks)
+    # The worker may have finished already when the cancel arrives.
+    chunks.close()
+    for chunk in pool.create_chat_completion(dict(BODY, stream=True)):
+        json.loads(chunk)